@@ -0,0 +1,267 @@
+"""
+pymys - Benchmarks of the decode, dispatch and state update hot paths
+
+Traffic is synthetic and generated from a fixed seed, and is replayed from an in-memory serial port,
+so runs are reproducible and comparable.
+
+    python benchmarks/bench.py
+    python benchmarks/bench.py --save baseline.json
+    python benchmarks/bench.py --compare baseline.json --threshold 0.1
+"""
+
+import argparse
+import gc
+import io
+import json
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from pymys import mys_16
+from pymys import mysensors as mys
+
+# (sensor type, value type, payload generator) of the synthetic sensors.
+SENSORS = (
+    (mys_16.Presentation.S_TEMP, mys_16.SetReq.V_TEMP, lambda r: "{:.1f}".format(r.uniform(-10, 40))),
+    (mys_16.Presentation.S_HUM, mys_16.SetReq.V_HUM, lambda r: "{:.1f}".format(r.uniform(20, 90))),
+    (mys_16.Presentation.S_BINARY, mys_16.SetReq.V_STATUS, lambda r: str(r.randint(0, 1))),
+    (mys_16.Presentation.S_DIMMER, mys_16.SetReq.V_PERCENTAGE, lambda r: str(r.randint(0, 100))),
+    (mys_16.Presentation.S_POWER, mys_16.SetReq.V_WATT, lambda r: "{:.2f}".format(r.uniform(0, 3000))),
+    (mys_16.Presentation.S_RGB_LIGHT, mys_16.SetReq.V_RGB, lambda r: "{:06x}".format(r.getrandbits(24))),
+)
+
+
+class FakeSerial(object):
+    """ In-memory serial port replaying a capture and discarding what is written. """
+
+    def __init__(self, data):
+        self.data = data
+        self.stream = io.BytesIO(data)
+        self.written = 0
+
+    def readline(self):
+        return self.stream.readline()
+
+    def write(self, data):
+        self.written += len(data)
+        return len(data)
+
+    def rewind(self):
+        self.stream.seek(0)
+
+    def close(self):
+        pass
+
+
+def presentations(nodes, sensors):
+    """ Returns the lines of nodes presenting themselves and their sensors. """
+    lines = []
+    for node_id in range(1, nodes + 1):
+        lines.append("{};255;0;0;17;1.6\n".format(node_id))
+        lines.append("{};255;3;0;11;Bench {}\n".format(node_id, node_id))
+        lines.append("{};255;3;0;12;1.0\n".format(node_id))
+        for sensor_id in range(sensors):
+            sensor_type = SENSORS[sensor_id % len(SENSORS)][0]
+            lines.append("{};{};0;0;{};\n".format(node_id, sensor_id, int(sensor_type)))
+
+    return lines
+
+
+def traffic(nodes, sensors, messages, seed=0):
+    """ Returns lines of random sensor values, with a battery level every 20 messages. """
+    rand = random.Random(seed)
+    lines = []
+    for i in range(messages):
+        node_id = rand.randint(1, nodes)
+        if i % 20 == 19:
+            lines.append("{};255;3;0;0;{}\n".format(node_id, rand.randint(0, 100)))
+            continue
+        sensor_id = rand.randrange(sensors)
+        _, value_type, value = SENSORS[sensor_id % len(SENSORS)]
+        lines.append("{};{};1;0;{};{}\n".format(node_id, sensor_id, int(value_type), value(rand)))
+
+    return lines
+
+
+def new_gateway(data=b"", **kwargs):
+    gw = mys.SerialGateway("/dev/null", protocol_version=1.6, **kwargs)
+    gw.serial = FakeSerial(data)
+    return gw
+
+
+def presented_gateway(args, **kwargs):
+    gw = new_gateway(**kwargs)
+    for line in presentations(args.nodes, args.sensors):
+        gw._dispatch(line.encode())
+
+    return gw
+
+
+def bench_decode(args):
+    lines = [line.encode() for line in traffic(args.nodes, args.sensors, args.messages)]
+    const = mys_16
+
+    def run():
+        for line in lines:
+            mys.Message(line, const)
+
+    return run, len(lines)
+
+
+def bench_encode(args):
+    msgs = [mys.Message(line) for line in traffic(args.nodes, args.sensors, args.messages)]
+
+    def run():
+        for msg in msgs:
+            msg.encode()
+
+    return run, len(msgs)
+
+
+def bench_encode_into(args):
+    msgs = [mys.Message(line) for line in traffic(args.nodes, args.sensors, args.messages)]
+    buffer = bytearray()
+
+    def run():
+        for msg in msgs:
+            del buffer[:]
+            msg.encode_into(buffer)
+
+    return run, len(msgs)
+
+
+def bench_presentation(args):
+    lines = [line.encode() for line in presentations(args.nodes, args.sensors)]
+
+    def run():
+        gw = new_gateway()
+        for line in lines:
+            gw._dispatch(line)
+
+    return run, len(lines)
+
+
+def bench_set(args):
+    gw = presented_gateway(args)
+    lines = [line.encode() for line in traffic(args.nodes, args.sensors, args.messages) if ";1;0;" in line]
+
+    def run():
+        for line in lines:
+            gw._dispatch(line)
+
+    return run, len(lines)
+
+
+def bench_internal(args):
+    gw = presented_gateway(args)
+    lines = [line.encode() for line in traffic(args.nodes, args.sensors, args.messages * 20)
+             if ";255;3;" in line][:args.messages]
+
+    def run():
+        for line in lines:
+            gw._dispatch(line)
+
+    return run, len(lines)
+
+
+def bench_process(args):
+    lines = traffic(args.nodes, args.sensors, args.messages)
+    gw = presented_gateway(args, message_callback=lambda msg: None)
+    gw.serial = FakeSerial("".join(lines).encode())
+
+    def run():
+        gw.serial.rewind()
+        for _ in range(len(lines)):
+            gw.process()
+
+    return run, len(lines)
+
+
+def bench_get_free_id(args):
+    gw = presented_gateway(args)
+    # Leaves a single free ID, the worst case with every other ID used.
+    allocator = gw.id_allocator
+    allocator.release(args.nodes)
+
+    def run():
+        for _ in range(args.messages):
+            allocator.release(gw.get_free_id())
+
+    return run, args.messages
+
+
+BENCHMARKS = (
+    ('decode', bench_decode),
+    ('encode', bench_encode),
+    ('encode_into', bench_encode_into),
+    ('presentation', bench_presentation),
+    ('set', bench_set),
+    ('internal', bench_internal),
+    ('process', bench_process),
+    ('get_free_id', bench_get_free_id),
+)
+
+
+def measure(setup, args):
+    """ Returns the best messages per second of args.repeat runs. """
+    run, count = setup(args)
+    run()
+    best = None
+    for _ in range(args.repeat):
+        gc.collect()
+        start = time.perf_counter()
+        run()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+
+    return count / best if best else float('inf')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmarks of pymys' hot paths.")
+    parser.add_argument('--nodes', type=int, default=254)
+    parser.add_argument('--sensors', type=int, default=8, help="Sensors per node")
+    parser.add_argument('--messages', type=int, default=50000)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--only', action='append', help="Run only this benchmark, may be repeated")
+    parser.add_argument('--save', help="Save the results as JSON")
+    parser.add_argument('--compare', help="Compare with results saved by --save")
+    parser.add_argument('--threshold', type=float, default=0.1,
+                        help="Relative slowdown reported as a regression (default 0.1)")
+    args = parser.parse_args(argv)
+    if not 1 <= args.nodes <= 254:
+        parser.error("--nodes must be between 1 and 254")
+
+    baseline = {}
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)['results']
+
+    results = {}
+    regressions = []
+    for name, setup in BENCHMARKS:
+        if args.only and name not in args.only:
+            continue
+        rate = results[name] = measure(setup, args)
+        line = "{:<14} {:>12,.0f} msg/s".format(name, rate)
+        if name in baseline:
+            change = rate / baseline[name] - 1
+            line += "  {:+.1%}".format(change)
+            if change < -args.threshold:
+                regressions.append(name)
+                line += "  REGRESSION"
+        print(line)
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump({'python': sys.version, 'nodes': args.nodes, 'sensors': args.sensors,
+                       'messages': args.messages, 'results': results}, f, indent=2)
+
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
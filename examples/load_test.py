@@ -0,0 +1,19 @@
+import time
+
+from pymys import mysensors as mys
+from pymys.simulator import SimulatedSerial, simulated_nodes
+
+
+SENSORS = [('S_TEMP', 'V_TEMP'), ('S_HUM', 'V_HUM'), ('S_BINARY', 'V_STATUS')]
+MESSAGES = 100000
+
+port = SimulatedSerial(simulated_nodes(254, SENSORS, interval=1.0), realtime=False, seed=0)
+gw = mys.SerialGateway("simulated", serial_factory=port.open)
+gw.connect()
+
+start = time.perf_counter()
+for _ in range(MESSAGES):
+    gw.process()
+elapsed = time.perf_counter() - start
+
+print("{} messages in {:.2f}s: {:.0f} msg/s".format(MESSAGES, elapsed, MESSAGES / elapsed))
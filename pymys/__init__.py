@@ -1,3 +1,11 @@
 """
 Python implementation of MySensors API
 """
+
+
+def __getattr__(name):
+    # Imported lazily so that "import pymys" does not load the gateways and pyserial.
+    if name in ('parse_stream', 'MessageColumns'):
+        from pymys import mysensors
+        return getattr(mysensors, name)
+    raise AttributeError("module 'pymys' has no attribute '{}'".format(name))
@@ -0,0 +1,105 @@
+"""
+pymys - Tracking of acknowledged messages
+"""
+
+from threading import Lock
+
+
+class AckTracker(object):
+    """
+      Keeps the messages sent with the ack flag until their echo is received.
+      Pending messages are indexed by (node_id, sensor_id, type, sub_type) and retransmitted by timers
+      of a TimerWheel, doubling the timeout (backoff) at each attempt. Each message has a Future which
+      is completed with the echo, or fails with AckTimeoutError when the retries are exhausted.
+    """
+
+    def __init__(self, send, timers, timeout=1.0, retries=3, backoff=2.0):
+        """
+          :param send: Function which writes a message to the gateway.
+          :param timers: TimerWheel firing the retransmissions.
+        """
+        self.send = send
+        self.timers = timers
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.pending = {}
+        self.failures = {}
+        self.lock = Lock()
+
+    def track(self, msg):
+        """
+          Sets the ack flag of a message which is about to be sent and starts waiting for its echo.
+          A pending message with the same key is superseded and its Future cancelled.
+          :return: Future completed with the echo.
+        """
+        from concurrent.futures import Future
+
+        msg.ack = 1
+        key = (msg.node_id, msg.sensor_id, int(msg.type), int(msg.sub_type))
+        entry = _Pending(msg, Future())
+        with self.lock:
+            previous = self.pending.get(key)
+            self.pending[key] = entry
+            entry.timer = self.timers.schedule(self.timeout, self._expire, key, entry)
+        if previous is not None:
+            self.timers.cancel(previous.timer)
+            previous.future.cancel()
+
+        return entry.future
+
+    def acknowledge(self, msg):
+        """
+          Completes the pending message echoed by msg.
+          :return: True if a pending message was acknowledged.
+        """
+        key = (msg.node_id, msg.sensor_id, int(msg.type), int(msg.sub_type))
+        with self.lock:
+            entry = self.pending.pop(key, None)
+        if entry is None:
+            return False
+
+        self.timers.cancel(entry.timer)
+        # The caller may have cancelled the Future, e.g. when waiting for it timed out.
+        if entry.future.set_running_or_notify_cancel():
+            entry.future.set_result(msg)
+        return True
+
+    def _expire(self, key, entry):
+        with self.lock:
+            if self.pending.get(key) is not entry:
+                return
+            if entry.attempts >= self.retries:
+                del self.pending[key]
+                self.failures[key[0]] = self.failures.get(key[0], 0) + 1
+                failed = True
+            else:
+                entry.attempts += 1
+                delay = self.timeout * self.backoff ** entry.attempts
+                entry.timer = self.timers.schedule(delay, self._expire, key, entry)
+                failed = False
+
+        if failed:
+            error = AckTimeoutError("No ack from node {} for {}".format(key[0], entry.msg))
+            if entry.future.set_running_or_notify_cancel():
+                entry.future.set_exception(error)
+        else:
+            self.send(entry.msg)
+
+    def __len__(self):
+        return len(self.pending)
+
+
+class _Pending(object):
+    __slots__ = ('msg', 'future', 'timer', 'attempts')
+
+    def __init__(self, msg, future):
+        self.msg = msg
+        self.future = future
+        self.timer = None
+        self.attempts = 0
+
+
+class AckTimeoutError(Exception):
+    def __init__(self, *args, **kwargs):
+        super(AckTimeoutError, self).__init__(*args, **kwargs)
@@ -0,0 +1,184 @@
+"""
+pymys - asyncio implementation of the MySensors Gateways
+"""
+
+import asyncio
+import inspect
+
+from pymys.mysensors import Gateway, Message, GatewayError, BadMessageError
+
+try:
+    import serial_asyncio
+except ImportError:
+    serial_asyncio = None
+
+
+class AsyncGateway(Gateway):
+    """
+      Base implementation for a MySensors Gateway running on an asyncio event loop.
+
+      Lines are read from an asyncio StreamReader and written to a StreamWriter, so
+      several gateways can share a single loop instead of one thread each. Messages
+      are dispatched through the same callbacks table used by Gateway, and both the
+      handlers and message_callback may be coroutine functions.
+    """
+
+    def __init__(self, message_callback=None, protocol_version=None, **kwargs):
+        self.reader = None
+        self.writer = None
+        super(AsyncGateway, self).__init__(message_callback, protocol_version, **kwargs)
+
+    async def open_connection(self):
+        """
+          Opens the connection to the gateway.
+          Must be implemented on a specialized class.
+          :return: A (StreamReader, StreamWriter) tuple.
+        """
+        raise NotImplementedError
+
+    async def connect(self, timeout=10):
+        """
+          Opens the connection and waits for the gateway to be ready.
+          Unless protocol_version was given, it is requested to the gateway.
+          :param timeout: Seconds to wait for the gateway.
+        """
+        if self.writer is None:
+            # Retransmissions are fired from the timers' thread, so they are handed to the loop.
+            loop = asyncio.get_running_loop()
+            self.acks.send = lambda msg: loop.call_soon_threadsafe(self.send, msg)
+            self.reader, self.writer = await self.open_connection()
+            try:
+                await asyncio.wait_for(self._handshake(), timeout)
+            except asyncio.TimeoutError:
+                await self.disconnect()
+                raise GatewayError("Gateway not initialized correctly.")
+
+        return True
+
+    async def _handshake(self):
+        msg = Message()
+        while True:
+            data = self._capture_line(await self.reader.readline())
+            if not data:
+                raise GatewayError("Gateway not initialized correctly.")
+            try:
+                msg.decode(data)
+            except BadMessageError:
+                continue
+            if msg.node_id == 0 and msg.type == 3:
+                if msg.sub_type == 9:
+                    self.log_queue.put(msg.payload)
+                elif msg.sub_type == 14:
+                    break
+
+        if self._query_version:
+            self.send(Message("0;0;3;0;2;"))
+            await self.writer.drain()
+            data = self._capture_line(await self.reader.readline())
+            while not data.startswith(b"0;0;3;0;2;"):
+                if not data:
+                    raise GatewayError("Gateway not initialized correctly.")
+                self.msg_queue.put(data)
+                data = self._capture_line(await self.reader.readline())
+            msg.decode(data)
+            self._negotiate(msg.payload)
+
+    async def disconnect(self):
+        """ Closes the connection to the gateway. """
+        if self.writer is not None:
+            writer = self.writer
+            self.reader = self.writer = None
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except (ConnectionError, OSError):
+                pass
+        self._close_stores()
+
+    async def receive(self):
+        """ Reads a line from the gateway without blocking the event loop. """
+        data = await self._read_line()
+
+        return data.decode("utf-8")
+
+    async def _read_line(self):
+        data = self._capture_line(await self.reader.readline())
+        if not data:
+            raise GatewayError("Connection to the gateway was closed.")
+
+        return data
+
+    def send(self, message, ack=False):
+        """
+          Queues a Message to be written to the gateway.
+          Use drain() to wait for the transport buffer to be flushed.
+          With ack, returns a concurrent Future (see asyncio.wrap_future) completed by its echo.
+        """
+        future = self.acks.track(message) if ack else None
+        data = message.encode().encode("utf-8")
+        self.writer.write(data)
+        if self.metrics is not None:
+            self.metrics.written(len(data))
+
+        return future
+
+    async def drain(self):
+        """ Waits until the write buffer is flushed to the gateway. """
+        if self.writer is not None:
+            await self.writer.drain()
+
+    async def process(self):
+        """
+          Reads a message, handles it and calls message_callback.
+          Messages buffered while connecting are handled first. Bad messages are counted in
+          pipeline_stats.bad_messages and skipped.
+        """
+        if not self.msg_queue.empty():
+            data = self.msg_queue.get(block=False)
+        else:
+            data = await self._read_line()
+
+        if data.strip():
+            try:
+                msg, result = self._dispatch(data)
+            except BadMessageError:
+                self.pipeline_stats.increment('bad_messages')
+                return
+            if inspect.isawaitable(result):
+                result = await result
+
+            if self.message_callback and not (self.changes_only and result is False):
+                result = self.message_callback(msg)
+                if inspect.isawaitable(result):
+                    await result
+
+    async def run(self):
+        """ Processes messages until the connection is closed. """
+        while self.writer is not None:
+            await self.process()
+
+
+class AsyncSerialGateway(AsyncGateway):
+    """ MySensors Serial Gateway on asyncio (requires pyserial-asyncio). """
+
+    def __init__(self, port, baudrate=115200, message_callback=None, protocol_version=None, **kwargs):
+        self._port = port
+        self._baudrate = baudrate
+        super(AsyncSerialGateway, self).__init__(message_callback, protocol_version, **kwargs)
+
+    async def open_connection(self):
+        if serial_asyncio is None:
+            raise GatewayError("pyserial-asyncio is required to use AsyncSerialGateway.")
+
+        try:
+            return await serial_asyncio.open_serial_connection(url=self.port, baudrate=self.baudrate)
+        except OSError as err:
+            raise GatewayError("Gateway not connected or problem in Serial connection: {}".format(err))
+
+    @property
+    def baudrate(self):
+        return self._baudrate
+
+    @property
+    def port(self):
+        return self._port
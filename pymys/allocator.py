@@ -0,0 +1,125 @@
+"""
+pymys - Allocation of node IDs
+"""
+
+import json
+import time
+from threading import Lock
+
+
+class NodeIdAllocator(object):
+    """
+      Hands out free node IDs.
+      Free IDs are kept in a bitmap, so finding the lowest one does not scan the nodes. An ID handed out
+      in I_ID_RESPONSE stays reserved until the node presents itself (confirm) or the reservation expires,
+      so nodes booting at the same time never receive the same ID.
+    """
+
+    def __init__(self, reservation_timeout=300.0, first_id=1, last_id=254):
+        self.reservation_timeout = reservation_timeout
+        self.first_id = first_id
+        self.last_id = last_id
+        self._all = ((1 << (last_id + 1)) - 1) ^ ((1 << first_id) - 1)
+        self._free = self._all
+        self._reserved = {}
+        self.lock = Lock()
+
+    def allocate(self):
+        """
+          Reserves the lowest free ID.
+          :return: The reserved ID.
+        """
+        with self.lock:
+            now = time.time()
+            self._expire(now)
+            if not self._free:
+                raise NoFreeIdError("There is no free node ID.")
+
+            lowest = self._free & -self._free
+            self._free ^= lowest
+            node_id = lowest.bit_length() - 1
+            self._reserved[node_id] = now + self.reservation_timeout
+
+        return node_id
+
+    def confirm(self, node_id):
+        """ Marks an ID as used, ending its reservation. """
+        if not self.first_id <= node_id <= self.last_id:
+            return
+
+        with self.lock:
+            self._reserved.pop(node_id, None)
+            self._free &= ~(1 << node_id)
+
+    def release(self, node_id):
+        """ Makes an ID free again. """
+        if not self.first_id <= node_id <= self.last_id:
+            return
+
+        with self.lock:
+            self._reserved.pop(node_id, None)
+            self._free |= 1 << node_id
+
+    def sync(self, node_ids):
+        """ Marks exactly node_ids as used. Pending reservations of other IDs are kept. """
+        used = 0
+        for node_id in node_ids:
+            if self.first_id <= node_id <= self.last_id:
+                used |= 1 << node_id
+
+        with self.lock:
+            reserved = 0
+            for node_id in list(self._reserved):
+                if used >> node_id & 1:
+                    del self._reserved[node_id]
+                else:
+                    reserved |= 1 << node_id
+            self._free = self._all & ~used & ~reserved
+
+    def is_free(self, node_id):
+        return bool(self._free >> node_id & 1) if self.first_id <= node_id <= self.last_id else False
+
+    def is_reserved(self, node_id):
+        return node_id in self._reserved
+
+    def _expire(self, now):
+        # Reservations share the same timeout, so they expire in insertion order.
+        reserved = self._reserved
+        while reserved:
+            node_id = next(iter(reserved))
+            if reserved[node_id] > now:
+                break
+            del reserved[node_id]
+            self._free |= 1 << node_id
+
+    def to_dict(self):
+        """ Returns the used IDs and pending reservations as a JSON serializable dictionary. """
+        with self.lock:
+            free = self._free
+            reserved = dict(self._reserved)
+        used = [i for i in range(self.first_id, self.last_id + 1) if not free >> i & 1 and i not in reserved]
+
+        return {'used': used, 'reserved': {str(k): v for k, v in reserved.items()}}
+
+    def from_dict(self, data):
+        """ Restores the state saved by to_dict. """
+        self.sync(data.get('used', []))
+        with self.lock:
+            for node_id, expiration in sorted(data.get('reserved', {}).items(), key=lambda item: item[1]):
+                node_id = int(node_id)
+                if self._free >> node_id & 1:
+                    self._free ^= 1 << node_id
+                    self._reserved[node_id] = expiration
+
+    def save(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.to_dict(), f)
+
+    def load(self, path):
+        with open(path) as f:
+            self.from_dict(json.load(f))
+
+
+class NoFreeIdError(IndexError):
+    def __init__(self, *args, **kwargs):
+        super(NoFreeIdError, self).__init__(*args, **kwargs)
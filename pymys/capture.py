@@ -0,0 +1,468 @@
+"""
+pymys - Capture of the raw traffic of a gateway and its replay
+"""
+
+import bisect
+import mmap
+import os
+import struct
+import time
+import zlib
+from array import array
+from collections import OrderedDict
+from threading import Lock, Timer
+
+from pymys.mysensors import BadMessageError, Gateway, GatewayError, Message
+
+MAGIC = b"PYMYSCAP"
+FORMAT_VERSION = 1
+COMPRESS_NONE = 0
+COMPRESS_ZLIB = 1
+
+# Magic, format version, compression and reserved bytes.
+HEADER = struct.Struct("<8sBB6x")
+# Stored (possibly compressed) and raw sizes of a block.
+BLOCK_HEADER = struct.Struct("<II")
+# Timestamp and length of a line.
+RECORD_HEADER = struct.Struct("<dH")
+
+INDEX_MAGIC = b"PYMYSIDX"
+# Magic, format version, compression, number of records, size and modification time of the capture and
+# number of blocks.
+INDEX_HEADER = struct.Struct("<8sBB6xQQdQ")
+# Type of the malformed lines in an index.
+INVALID = 0xFF
+
+
+class CaptureWriter(object):
+    """
+      Appends timestamped raw lines to a binary capture file.
+      The file starts with HEADER and is made of blocks (BLOCK_HEADER and the block's data, zlib compressed
+      if compress is true) of records (RECORD_HEADER and the line). Records are packed in memory and a
+      block is only written when it reaches block_size bytes, or on flush, so writing a line makes no
+      system call. A timer also flushes a block flush_interval seconds after its first line.
+      Lines written after close are appended to the file, which is reopened.
+    """
+
+    def __init__(self, path, compress=False, block_size=65536, flush_interval=1.0):
+        self.path = path
+        self.compression = COMPRESS_ZLIB if compress else COMPRESS_NONE
+        self.block_size = block_size
+        self.flush_interval = flush_interval
+        self.lines = 0
+        self._block = bytearray()
+        self._flush_timer = None
+        self._file = open(path, 'wb')
+        self._file.write(HEADER.pack(MAGIC, FORMAT_VERSION, self.compression))
+        self.lock = Lock()
+
+    def write(self, line, timestamp=None):
+        """ Appends a raw line (bytes) read at timestamp. """
+        if timestamp is None:
+            timestamp = time.time()
+        line = line[:0xFFFF]
+
+        with self.lock:
+            block = self._block
+            block += RECORD_HEADER.pack(timestamp, len(line))
+            block += line
+            self.lines += 1
+            if len(block) >= self.block_size:
+                self._write_block()
+            elif self._flush_timer is None:
+                self._flush_timer = Timer(self.flush_interval, self.flush)
+                self._flush_timer.daemon = True
+                self._flush_timer.start()
+
+    def _write_block(self):
+        if not self._block:
+            return
+
+        if self._file is None:
+            self._file = open(self.path, 'ab')
+
+        data = bytes(self._block)
+        stored = zlib.compress(data) if self.compression == COMPRESS_ZLIB else data
+        self._file.write(BLOCK_HEADER.pack(len(stored), len(data)))
+        self._file.write(stored)
+        del self._block[:]
+
+    def flush(self):
+        """ Writes the pending block and flushes the file. """
+        with self.lock:
+            self._flush_timer = None
+            self._write_block()
+            if self._file is not None:
+                self._file.flush()
+
+    def close(self):
+        with self.lock:
+            if self._flush_timer is not None:
+                self._flush_timer.cancel()
+                self._flush_timer = None
+            self._write_block()
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def read_header(f):
+    """ Reads the header of a capture file and returns its compression. """
+    data = f.read(HEADER.size)
+    if len(data) < HEADER.size:
+        raise CaptureError("File is too short to be a capture.")
+    magic, version, compression = HEADER.unpack(data)
+    if magic != MAGIC:
+        raise CaptureError("File is not a capture.")
+    if version != FORMAT_VERSION:
+        raise CaptureError("Unsupported capture format version: {}".format(version))
+
+    return compression
+
+
+def iter_blocks(f, compression):
+    """
+      Yields (offset, data) of each block of a capture file positioned after its header, data uncompressed.
+      A block truncated by a crash ends the capture.
+    """
+    while True:
+        offset = f.tell()
+        header = f.read(BLOCK_HEADER.size)
+        if len(header) < BLOCK_HEADER.size:
+            return
+        stored_size, raw_size = BLOCK_HEADER.unpack(header)
+        data = f.read(stored_size)
+        if len(data) < stored_size:
+            return
+        yield offset, zlib.decompress(data) if compression == COMPRESS_ZLIB else data
+
+
+def iter_records(data):
+    """ Yields (position, timestamp, line) of each record of a block. """
+    position = 0
+    size = len(data)
+    unpack_from = RECORD_HEADER.unpack_from
+    header_size = RECORD_HEADER.size
+    while position + header_size <= size:
+        timestamp, length = unpack_from(data, position)
+        start = position + header_size
+        yield position, timestamp, bytes(data[start:start + length])
+        position = start + length
+
+
+def read_capture(path):
+    """ Returns a generator of the (timestamp, line) of a capture file. """
+    with open(path, 'rb') as f:
+        compression = read_header(f)
+        for _, data in iter_blocks(f, compression):
+            for _, timestamp, line in iter_records(data):
+                yield timestamp, line
+
+
+class ReplayGateway(Gateway):
+    """
+      Gateway reading the lines of a capture file.
+      With speed None lines are replayed as fast as possible, otherwise at speed times the captured pace
+      (1.0 is real time). Messages sent to the network are kept in sent.
+    """
+
+    def __init__(self, path, speed=None, message_callback=None, protocol_version=None, **kwargs):
+        self.path = path
+        self.speed = speed
+        self.sent = []
+        self.finished = False
+        self._records = None
+        self._first = None
+        self._started = None
+        super(ReplayGateway, self).__init__(message_callback, protocol_version, **kwargs)
+
+    def connect(self, timeout=10):
+        if self.protocol_version is None:
+            raise GatewayError("protocol_version must be given to replay a capture.")
+
+        self._records = read_capture(self.path)
+        self.finished = False
+        self._first = None
+        return True
+
+    def disconnect(self):
+        if self._records is not None:
+            self._records.close()
+            self._records = None
+        self._close_stores()
+
+    def receive(self):
+        return self._read_line().decode("utf-8")
+
+    def send(self, message, ack=False):
+        future = self.acks.track(message) if ack else None
+        self.sent.append(message.encode())
+
+        return future
+
+    def _read_line(self):
+        """ Returns the next line of the capture, b"" at its end. """
+        if self._records is None:
+            raise GatewayError("Gateway not connected.")
+
+        for timestamp, line in self._records:
+            if self.speed:
+                now = time.monotonic()
+                if self._first is None:
+                    self._first, self._started = timestamp, now
+                delay = self._started + (timestamp - self._first) / self.speed - now
+                if delay > 0:
+                    time.sleep(delay)
+            return line
+
+        self.finished = True
+        return b""
+
+    def replay(self):
+        """
+          Handles every line of the capture. Bad messages and the messages whose handler failed (e.g. values
+          of a node which presented itself before the capture started) are counted in pipeline_stats and skipped.
+          :return: Number of messages handled.
+        """
+        if self._records is None:
+            self.connect()
+
+        stats = self.pipeline_stats
+        handled = 0
+        while True:
+            try:
+                self.process()
+            except BadMessageError:
+                stats.increment('bad_messages')
+                continue
+            except Exception as err:
+                stats.increment('errors')
+                stats.last_error = err
+                continue
+            if self.finished:
+                break
+            handled += 1
+
+        return handled
+
+
+class MappedCapture(object):
+    """
+      Random access to a capture file through mmap.
+      Records are indexed once and the index is kept next to the capture (index_path, by default the
+      capture's path with ".idx"). It holds arrays of the records' timestamps, blocks and positions, and
+      of their node_id, type and sub_type, so records can be found by timestamp with a binary search and
+      filtered without reading their lines. The index file is itself mapped, and it is rebuilt when the
+      capture's size or modification time changed. Compressed blocks are decompressed when a record
+      of theirs is read, the last few of them are kept.
+    """
+
+    def __init__(self, path, index_path=None, rebuild=False, cached_blocks=8):
+        self.path = path
+        self.index_path = index_path if index_path is not None else path + ".idx"
+        self.cached_blocks = cached_blocks
+        self._blocks = OrderedDict()
+        self._file = open(path, 'rb')
+        try:
+            self.compression = read_header(self._file)
+            stat = os.fstat(self._file.fileno())
+            self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+            if rebuild or not self._load_index(stat):
+                self._build_index(stat)
+                if not self._load_index(stat):
+                    raise CaptureError("Index {} could not be loaded.".format(self.index_path))
+        except Exception:
+            self.close()
+            raise
+
+    def _build_index(self, stat):
+        block_offsets = array('Q')
+        timestamps = array('d')
+        blocks = array('I')
+        positions = array('I')
+        node_ids = bytearray()
+        types = bytearray()
+        sub_types = bytearray()
+
+        self._file.seek(HEADER.size)
+        for block, (offset, data) in enumerate(iter_blocks(self._file, self.compression)):
+            block_offsets.append(offset)
+            for position, timestamp, line in iter_records(data):
+                timestamps.append(timestamp)
+                blocks.append(block)
+                positions.append(position)
+                node_id, msg_type, sub_type = _parse_key(line)
+                node_ids.append(node_id)
+                types.append(msg_type)
+                sub_types.append(sub_type)
+
+        temp_path = self.index_path + ".tmp"
+        with open(temp_path, 'wb') as f:
+            f.write(INDEX_HEADER.pack(INDEX_MAGIC, FORMAT_VERSION, self.compression, len(timestamps), stat.st_size,
+                                      stat.st_mtime, len(block_offsets)))
+            for section in (block_offsets, timestamps, blocks, positions):
+                section.tofile(f)
+            for section in (node_ids, types, sub_types):
+                f.write(section)
+        os.replace(temp_path, self.index_path)
+
+    def _load_index(self, stat):
+        """ Maps the index, returns False if there is none or it does not match the capture. """
+        try:
+            f = open(self.index_path, 'rb')
+        except FileNotFoundError:
+            return False
+
+        with f:
+            header = f.read(INDEX_HEADER.size)
+            if len(header) < INDEX_HEADER.size:
+                return False
+            magic, version, compression, count, size, mtime, block_count = INDEX_HEADER.unpack(header)
+            if magic != INDEX_MAGIC or version != FORMAT_VERSION or size != stat.st_size or mtime != stat.st_mtime:
+                return False
+            if os.fstat(f.fileno()).st_size != INDEX_HEADER.size + 8 * block_count + 19 * count:
+                return False
+            index = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        self._index = index
+        self._count = count
+        view = memoryview(index)
+        position = INDEX_HEADER.size
+        sections = []
+        for fmt, length in (('Q', block_count), ('d', count), ('I', count), ('I', count)):
+            size = struct.calcsize(fmt) * length
+            sections.append(view[position:position + size].cast(fmt))
+            position += size
+        self._block_offsets, self.timestamps, self._record_blocks, self._positions = sections
+        # Offsets of the node_id, type and sub_type bytes in the index, searched with mmap.find.
+        self._keys = tuple(position + count * i for i in range(3))
+        self._view = view
+
+        return True
+
+    def __len__(self):
+        return self._count
+
+    def _block(self, block):
+        """ Returns the data of a block and the offset of its first byte in it. """
+        offset = self._block_offsets[block] + BLOCK_HEADER.size
+        if self.compression != COMPRESS_ZLIB:
+            return self._map, offset
+
+        data = self._blocks.get(block)
+        if data is None:
+            stored_size, _ = BLOCK_HEADER.unpack_from(self._map, offset - BLOCK_HEADER.size)
+            data = self._blocks[block] = zlib.decompress(self._map[offset:offset + stored_size])
+            if len(self._blocks) > self.cached_blocks:
+                self._blocks.popitem(last=False)
+        else:
+            self._blocks.move_to_end(block)
+
+        return data, 0
+
+    def line(self, i):
+        """ Returns the raw line of record i. """
+        if not 0 <= i < self._count:
+            raise IndexError("Record index out of range.")
+        data, offset = self._block(self._record_blocks[i])
+        position = offset + self._positions[i]
+        _, length = RECORD_HEADER.unpack_from(data, position)
+        start = position + RECORD_HEADER.size
+
+        return bytes(data[start:start + length])
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += self._count
+        return self.timestamps[i], self.line(i)
+
+    def node_id(self, i):
+        return self._index[self._keys[0] + i]
+
+    def type(self, i):
+        """ Returns the message type of record i, INVALID if its line is malformed. """
+        return self._index[self._keys[1] + i]
+
+    def sub_type(self, i):
+        return self._index[self._keys[2] + i]
+
+    def seek(self, timestamp):
+        """ Returns the index of the first record at or after timestamp. """
+        return bisect.bisect_left(self.timestamps, timestamp)
+
+    def select(self, node_id=None, type=None, sub_type=None, start=None, end=None):
+        """
+          Yields the indexes of the records matching node_id, type and sub_type (None matches anything)
+          taken between the start and end timestamps (end excluded), reading only the index.
+        """
+        first = self.seek(start) if start is not None else 0
+        last = self.seek(end) if end is not None else self._count
+        filters = [(self._keys[i], int(value)) for i, value in enumerate((node_id, type, sub_type))
+                   if value is not None]
+        index = self._index
+        if not filters:
+            for i in range(first, last):
+                if index[self._keys[1] + i] != INVALID:
+                    yield i
+            return
+
+        # The first filter is searched with mmap.find, which runs in C, and the others checked on its matches.
+        base, value = filters[0]
+        others = filters[1:]
+        types = self._keys[1]
+        needle = bytes((value,))
+        found = index.find(needle, base + first, base + last)
+        while found >= 0:
+            i = found - base
+            if index[types + i] != INVALID and all(index[b + i] == v for b, v in others):
+                yield i
+            found = index.find(needle, found + 1, base + last)
+
+    def messages(self, node_id=None, type=None, sub_type=None, start=None, end=None, const=None):
+        """ Yields the decoded messages of the selected records, only their lines are read and decoded. """
+        for i in self.select(node_id, type, sub_type, start, end):
+            try:
+                yield Message(self.line(i), const)
+            except BadMessageError:
+                continue
+
+    def close(self):
+        for name in ('_block_offsets', 'timestamps', '_record_blocks', '_positions', '_view'):
+            view = self.__dict__.pop(name, None)
+            if view is not None:
+                view.release()
+        for name in ('_index', '_map', '_file'):
+            resource = self.__dict__.pop(name, None)
+            if resource is not None:
+                resource.close()
+        self._blocks.clear()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def _parse_key(line):
+    """ Returns the node_id, type and sub_type of a raw line, with INVALID as type if it is malformed. """
+    fields = line.split(b";", 5)
+    try:
+        node_id, msg_type, sub_type = int(fields[0]), int(fields[2]), int(fields[4])
+    except (ValueError, IndexError):
+        return INVALID, INVALID, INVALID
+    if not (0 <= node_id < 256 and 0 <= msg_type < INVALID and 0 <= sub_type < 256):
+        return INVALID, INVALID, INVALID
+
+    return node_id, msg_type, sub_type
+
+
+class CaptureError(Exception):
+    def __init__(self, *args, **kwargs):
+        super(CaptureError, self).__init__(*args, **kwargs)
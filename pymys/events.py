@@ -0,0 +1,143 @@
+"""
+pymys - Subscriptions to the gateway's events
+"""
+
+from threading import Lock
+
+# Events published by Gateway
+MESSAGE = 'message'
+CHANGED = 'changed'
+OFFLINE = 'offline'
+ONLINE = 'online'
+
+
+class Subscription(object):
+    """ Callback subscribed to an event, optionally filtered by node_id, sensor_id, type and sub_type. """
+
+    __slots__ = ('event', 'callback', 'key', 'pattern', 'background')
+
+    def __init__(self, event, callback, key, background):
+        self.event = event
+        self.callback = callback
+        self.key = key
+        self.background = background
+        # Bitmask of the fields which are filtered.
+        self.pattern = sum(1 << i for i, value in enumerate(key) if value is not None)
+
+
+class EventBus(object):
+    """
+      Calls the subscribers of an event whose filters match it.
+      Subscriptions are indexed by (event, node_id, sensor_id, type, sub_type) with None for the fields
+      which are not filtered, so publishing does one dictionary lookup per combination of filtered fields
+      in use instead of testing every subscriber. The index is replaced as a whole when subscriptions
+      change, so publishing never locks.
+      Background subscribers run on a thread pool of workers threads, so they do not block the reader,
+      and may be called out of order. Exceptions raised by subscribers are counted and kept in last_error.
+    """
+
+    def __init__(self, workers=4):
+        self.workers = workers
+        self.subscriptions = ()
+        self.errors = 0
+        self.last_error = None
+        self._index = {}
+        self._patterns = {}
+        self._executor = None
+        self.lock = Lock()
+
+    def subscribe(self, callback, event=MESSAGE, node_id=None, sensor_id=None, type=None, sub_type=None,
+                  background=False):
+        """
+          Subscribes a callback to an event. None filters match anything.
+          :param callback: Called with the arguments of the event, e.g. the Message for MESSAGE.
+          :param background: Runs the callback on the thread pool.
+          :return: Subscription to pass to unsubscribe.
+        """
+        key = tuple(None if value is None else int(value) for value in (node_id, sensor_id, type, sub_type))
+        subscription = Subscription(event, callback, key, background)
+        with self.lock:
+            self._rebuild(self.subscriptions + (subscription,))
+
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self.lock:
+            self._rebuild(tuple(s for s in self.subscriptions if s is not subscription))
+
+    def _rebuild(self, subscriptions):
+        index = {}
+        patterns = {}
+        for subscription in subscriptions:
+            index.setdefault((subscription.event,) + subscription.key, []).append(subscription)
+            patterns.setdefault(subscription.event, set()).add(subscription.pattern)
+        self._index = index
+        self._patterns = {event: tuple(sorted(p)) for event, p in patterns.items()}
+        self.subscriptions = subscriptions
+
+    def has_subscribers(self, event):
+        return event in self._patterns
+
+    def publish(self, event, node_id=None, sensor_id=None, type=None, sub_type=None, args=()):
+        """
+          Calls the subscribers of an event matching its fields with args.
+          A field which is None only matches the subscribers which do not filter it.
+          :return: Number of subscribers called.
+        """
+        patterns = self._patterns.get(event)
+        if patterns is None:
+            return 0
+
+        index = self._index
+        fields = (node_id, sensor_id, type, sub_type)
+        present = 0
+        for i, value in enumerate(fields):
+            if value is not None:
+                present |= 1 << i
+        called = 0
+        for pattern in patterns:
+            if pattern & ~present:
+                continue
+            key = (event,) + tuple(value if pattern >> i & 1 else None for i, value in enumerate(fields))
+            for subscription in index.get(key, ()):
+                if subscription.background:
+                    self._submit(subscription.callback, args)
+                else:
+                    self._call(subscription.callback, args)
+                called += 1
+
+        return called
+
+    def publish_message(self, msg, event=MESSAGE, args=None):
+        """ Publishes an event about a message, its subscribers are called with the message and args. """
+        if event not in self._patterns:
+            return 0
+
+        return self.publish(event, msg.node_id, msg.sensor_id, int(msg.type), int(msg.sub_type),
+                            (msg,) + tuple(args or ()))
+
+    def _call(self, callback, args):
+        try:
+            callback(*args)
+        except Exception as err:
+            with self.lock:
+                self.errors += 1
+                self.last_error = err
+
+    def _submit(self, callback, args):
+        executor = self._executor
+        if executor is None:
+            with self.lock:
+                if self._executor is None:
+                    # Imported here as concurrent.futures is slow to import and rarely needed.
+                    from concurrent.futures import ThreadPoolExecutor
+                    self._executor = ThreadPoolExecutor(self.workers, thread_name_prefix="pymys-events")
+                executor = self._executor
+        executor.submit(self._call, callback, args)
+
+    def shutdown(self, wait=True):
+        """ Stops the thread pool, after the pending callbacks if wait is true. """
+        with self.lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait)
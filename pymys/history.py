@@ -0,0 +1,106 @@
+"""
+pymys - History of sensor values
+"""
+
+import time
+from array import array
+from threading import Lock
+
+
+class History(object):
+    """
+      Ring buffer of (timestamp, value) samples.
+      Samples are stored as doubles in two preallocated arrays, so numeric values are parsed once and
+      appending never allocates. Samples older than max_age seconds are discarded.
+    """
+
+    def __init__(self, size=1024, max_age=None):
+        self.size = size
+        self.max_age = max_age
+        self._times = array('d', bytes(8 * size))
+        self._values = array('d', bytes(8 * size))
+        self._start = 0
+        self._count = 0
+        self.lock = Lock()
+
+    def append(self, value, timestamp=None):
+        """ Adds a sample, overwriting the oldest one if the buffer is full. """
+        if timestamp is None:
+            timestamp = time.time()
+
+        with self.lock:
+            index = (self._start + self._count) % self.size
+            self._times[index] = timestamp
+            self._values[index] = value
+            if self._count < self.size:
+                self._count += 1
+            else:
+                self._start = (self._start + 1) % self.size
+            if self.max_age is not None:
+                self._discard(timestamp - self.max_age)
+
+    def _discard(self, oldest):
+        while self._count and self._times[self._start] < oldest:
+            self._start = (self._start + 1) % self.size
+            self._count -= 1
+
+    def _slice(self, first, last):
+        """ Returns the samples between the logical indexes first and last (exclusive), oldest first. """
+        size, start = self.size, self._start
+        return [(self._times[(start + i) % size], self._values[(start + i) % size]) for i in range(first, last)]
+
+    def _bisect(self, timestamp, after=False):
+        """ Returns the logical index of the first sample taken at (unless after is true) or after timestamp. """
+        low, high = 0, self._count
+        while low < high:
+            middle = (low + high) // 2
+            sample = self._times[(self._start + middle) % self.size]
+            if sample < timestamp or after and sample == timestamp:
+                low = middle + 1
+            else:
+                high = middle
+
+        return low
+
+    def last(self, n=1):
+        """ Returns the n most recent samples, oldest first. """
+        with self.lock:
+            return self._slice(max(self._count - n, 0), self._count)
+
+    def range(self, start=None, end=None):
+        """ Returns the samples taken between start and end (inclusive) timestamps, oldest first. """
+        with self.lock:
+            first = self._bisect(start) if start is not None else 0
+            last = self._bisect(end, after=True) if end is not None else self._count
+            return self._slice(first, last)
+
+    def window(self, seconds, now=None):
+        """ Returns the values of the samples taken in the last seconds. """
+        if now is None:
+            now = time.time()
+
+        return [value for _, value in self.range(now - seconds)]
+
+    def min(self, seconds=None, now=None):
+        values = self._window_values(seconds, now)
+        return min(values) if values else None
+
+    def max(self, seconds=None, now=None):
+        values = self._window_values(seconds, now)
+        return max(values) if values else None
+
+    def mean(self, seconds=None, now=None):
+        values = self._window_values(seconds, now)
+        return sum(values) / len(values) if values else None
+
+    def _window_values(self, seconds, now):
+        if seconds is None:
+            return [value for _, value in self.last(self._count)]
+
+        return self.window(seconds, now)
+
+    def __len__(self):
+        return self._count
+
+    def __iter__(self):
+        return iter(self.last(self._count))
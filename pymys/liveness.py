@@ -0,0 +1,125 @@
+"""
+pymys - Tracking of the nodes which stopped reporting
+"""
+
+import heapq
+import time
+from threading import Lock
+
+
+class LivenessMonitor(object):
+    """
+      Tells when a node has not been seen for longer than its timeout, and when it is seen again.
+      Deadlines are kept in a heap with a single entry per node. Seeing a node only records the time:
+      when its entry reaches the top of the heap, it is pushed back with the deadline of the last time the
+      node was seen, or the node is reported offline. So reports cost O(1) and only the expired entries
+      are looked at, instead of scanning every node. A single timer of a TimerWheel fires at the earliest
+      deadline.
+    """
+
+    def __init__(self, timers, notify, timeout=None):
+        """
+          :param timers: TimerWheel firing the checks.
+          :param notify: Called with (online, node_id) from the timers' thread when a node goes offline,
+                         and from the reader when an offline node is seen again.
+          :param timeout: Seconds without message after which a node is offline, None disables it for
+                          the nodes without a timeout of their own.
+        """
+        self.timers = timers
+        self.notify = notify
+        self.timeout = timeout
+        self.timeouts = {}
+        self.offline = set()
+        self._seen = {}
+        self._scheduled = {}
+        self._heap = []
+        self._timer = None
+        self._timer_due = None
+        self.lock = Lock()
+
+    def set_timeout(self, node_id, timeout):
+        """ Sets the timeout of a node, None uses the default timeout. """
+        with self.lock:
+            if timeout is None:
+                self.timeouts.pop(node_id, None)
+            else:
+                self.timeouts[node_id] = timeout
+            if node_id in self._seen and node_id not in self.offline:
+                self._push(node_id, time.monotonic())
+
+    def seen(self, node_id, now=None):
+        """ Records that a node sent a message. """
+        if now is None:
+            now = time.monotonic()
+
+        timeout = self.timeouts.get(node_id, self.timeout)
+        if timeout is None:
+            return
+
+        with self.lock:
+            self._seen[node_id] = now
+            if node_id in self._scheduled:
+                return
+            back = node_id in self.offline
+            self.offline.discard(node_id)
+            self._push(node_id, now)
+        if back:
+            self.notify(True, node_id)
+
+    def is_online(self, node_id):
+        return node_id not in self.offline
+
+    def _push(self, node_id, now):
+        """ Schedules the check of a node at the deadline of its last message. Lock must be held. """
+        timeout = self.timeouts.get(node_id, self.timeout)
+        if timeout is None:
+            self._scheduled.pop(node_id, None)
+            return
+
+        due = self._seen.get(node_id, now) + timeout
+        self._scheduled[node_id] = due
+        heapq.heappush(self._heap, (due, node_id))
+        if self._timer_due is None or due < self._timer_due:
+            self._arm(due, now)
+
+    def _arm(self, due, now):
+        if self._timer is not None:
+            self.timers.cancel(self._timer)
+        self._timer_due = due
+        self._timer = self.timers.schedule(max(due - now, 0.0), self.check)
+
+    def check(self, now=None):
+        """
+          Reports the nodes whose deadline passed. It is called by the timer.
+          :return: IDs of the nodes which went offline.
+        """
+        if now is None:
+            now = time.monotonic()
+
+        expired = []
+        with self.lock:
+            if self._timer is not None:
+                self.timers.cancel(self._timer)
+            self._timer = self._timer_due = None
+            heap = self._heap
+            while heap and heap[0][0] <= now:
+                due, node_id = heapq.heappop(heap)
+                if self._scheduled.get(node_id) != due:
+                    # Superseded by a later entry of the node (see set_timeout).
+                    continue
+                del self._scheduled[node_id]
+                timeout = self.timeouts.get(node_id, self.timeout)
+                if timeout is None:
+                    continue
+                if self._seen[node_id] + timeout <= now:
+                    self.offline.add(node_id)
+                    expired.append(node_id)
+                else:
+                    self._push(node_id, now)
+            if heap and (self._timer_due is None or heap[0][0] < self._timer_due):
+                self._arm(heap[0][0], now)
+
+        for node_id in expired:
+            self.notify(False, node_id)
+
+        return expired
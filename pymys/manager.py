@@ -0,0 +1,275 @@
+"""
+pymys - Several gateways run from a single thread
+"""
+
+import selectors
+import socket
+import time
+from collections.abc import Mapping
+from threading import Event, RLock, Thread
+
+from pymys.allocator import NodeIdAllocator
+from pymys.mysensors import GatewayError
+
+
+class GatewayManager(object):
+    """
+      Runs several connected gateways from one thread, waiting for all of them with a selector.
+      Gateways share a NodeIdAllocator, so the IDs handed to new nodes are unique across the networks
+      and nodes can be looked up and sent messages by ID alone. Nodes with fixed IDs must not use
+      the same ID on two networks.
+      A gateway whose connection is lost is unregistered and reconnected with the gateway's backoff
+      (reconnect_delay, max_reconnect_delay, max_reconnect_attempts). Each attempt connects from a thread of
+      its own, which wakes poll up when it is over, so the other gateways keep running during the connection
+      and its handshake. A gateway which runs out of attempts is removed. Errors raised by a gateway are
+      counted in errors and kept in last_error.
+    """
+
+    def __init__(self, gateways=(), message_callback=None, id_allocator=None):
+        """
+          :param message_callback: Default message_callback of the gateways which have none.
+          :param id_allocator: NodeIdAllocator shared by the gateways.
+        """
+        self.gateways = []
+        self.message_callback = message_callback
+        self.id_allocator = id_allocator if id_allocator is not None else NodeIdAllocator()
+        self.nodes = NodesView(self)
+        # select() is called on the current file descriptors every time, so a gateway which reconnects
+        # and gets the same descriptor number is not missed as it could be with epoll.
+        self._selector = selectors.SelectSelector()
+        self._fds = {}
+        self._routes = {}
+        # Due time (None while connecting), delay and attempts of the gateways to reconnect.
+        self._reconnects = {}
+        self._connected = []
+        # Connection threads write to this socket to wake poll up.
+        self._wakeup, self._wakeup_writer = socket.socketpair()
+        self._wakeup.setblocking(False)
+        self._selector.register(self._wakeup, selectors.EVENT_READ, None)
+        self.errors = 0
+        self.last_error = None
+        self._stopping = Event()
+        self._thread = None
+        self.lock = RLock()
+        for gateway in gateways:
+            self.add(gateway)
+
+    def add(self, gateway):
+        """
+          Adds a connected gateway and handles the messages it already received.
+          Its nodes must be loaded before, as its ID allocator is replaced by the shared one.
+        """
+        with self.lock:
+            self.gateways.append(gateway)
+            gateway.id_allocator = self.id_allocator
+            self.id_allocator.sync(list(self.nodes))
+            if gateway.message_callback is None:
+                gateway.message_callback = self.message_callback
+            self._register(gateway)
+        gateway.process_ready(read=False)
+
+        return gateway
+
+    def remove(self, gateway):
+        with self.lock:
+            self.gateways.remove(gateway)
+            self._reconnects.pop(gateway, None)
+            fd = self._fds.pop(gateway, None)
+            if fd is not None:
+                self._selector.unregister(fd)
+            self._routes = {k: v for k, v in self._routes.items() if v is not gateway}
+
+    def _register(self, gateway):
+        """ Registers the current file descriptor of a gateway, it changes when the gateway reconnects. """
+        fd = gateway.fileno()
+        previous = self._fds.get(gateway)
+        if previous == fd:
+            return
+        if previous is not None:
+            self._selector.unregister(previous)
+            del self._fds[gateway]
+        if fd >= 0:
+            self._selector.register(fd, selectors.EVENT_READ, gateway)
+            self._fds[gateway] = fd
+
+    def poll(self, timeout=None):
+        """
+          Waits until a gateway is readable and handles its messages.
+          :param timeout: Maximum number of seconds to wait, None waits forever.
+          :return: Number of messages handled.
+        """
+        self._reconnect_due()
+        with self.lock:
+            dues = [retry[0] for retry in self._reconnects.values() if retry[0] is not None]
+        if dues:
+            wait = max(min(dues) - time.monotonic(), 0.0)
+            timeout = wait if timeout is None else min(timeout, wait)
+
+        handled = 0
+        for key, _ in self._selector.select(timeout):
+            gateway = key.data
+            if gateway is None:
+                handled += self._finish_reconnects()
+                continue
+            try:
+                handled += gateway.process_ready(reconnect=False)
+            except Exception as err:
+                self._error(err)
+            with self.lock:
+                if gateway in self._fds:
+                    self._register(gateway)
+                    if gateway not in self._fds:
+                        self._schedule_reconnect(gateway)
+
+        return handled
+
+    def _error(self, err):
+        with self.lock:
+            self.errors += 1
+            self.last_error = err
+
+    def _schedule_reconnect(self, gateway, delay=None, attempts=0):
+        """ Schedules a connection attempt of a gateway which lost its connection. Lock must be held. """
+        if delay is None:
+            delay = getattr(gateway, 'reconnect_delay', 1.0)
+        self._reconnects[gateway] = (time.monotonic() + delay, delay, attempts)
+
+    def _reconnect_due(self):
+        """ Starts a connection attempt of each gateway whose delay passed. """
+        now = time.monotonic()
+        with self.lock:
+            for gateway, (due, delay, attempts) in list(self._reconnects.items()):
+                if due is not None and due <= now:
+                    self._reconnects[gateway] = (None, delay, attempts)
+                    Thread(target=self._connect, args=(gateway,), name="pymys-reconnect", daemon=True).start()
+
+    def _connect(self, gateway):
+        try:
+            gateway.connect()
+            error = None
+        except Exception as err:
+            error = err
+        with self.lock:
+            removed = gateway not in self._reconnects
+            if not removed:
+                self._connected.append((gateway, error))
+        if removed:
+            # Removed while connecting, e.g. by disconnect.
+            if error is None:
+                gateway.disconnect()
+            return
+        self._wakeup_writer.send(b"\0")
+
+    def _finish_reconnects(self):
+        """
+          Registers the gateways which reconnected, and schedules another attempt for the others.
+          :return: Number of messages handled by the gateways which reconnected.
+        """
+        try:
+            self._wakeup.recv(4096)
+        except BlockingIOError:
+            pass
+        with self.lock:
+            connected, self._connected = self._connected, []
+
+        handled = 0
+        for gateway, error in connected:
+            with self.lock:
+                retry = self._reconnects.get(gateway)
+                if retry is None:
+                    continue
+                _, delay, attempts = retry
+                if error is None:
+                    del self._reconnects[gateway]
+                    self._register(gateway)
+            if error is None:
+                try:
+                    handled += gateway.process_ready(read=False, reconnect=False)
+                except Exception as err:
+                    self._error(err)
+                continue
+
+            self._error(error)
+            attempts += 1
+            max_attempts = getattr(gateway, 'max_reconnect_attempts', None)
+            if max_attempts is not None and attempts >= max_attempts:
+                self.remove(gateway)
+                continue
+            with self.lock:
+                delay = min(delay * 2, getattr(gateway, 'max_reconnect_delay', 60.0))
+                self._schedule_reconnect(gateway, delay, attempts)
+
+        return handled
+
+    def run(self, timeout=1.0):
+        """ Polls the gateways until stop is called. """
+        self._stopping.clear()
+        while not self._stopping.is_set():
+            self.poll(timeout)
+
+    def start(self, timeout=1.0):
+        """ Runs the gateways from a thread. """
+        if self._thread is not None:
+            raise GatewayError("Manager already started.")
+
+        self._stopping.clear()
+        self._thread = Thread(target=self.run, args=(timeout,), name="pymys-manager", daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout=None):
+        """ Stops the thread, it only notices it after its current poll, so it may take up to its timeout. """
+        self._stopping.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+
+    def route(self, node_id):
+        """ Returns the gateway of the network of a node. """
+        gateway = self._routes.get(node_id)
+        if gateway is not None and node_id in gateway.nodes:
+            return gateway
+
+        for gateway in self.gateways:
+            if node_id in gateway.nodes:
+                self._routes[node_id] = gateway
+                return gateway
+
+        raise GatewayError("Node {} is not known by any gateway.".format(node_id))
+
+    def send(self, msg, ack=False):
+        """ Sends a message through the gateway of its node. """
+        return self.route(msg.node_id).send(msg, ack)
+
+    def disconnect(self):
+        """ Stops the thread and disconnects every gateway. """
+        self.stop()
+        for gateway in list(self.gateways):
+            self.remove(gateway)
+            gateway.disconnect()
+
+    def __getitem__(self, item):
+        return self.nodes[int(item)]
+
+
+class NodesView(Mapping):
+    """ Read-only mapping of the nodes of every gateway of a manager by ID. """
+
+    def __init__(self, manager):
+        self._manager = manager
+
+    def __getitem__(self, node_id):
+        try:
+            return self._manager.route(node_id).nodes[node_id]
+        except GatewayError:
+            raise KeyError(node_id)
+
+    def __iter__(self):
+        seen = set()
+        for gateway in list(self._manager.gateways):
+            for node_id in gateway.nodes:
+                if node_id not in seen:
+                    seen.add(node_id)
+                    yield node_id
+
+    def __len__(self):
+        return len(set().union(*(gateway.nodes for gateway in list(self._manager.gateways))))
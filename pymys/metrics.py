@@ -0,0 +1,179 @@
+"""
+pymys - Metrics of the gateway loop
+"""
+
+import math
+import time
+from array import array
+from bisect import bisect_left
+from threading import Lock
+
+MAX_TYPES = 8
+MAX_SUB_TYPES = 64
+MAX_NODES = 256
+
+# Upper bounds (seconds) of the handler latency buckets.
+LATENCY_BUCKETS = (0.00001, 0.00005, 0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0)
+
+
+class Histogram(object):
+    """ Histogram with fixed buckets, as a Prometheus histogram. """
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = array('Q', bytes(8 * (len(self.buckets) + 1)))
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative(self):
+        """ Returns (upper bound, count of values lower or equal) pairs, the last bound is inf. """
+        total = 0
+        result = []
+        for bound, count in zip(self.buckets + (float('inf'),), self.counts):
+            total += count
+            result.append((bound, total))
+
+        return result
+
+
+class GatewayMetrics(object):
+    """
+      Counters of the messages handled by a gateway.
+      Every counter lives in an array allocated up front and indexed by type, sub_type or node ID, so
+      counting a message does not allocate. Node rates are exponentially weighted moving averages
+      of messages per second over rate_period seconds.
+    """
+
+    def __init__(self, rate_period=60.0):
+        self.rate_period = rate_period
+        self.messages = array('Q', bytes(8 * MAX_TYPES * MAX_SUB_TYPES))
+        self.node_messages = array('Q', bytes(8 * MAX_NODES))
+        self.node_last_seen = array('d', bytes(8 * MAX_NODES))
+        self._node_rates = array('d', bytes(8 * MAX_NODES))
+        self.handler_latency = Histogram()
+        self.bad_messages = 0
+        self.bytes_read = 0
+        self.bytes_written = 0
+        self.lock = Lock()
+
+    def message(self, msg, size, latency, now=None):
+        """
+          Counts a handled message.
+          :param size: Length of the raw message in bytes.
+          :param latency: Seconds taken by its handler.
+        """
+        if now is None:
+            now = time.time()
+
+        node_id = msg.node_id
+        with self.lock:
+            self.bytes_read += size
+            sub_type = int(msg.sub_type)
+            if sub_type < MAX_SUB_TYPES:
+                self.messages[int(msg.type) * MAX_SUB_TYPES + sub_type] += 1
+            if 0 <= node_id < MAX_NODES:
+                self.node_messages[node_id] += 1
+                last_seen = self.node_last_seen[node_id]
+                decay = math.exp((last_seen - now) / self.rate_period) if last_seen else 0.0
+                self._node_rates[node_id] = self._node_rates[node_id] * decay + 1.0 / self.rate_period
+                self.node_last_seen[node_id] = now
+            self.handler_latency.observe(latency)
+
+    def bad_message(self, size):
+        with self.lock:
+            self.bytes_read += size
+            self.bad_messages += 1
+
+    def written(self, size):
+        with self.lock:
+            self.bytes_written += size
+
+    def count(self, msg_type, sub_type):
+        return self.messages[int(msg_type) * MAX_SUB_TYPES + int(sub_type)]
+
+    def node_rate(self, node_id, now=None):
+        """ Returns the messages per second recently sent by a node. """
+        last_seen = self.node_last_seen[node_id]
+        if not last_seen:
+            return 0.0
+        if now is None:
+            now = time.time()
+
+        return self._node_rates[node_id] * math.exp(min(last_seen - now, 0.0) / self.rate_period)
+
+    def top_nodes(self, n=10, now=None):
+        """ Returns the (node_id, rate) of the n nodes sending the most messages per second. """
+        if now is None:
+            now = time.time()
+        rates = [(node_id, self.node_rate(node_id, now)) for node_id in range(MAX_NODES)
+                 if self.node_last_seen[node_id]]
+
+        return sorted(rates, key=lambda item: item[1], reverse=True)[:n]
+
+    def to_prometheus(self, const=None, queues=None, now=None):
+        """
+          Returns a snapshot of the metrics in the Prometheus text format.
+          :param const: Protocol module used to name types and sub_types, otherwise they are numbers.
+          :param queues: Dictionary of queues whose depth is exported, by name.
+        """
+        if now is None:
+            now = time.time()
+
+        lines = ["# TYPE pymys_messages_total counter"]
+        for index, count in enumerate(self.messages):
+            if count:
+                msg_type, sub_type = divmod(index, MAX_SUB_TYPES)
+                lines.append('pymys_messages_total{{type="{}",sub_type="{}"}} {}'.format(
+                    *_names(const, msg_type, sub_type) + (count,)))
+
+        lines.append("# TYPE pymys_bad_messages_total counter")
+        lines.append("pymys_bad_messages_total {}".format(self.bad_messages))
+        lines.append("# TYPE pymys_read_bytes_total counter")
+        lines.append("pymys_read_bytes_total {}".format(self.bytes_read))
+        lines.append("# TYPE pymys_written_bytes_total counter")
+        lines.append("pymys_written_bytes_total {}".format(self.bytes_written))
+
+        lines.append("# TYPE pymys_handler_seconds histogram")
+        for bound, count in self.handler_latency.cumulative():
+            le = "+Inf" if math.isinf(bound) else repr(bound)
+            lines.append('pymys_handler_seconds_bucket{{le="{}"}} {}'.format(le, count))
+        lines.append("pymys_handler_seconds_sum {}".format(self.handler_latency.sum))
+        lines.append("pymys_handler_seconds_count {}".format(self.handler_latency.count))
+
+        seen = [node_id for node_id in range(MAX_NODES) if self.node_last_seen[node_id]]
+        lines.append("# TYPE pymys_node_messages_total counter")
+        for node_id in seen:
+            lines.append('pymys_node_messages_total{{node="{}"}} {}'.format(node_id, self.node_messages[node_id]))
+        lines.append("# TYPE pymys_node_messages_rate gauge")
+        for node_id in seen:
+            lines.append('pymys_node_messages_rate{{node="{}"}} {}'.format(node_id, self.node_rate(node_id, now)))
+        lines.append("# TYPE pymys_node_last_seen_seconds gauge")
+        for node_id in seen:
+            lines.append('pymys_node_last_seen_seconds{{node="{}"}} {}'.format(node_id, self.node_last_seen[node_id]))
+
+        if queues:
+            lines.append("# TYPE pymys_queue_depth gauge")
+            for name, q in sorted(queues.items()):
+                lines.append('pymys_queue_depth{{queue="{}"}} {}'.format(name, q.qsize()))
+
+        return "\n".join(lines) + "\n"
+
+
+def _names(const, msg_type, sub_type):
+    if const is None:
+        return msg_type, sub_type
+
+    try:
+        type_member = const.message_types[msg_type]
+        sub_type_member = const.sub_types[msg_type][sub_type]
+    except IndexError:
+        return msg_type, sub_type
+    if type_member is None or sub_type_member is None:
+        return msg_type, sub_type
+
+    return type_member.name, sub_type_member.name
@@ -4,6 +4,8 @@ MySensors Constants - Protocol Version 1.6
 
 from enum import IntEnum
 
+from pymys import utils
+
 
 class MessageType(IntEnum):
     """ MySensors message types """
@@ -153,4 +155,8 @@ subtypes = {MessageType.C_PRESENTATION: Presentation,
             MessageType.C_SET: SetReq,
             MessageType.C_REQ: SetReq,
             MessageType.C_INTERNAL: Internal,
-            MessageType.C_STREAM: Stream}
\ No newline at end of file
+            MessageType.C_STREAM: Stream}
+
+# Lookup tables indexed by the raw ints of a message, used to decode without building enums.
+message_types = utils.enum_table(MessageType)
+sub_types = tuple(utils.enum_table(subtypes[msg_type]) for msg_type in message_types)
@@ -2,34 +2,107 @@
 pymys - Python implementation of the MySensors Gateways and its helpers objects
 """
 
+import importlib
+import queue
+import socket
 import time
 import serial
-from threading import RLock
+from array import array
+from collections import OrderedDict
+from threading import Event, Lock, RLock, Thread
 
-from pymys import mys_15
-from pymys import mys_16
+from pymys import payload
+from pymys import protocol
 from pymys import utils
+from pymys.ack import AckTracker, AckTimeoutError
+from pymys.allocator import NodeIdAllocator, NoFreeIdError
+from pymys.events import CHANGED, MESSAGE, OFFLINE, ONLINE, EventBus
+from pymys.history import History
+from pymys.liveness import LivenessMonitor
+from pymys.ota import FirmwareManager
+from pymys.protocol import UnsupportedProtocolError
+from pymys.writer import BatchWriter, RateLimiter
+
+
+def __getattr__(name):
+    # The protocol modules are imported when a gateway first uses them, see protocol.load.
+    if name.startswith('mys_') and 'pymys.' + name in protocol.MODULES.values():
+        return importlib.import_module('pymys.' + name)
+    raise AttributeError("module '{}' has no attribute '{}'".format(__name__, name))
+
+
+# Internal messages telling that a sleeping node is awake and listening
+WAKE_UP_MESSAGES = ('I_HEARTBEAT', 'I_HEARTBEAT_RESPONSE', 'I_PRE_SLEEP_NOTIFICATION')
+
+# Backpressure policies of the reader/dispatcher pipeline
+BLOCK = 'block'
+DROP_OLDEST = 'drop_oldest'
+DROP_NEWEST = 'drop_newest'
 
 
 class Gateway(object):
     """ Base implementation for a MySensors Gateway. """
 
-    def __init__(self, message_callback=None, protocol_version=None):
+    def __init__(self, message_callback=None, protocol_version=None, **kwargs):
         self.message_callback = message_callback
-        self.nodes = utils.DictThreadSafe()
+        self.id_allocator = NodeIdAllocator(kwargs.get('id_reservation_timeout', 300.0))
+        self.nodes = utils.CopyOnWriteDict()
         self._protocol_version = protocol_version
-        if self._protocol_version == 1.5:
-            self._const = mys_15
-        elif self._protocol_version == 1.6:
-            self._const = mys_16
+        self._const = None
+        # The version is queried on connect unless it was given, a restored one is only a starting point.
+        self._query_version = protocol_version is None
 
         self._config = 'M'
 
         self.msg_queue = utils.IndexableQueue()
         self.log_queue = utils.IndexableQueue()
-        self.callbacks = {}
+        self.callbacks = []
         self.lock = RLock()
 
+        self.pipeline_stats = PipelineStats()
+        self._policy = BLOCK
+        self._threads = []
+        self._stopping = Event()
+
+        self.typed_values = kwargs.get('typed_values', True)
+        self.metrics = kwargs.get('metrics')
+        self.capture = kwargs.get('capture')
+        self.events = EventBus(kwargs.get('event_workers', 4))
+        self.changes_only = kwargs.get('changes_only', False)
+        self.deadbands = dict(kwargs.get('deadbands', {}))
+        self._deadbands = {}
+        self._table = None
+        self._wake_up_types = frozenset()
+        self._outbox = {}
+        self._outbox_lock = Lock()
+        self.ota = FirmwareManager()
+        self.timers = utils.TimerWheel()
+        self.acks = AckTracker(self.send, self.timers, kwargs.get('ack_timeout', 1.0),
+                               kwargs.get('ack_retries', 3), kwargs.get('ack_backoff', 2.0))
+        self.liveness = LivenessMonitor(self.timers, self._liveness_changed, kwargs.get('node_timeout'))
+        self.history_size = kwargs.get('history_size')
+        self.history_max_age = kwargs.get('history_max_age')
+
+        self.persistence = kwargs.get('persistence')
+        self._persist_lock = Lock()
+
+        if self._protocol_version is not None:
+            self.protocol_version = self._protocol_version
+
+        if self.persistence is not None:
+            self.load_state()
+
+    @property
+    def nodes(self):
+        return self._nodes
+
+    @nodes.setter
+    def nodes(self, value):
+        if not isinstance(value, utils.CopyOnWriteDict):
+            value = utils.CopyOnWriteDict(value)
+        self._nodes = value
+        self.id_allocator.sync(value.keys())
+
     @property
     def config(self):
         with self.lock:
@@ -54,17 +127,48 @@ class Gateway(object):
     @const.setter
     def const(self, value):
         with self.lock:
-            if value == 1.5:
-                self._const = mys_15
-            elif value == 1.6:
-                self._const = mys_16
+            self._const = protocol.load(value)
+
+            # The tables are shared by the gateways of a protocol version, the callbacks are bound to this one.
+            table = protocol.dispatch_table(self._const)
+            self.callbacks = [getattr(self, name) if name is not None else None for name in table.handlers]
+            self._table = table
+            self._build_deadbands()
+            self._wake_up_types = frozenset(getattr(self._const.Internal, name) for name in WAKE_UP_MESSAGES
+                                            if hasattr(self._const.Internal, name))
+
+    def set_node_timeout(self, node_id, timeout):
+        """
+          Sets the seconds a node may stay silent before it is reported offline, e.g. a bit more than
+          its reporting interval. None uses node_timeout.
+        """
+        self.liveness.set_timeout(int(node_id), timeout)
+
+    def _liveness_changed(self, online, node_id):
+        node = self._nodes.get(node_id)
+        if node is not None:
+            self.events.publish(ONLINE if online else OFFLINE, node_id, args=(node,))
+
+    def set_deadband(self, value_type, deadband):
+        """
+          Sets the smallest change of a numeric value type which is reported as a change.
+          :param value_type: SetReq member or name, e.g. 'V_TEMP'.
+          :param deadband: Absolute difference with the value of the last change, None removes it.
+        """
+        name = getattr(value_type, 'name', value_type)
+        with self.lock:
+            if deadband is None:
+                self.deadbands.pop(name, None)
             else:
-                # TODO Raise an exception
-                pass
+                self.deadbands[name] = deadband
+            self._build_deadbands()
 
-            for msg_type in self._const.MessageType:
-                method_name = msg_type.name.split("_")[1].lower()
-                self.callbacks[msg_type] = getattr(self, method_name)
+    def _build_deadbands(self):
+        # Deadbands are configured by name and looked up by the protocol's SetReq values.
+        if self._const is not None:
+            set_req = self._const.SetReq
+            self._deadbands = {int(set_req[name]): deadband for name, deadband in self.deadbands.items()
+                               if name in set_req.__members__}
 
     @property
     def protocol_version(self):
@@ -76,7 +180,7 @@ class Gateway(object):
     @protocol_version.setter
     def protocol_version(self, value):
         with self.lock:
-            value = float(value[:3])
+            value = protocol.parse_version(value)
             self.const = value
             self._protocol_version = value
 
@@ -86,17 +190,129 @@ class Gateway(object):
     def disconnect(self):
         pass
 
-    def send(self, msg):
+    def _close_stores(self):
+        """
+          Writes out and closes the persistence store and the capture, they reopen when something is
+          written to them again.
+        """
+        if self.persistence is not None:
+            self.persistence.close()
+        if self.capture is not None:
+            self.capture.close()
+
+    def send(self, msg, ack=False):
         """
           Sends a message to Gateway.
           Must be implemented on a specialized class.
           :param msg: Message to gateway.
+          :param ack: If true, the message requests an ack and is retransmitted until it is echoed.
+          :return: If ack is true, a Future completed with the echo (see AckTracker), otherwise None.
         """
         pass
 
     def receive(self):
         pass
 
+    def _read_line(self):
+        """
+          Reads a raw line from the interface.
+          Specialized classes should override it to return bytes without decoding them.
+          :return: Line as bytes, empty if nothing was read before the timeout.
+        """
+        data = self.receive()
+        if not data:
+            return b""
+
+        return data.encode("utf-8")
+
+    def _capture_line(self, data):
+        """ Records a raw line read from the interface in the capture, if any, when it is read. """
+        if data and self.capture is not None:
+            self.capture.write(data)
+
+        return data
+
+    def _write(self, data):
+        """
+          Writes raw bytes to the interface.
+          Must be implemented on a specialized class.
+        """
+        raise NotImplementedError
+
+    def fileno(self):
+        """
+          Returns the file descriptor of the interface, to wait for it with select.
+          Must be implemented on a specialized class.
+        """
+        raise NotImplementedError
+
+    def _read_available(self, read=True, reconnect=True):
+        """
+          Returns the complete raw lines already buffered and, if read is true, reads once from the interface
+          without blocking (it must be readable) and adds the lines completed by what was read.
+          Must be implemented on a specialized class.
+          :param reconnect: If false, a lost connection raises GatewayError instead of being reconnected.
+        """
+        raise NotImplementedError
+
+    def _handshake(self, timeout):
+        """
+          Waits for I_GATEWAY_READY and, unless protocol_version was given, queries I_VERSION.
+          Messages received while waiting for the version are kept in msg_queue.
+          :param timeout: Maximum number of lines to read while waiting for the gateway.
+        """
+        connected = False
+        msg = Message()
+        for i in range(timeout+1):
+            data = self._capture_line(self._read_line())
+
+            if not data or i == timeout:
+                raise GatewayError("Gateway not initialized correctly.")
+            try:
+                msg.decode(data)
+            except BadMessageError:
+                # FIXME This was put here because a bug on pyserial that couldn't flush the buffer
+                continue
+            if msg.node_id == 0 and msg.type == 3:
+                if msg.sub_type == 9:
+                    self.log_queue.put(msg.payload)
+                elif msg.sub_type == 14:
+                    connected = True
+                    break
+
+        if not connected:
+            raise GatewayError("Gateway not initialized correctly.")
+
+        if self._query_version:
+            msg = Message("0;0;3;0;2;")
+            self._write(msg.encode().encode("utf-8"))
+            data = self._capture_line(self._read_line())
+            while not data.startswith(b"0;0;3;0;2;"):
+                if not data:
+                    raise GatewayError("Gateway did not answer its protocol version.")
+                self.msg_queue.put(data)
+                data = self._capture_line(self._read_line())
+            msg.decode(data)
+
+            if msg.node_id == 0 and msg.type == 3 and msg.sub_type == 2:
+                self._negotiate(msg.payload)
+
+    def _negotiate(self, version):
+        """
+          Uses the protocol module of the version reported by the gateway. Nodes known under another
+          module, e.g. restored from the persistence store, are converted to the new one.
+        """
+        const = self._const
+        try:
+            self.protocol_version = version
+        except UnsupportedProtocolError as err:
+            raise GatewayError("Gateway protocol version {} is not supported.".format(version)) from err
+
+        if const is not None and self._const is not const:
+            self.nodes = utils.CopyOnWriteDict(
+                (node_id, Node.from_dict(node.snapshot(), self._const, self.typed_values))
+                for node_id, node in self.nodes.items())
+
     def presentation(self, msg):
         """
           Processes a presentation message.
@@ -104,58 +320,166 @@ class Gateway(object):
         """
         # FIXME If a node with a repeated ID was presented, it will be "merged" to the old node.
 
-        self.const.Presentation(msg.sub_type)
-
-        if msg.node_id not in self.nodes:
-            self.nodes[msg.node_id] = Node(msg.node_id)
+        node = self._get_node(msg.node_id)
+        sensor = node.sensors.get(msg.sensor_id)
+        if sensor is None:
+            node.sensors.setdefault(msg.sensor_id, Sensor(msg.sensor_id, msg.sub_type))
+        elif sensor.type != msg.sub_type:
+            sensor.type = msg.sub_type
+        else:
+            return
 
-        self.nodes[msg.node_id][msg.sensor_id] = self.const.Presentation(msg.sub_type)
+        if self.persistence is not None:
+            self._persist('sensor', msg.node_id, msg.sensor_id, int(msg.sub_type))
 
     def set(self, msg):
         """
           Processes a set and a request message.
+          Publishes CHANGED, with the message and the previous value, if the value changed by more than
+          the deadband of its type.
           :param msg: Message from gateway.
+          :return: False if the value did not change.
         """
-        self.const.SetReq(msg.sub_type)
-
-        self.nodes[msg.node_id].set_sensor_value(msg.sensor_id, self.const.SetReq(msg.sub_type), msg.payload)
+        node = self.nodes[msg.node_id]
+        sensor = node.sensors.get(msg.sensor_id)
+        if sensor is None:
+            return False
+
+        value = msg.payload
+        if self.typed_values:
+            # Converters come from the dispatch table shared by the gateways of this protocol version.
+            codec = self._table.codecs[msg.sub_type]
+            if codec is not None and value:
+                try:
+                    value = codec(value)
+                except ValueError:
+                    pass
+        same_payload = sensor.raw_values.get(msg.sub_type) == msg.payload
+        changed, previous = sensor.update_value(msg.sub_type, value, msg.payload, self._deadbands.get(msg.sub_type))
+
+        if self.history_size:
+            sensor.add_sample(msg.sub_type, value, self.history_size, self.history_max_age)
+
+        if self.persistence is not None and not same_payload:
+            self._persist('value', msg.node_id, msg.sensor_id, int(msg.sub_type), msg.payload)
+
+        if changed:
+            self.events.publish_message(msg, CHANGED, (previous,))
+        return changed
 
     def req(self, msg):
-        self.const.SetReq(msg.sub_type)
+        pass
 
     def stream(self, msg):
-        # TODO Implement
-        self.const.Stream(msg.sub_type)
-
-    def internal(self, msg):
         """
-          Processes an internal message.
+          Processes a stream message. Firmware requests are answered by ota.
           :param msg: Message from gateway.
         """
+        response = self.ota.handle(msg, self._const.Stream)
+        if response is not None:
+            self.send(response)
 
-        self.const.Internal(msg.sub_type)
+    def update_firmware(self, node_ids, fw_type, fw_version, path=None, reboot=True):
+        """
+          Schedules a firmware update of some nodes.
+          :param node_ids: IDs of the nodes to be updated.
+          :param path: Intel HEX file of the firmware. It is loaded once and kept in ota's cache.
+          :param reboot: If true, an I_REBOOT is sent to each node so it requests the firmware.
+        """
+        if path is not None:
+            self.ota.load(fw_type, fw_version, path)
 
-        if msg.node_id not in self.nodes:
-            self.nodes[msg.node_id] = Node(msg.node_id)
+        for node_id in node_ids:
+            self.ota.schedule(node_id, fw_type, fw_version)
+            if reboot:
+                msg = Message()
+                msg.node_id = node_id
+                msg.sensor_id = 255
+                msg.type = self._const.MessageType.C_INTERNAL
+                msg.sub_type = self._const.Internal.I_REBOOT
+                self.send(msg)
 
-        if msg.sub_type == self.const.Internal.I_ID_REQUEST and msg.node_id == 255:
-            free_id = self.get_free_id()
-            response = msg.copy(**{'sub_type': self.const.Internal.I_ID_RESPONSE, 'payload': free_id})
-            self.send(response)
-        elif msg.sub_type == self.const.Internal.I_LOG_MESSAGE:
+    def internal(self, msg):
+        """
+          Processes an internal message.
+          Raises BadMessageError if the payload of a numeric sub-type is not a number.
+          :param msg: Message from gateway.
+        """
+        internal = self._const.Internal
+        if msg.node_id == 255:
+            # 255 is the ID of nodes which have none yet, it is not registered as a node.
+            if msg.sub_type == internal.I_ID_REQUEST:
+                free_id = self.get_free_id()
+                response = msg.copy(**{'sub_type': internal.I_ID_RESPONSE, 'payload': free_id})
+                self.send(response)
+            return
+
+        node = self._get_node(msg.node_id)
+        if msg.sub_type == internal.I_LOG_MESSAGE:
             self.log_queue.put(msg)
-        elif msg.sub_type == self.const.Internal.I_BATTERY_LEVEL:
-            self.nodes[msg.node_id].battery_level = int(msg.payload)
-        elif msg.sub_type == self.const.Internal.I_SKETCH_NAME:
-            self.nodes[msg.node_id].sketch_name = msg.payload
-        elif msg.sub_type == self.const.Internal.I_SKETCH_VERSION:
-            self.nodes[msg.node_id].sketch_version = float(msg.payload)
-        elif msg.sub_type == self.const.Internal.I_TIME:
+        elif msg.sub_type == internal.I_BATTERY_LEVEL:
+            node.battery_level = _number(msg, int)
+            self._persist_node(node, 'battery_level')
+        elif msg.sub_type == internal.I_SKETCH_NAME:
+            node.sketch_name = msg.payload
+            self._persist_node(node, 'sketch_name')
+        elif msg.sub_type == internal.I_SKETCH_VERSION:
+            node.sketch_version = _number(msg, float)
+            self._persist_node(node, 'sketch_version')
+        elif msg.sub_type == internal.I_TIME:
             response = msg.copy(**{'payload': int(time.time())})
             self.send(response)
-        elif msg.sub_type == self.const.Internal.I_CONFIG:
+        elif msg.sub_type == internal.I_CONFIG:
             response = msg.copy(**{'payload': self._config})
             self.send(response)
+        elif msg.sub_type == getattr(internal, 'I_HEARTBEAT_RESPONSE', None):
+            node.heartbeat = _number(msg, int)
+        elif msg.sub_type == getattr(internal, 'I_DISCOVER_RESPONSE', None):
+            node.parent_id = _number(msg, int)
+            self._persist_node(node, 'parent_id')
+        elif msg.sub_type == getattr(internal, 'I_DEBUG', None):
+            self.log_queue.put(msg)
+
+        if msg.sub_type in self._wake_up_types and msg.node_id in self._outbox:
+            self.flush_outbox(msg.node_id)
+
+    def send_many(self, msgs):
+        """
+          Sends several messages at once.
+          Specialized classes may override it to write them together.
+        """
+        for msg in msgs:
+            self.send(msg)
+
+    def send_when_awake(self, msg):
+        """
+          Keeps a message for a sleeping node until it tells it is awake (e.g. I_HEARTBEAT), then every
+          kept message is sent in a single burst. Only the latest message for each sensor, type and
+          sub_type is kept.
+          Raises GatewayError if the protocol version has no message telling that a node is awake (1.5).
+        """
+        if not self._wake_up_types:
+            raise GatewayError("Protocol version {} cannot tell when a node is awake.".format(self.protocol_version))
+
+        key = (msg.sensor_id, int(msg.type), int(msg.sub_type))
+        with self._outbox_lock:
+            outbox = self._outbox.get(msg.node_id)
+            if outbox is None:
+                outbox = self._outbox[msg.node_id] = OrderedDict()
+            outbox.pop(key, None)
+            outbox[key] = msg
+
+    def pending_messages(self, node_id):
+        """ Returns the messages kept for a sleeping node. """
+        with self._outbox_lock:
+            return list(self._outbox.get(node_id, {}).values())
+
+    def flush_outbox(self, node_id):
+        """ Sends every message kept for a node. """
+        with self._outbox_lock:
+            outbox = self._outbox.pop(node_id, None)
+        if outbox:
+            self.send_many(list(outbox.values()))
 
     def process(self):
         """
@@ -164,22 +488,276 @@ class Gateway(object):
         data is a pymys command string
         """
 
-        data = self.receive()
+        data = self._capture_line(self._read_line())
 
         self.msg_queue.put(data)
         data = self.msg_queue.get(block=False)
         if data:
-            msg = Message(data)
+            msg, result = self._dispatch(data)
 
-            msg_type = self.const.MessageType(msg.type)
-            self.callbacks[msg_type](msg)
-
-            if self.message_callback:
+            if self.message_callback and not (self.changes_only and result is False):
                 self.message_callback(msg)
 
+    def process_ready(self, read=True, reconnect=True):
+        """
+          Handles every message available, reading at most once from the interface. It is meant to be
+          called when fileno() is readable (see manager.GatewayManager), and must not be mixed with process.
+          Bad messages and the messages whose handler or message_callback failed are counted in pipeline_stats
+          and skipped.
+          :param read: If false, only the messages already received are handled.
+          :param reconnect: If false, a lost connection raises GatewayError instead of blocking to reconnect.
+          :return: Number of messages handled.
+        """
+        lines = []
+        while not self.msg_queue.empty():
+            lines.append(self.msg_queue.get(block=False))
+        for data in self._read_available(read, reconnect):
+            lines.append(self._capture_line(data))
+
+        handled = 0
+        for data in lines:
+            if not data:
+                continue
+            try:
+                msg, result = self._dispatch(data)
+                if self.message_callback and not (self.changes_only and result is False):
+                    self.message_callback(msg)
+            except BadMessageError:
+                self.pipeline_stats.increment('bad_messages')
+                continue
+            except Exception as err:
+                # The other lines were already taken from the interface, they must still be handled.
+                self.pipeline_stats.increment('errors')
+                self.pipeline_stats.last_error = err
+                continue
+            handled += 1
+
+        return handled
+
+    def start(self, workers=1, queue_size=1024, policy=BLOCK):
+        """
+          Starts the pipeline mode: a reader thread fills msg_queue with raw lines and worker
+          threads decode them and run the callbacks, so a slow message_callback does not stall
+          the interface. With more than one worker, messages may be handled out of order.
+          :param workers: Number of dispatcher threads.
+          :param queue_size: Maximum number of raw lines waiting in msg_queue.
+          :param policy: What the reader does when msg_queue is full: BLOCK waits for room,
+                         DROP_OLDEST discards the oldest line and DROP_NEWEST discards the new one.
+        """
+        if policy not in (BLOCK, DROP_OLDEST, DROP_NEWEST):
+            raise ValueError("Unknown backpressure policy: {}".format(policy))
+        if self._threads:
+            raise GatewayError("Pipeline already started.")
+
+        self._policy = policy
+        pending = self.msg_queue
+        self.msg_queue = utils.IndexableQueue(queue_size)
+        while not pending.empty():
+            self._enqueue(pending.get(block=False))
+
+        self._stopping.clear()
+        self._threads = [Thread(target=self._reader, name="pymys-reader", daemon=True)]
+        for i in range(workers):
+            self._threads.append(Thread(target=self._worker, name="pymys-worker-{}".format(i), daemon=True))
+        for thread in self._threads:
+            thread.start()
+
+    def stop(self, timeout=None):
+        """
+          Stops the pipeline mode. Lines already in msg_queue are dispatched before the workers exit, unless
+          msg_queue stays full for timeout seconds (1 if it is None), then the oldest lines are dropped.
+          The reader only notices it after its current read, so it may take up to the read timeout.
+        """
+        if not self._threads:
+            return
+
+        reader, workers = self._threads[0], self._threads[1:]
+        self._stopping.set()
+        reader.join(timeout)
+        for _ in workers:
+            try:
+                self.msg_queue.put(None, timeout=1.0 if timeout is None else timeout)
+            except queue.Full:
+                # The workers are stuck or dead, the oldest line waiting is discarded to stop them.
+                if self.msg_queue.put_drop_oldest(None) is not None:
+                    self.pipeline_stats.increment('dropped')
+        for thread in workers:
+            thread.join(timeout)
+        self._threads = []
+
+    def _enqueue(self, data):
+        """ Puts a raw line in msg_queue following the backpressure policy. """
+        if self._policy == BLOCK:
+            # Waits in steps so stop() is noticed while msg_queue is full, the line is then dropped.
+            while True:
+                try:
+                    self.msg_queue.put(data, timeout=0.1)
+                    return
+                except queue.Full:
+                    if self._stopping.is_set():
+                        self.pipeline_stats.increment('dropped')
+                        return
+        elif self._policy == DROP_OLDEST:
+            if self.msg_queue.put_drop_oldest(data) is not None:
+                self.pipeline_stats.increment('dropped')
+        else:
+            try:
+                self.msg_queue.put(data, block=False)
+            except queue.Full:
+                self.pipeline_stats.increment('dropped')
+
+    def _reader(self):
+        stats = self.pipeline_stats
+        while not self._stopping.is_set():
+            try:
+                data = self._capture_line(self._read_line())
+            except Exception as err:
+                stats.last_error = err
+                break
+            if data:
+                stats.received += 1
+                self._enqueue(data)
+
+    def _worker(self):
+        stats = self.pipeline_stats
+        while True:
+            data = self.msg_queue.get()
+            if data is None:
+                self.msg_queue.task_done()
+                break
+            try:
+                msg, result = self._dispatch(data)
+                if self.message_callback and not (self.changes_only and result is False):
+                    self.message_callback(msg)
+                stats.increment('dispatched')
+            except BadMessageError:
+                stats.increment('bad_messages')
+            except Exception as err:
+                stats.increment('errors')
+                stats.last_error = err
+            finally:
+                self.msg_queue.task_done()
+
+    def _dispatch(self, data):
+        """
+          Decodes a raw message and runs the handler registered for its type.
+          Type and sub_type are resolved to the protocol's enum members while decoding.
+          :param data: Raw message from gateway.
+          :return: A tuple with the decoded Message and the handler's result.
+        """
+        metrics = self.metrics
+        try:
+            msg = Message(data, self._const)
+        except BadMessageError:
+            if metrics is not None:
+                metrics.bad_message(len(data))
+            raise
+        if msg.ack and self.acks.pending:
+            self.acks.acknowledge(msg)
+        try:
+            if metrics is None:
+                result = self.callbacks[msg.type](msg)
+            else:
+                started = time.perf_counter()
+                result = self.callbacks[msg.type](msg)
+                metrics.message(msg, len(data), time.perf_counter() - started)
+        except BadMessageError:
+            if metrics is not None:
+                metrics.bad_message(len(data))
+            raise
+        node = self._nodes.get(msg.node_id)
+        if node is not None:
+            node.seen(msg.sensor_id)
+            self.liveness.seen(msg.node_id)
+        self.events.publish_message(msg)
+
+        return msg, result
+
+    def subscribe(self, callback, event=MESSAGE, node_id=None, sensor_id=None, type=None, sub_type=None,
+                  background=False):
+        """
+          Subscribes a callback to the messages (or another event) matching some of node_id, sensor_id,
+          type and sub_type. It is called after the message was handled, before message_callback.
+          :param background: Runs the callback on a thread pool, so it does not block the reader.
+          :return: Subscription to pass to unsubscribe.
+        """
+        return self.events.subscribe(callback, event, node_id, sensor_id, type, sub_type, background)
+
+    def unsubscribe(self, subscription):
+        self.events.unsubscribe(subscription)
+
+    def export_metrics(self):
+        """ Returns the metrics in the Prometheus text format, including the depth of msg_queue and log_queue. """
+        if self.metrics is None:
+            raise GatewayError("Gateway was created without metrics.")
+
+        return self.metrics.to_prometheus(self._const, {'msg_queue': self.msg_queue, 'log_queue': self.log_queue})
+
+    def _get_node(self, node_id):
+        """ Returns a node, registering it if it is not known yet. """
+        node = self._nodes.get(node_id)
+        if node is None:
+            node = self._nodes.setdefault(node_id, Node(node_id))
+            self.id_allocator.confirm(node_id)
+            if self.persistence is not None:
+                self._persist('node', node_id, {})
+
+        return node
+
+    def load_state(self):
+        """
+          Restores nodes, sensors and reserved IDs from the persistence store.
+          If protocol_version is unknown, the saved one is used until the gateway reports its version.
+        """
+        state = self.persistence.load()
+        if state is None:
+            return
+
+        if self._const is None and state.get('protocol_version') is not None:
+            self.protocol_version = str(state['protocol_version'])
+
+        self.nodes = utils.CopyOnWriteDict(
+            (node_id, Node.from_dict(data, self._const, self.typed_values)) for node_id, data in state['nodes'].items())
+        if state.get('id_allocator'):
+            self.id_allocator.from_dict(state['id_allocator'])
+
+    def save_state(self):
+        """ Saves a full snapshot to the persistence store, which discards its journal. """
+        with self._persist_lock:
+            self.persistence.compact(self._state())
+
+    def _state(self):
+        # Only raw values are saved, they are converted again when loaded.
+        nodes = self.snapshot()
+        for node in nodes.values():
+            for sensor in node['sensors'].values():
+                del sensor['values']
+
+        return {'protocol_version': self.protocol_version,
+                'nodes': nodes,
+                'id_allocator': self.id_allocator.to_dict()}
+
+    def _persist(self, *operation):
+        with self._persist_lock:
+            self.persistence.record(*operation)
+            if self.persistence.needs_compaction():
+                self.persistence.compact(self._state())
+
+    def _persist_node(self, node, field):
+        if self.persistence is not None:
+            self._persist('node', node.id, {field: getattr(node, field)})
+
+    def snapshot(self):
+        """ Returns a consistent copy of every node and its sensors as plain dictionaries. """
+        return {node_id: node.snapshot() for node_id, node in self.nodes.items()}
+
     def get_free_id(self):
-        free_ids = [i for i in range(1,255) if i not in self.nodes.keys()]
-        return free_ids[0]
+        """
+          Reserves and returns the lowest free node ID. The reservation ends when the node presents
+          itself or after id_reservation_timeout seconds.
+          Raises NoFreeIdError (an IndexError) if every ID is in use.
+        """
+        return self.id_allocator.allocate()
 
     def __getitem__(self, item):
         item = int(item)
@@ -187,79 +765,123 @@ class Gateway(object):
 
 
 class SerialGateway(Gateway):
-    """ MySensors Serial Gateway. """
+    """
+      MySensors Serial Gateway.
+      With batch_writes (or max_rate), messages are written by a writer thread which joins the queued
+      ones into a single write of up to max_batch messages, sending at most max_rate messages per second.
+      serial_factory replaces serial.Serial to open the port, e.g. with a simulator.SimulatedSerial.
+    """
 
     def __init__(self, port, baudrate=115200, message_callback=None, protocol_version=None, **kwargs):
         self.serial = None
         self._port = port
         self._baudrate = baudrate
         self._timeout = kwargs.get('timeout', 10.0)
+        self._serial_factory = kwargs.get('serial_factory')
+        self._buffer = utils.LineBuffer(kwargs.get('buffer_size', 4096))
+        self._write_buffer = bytearray()
+        self.writer = None
+        max_rate = kwargs.get('max_rate')
+        if kwargs.get('batch_writes', False) or max_rate:
+            limiter = RateLimiter(max_rate, kwargs.get('max_burst')) if max_rate else None
+            self.writer = BatchWriter(self._write_locked, kwargs.get('max_batch', 64), limiter)
         super(SerialGateway, self).__init__(message_callback, protocol_version, **kwargs)
 
     def connect(self, timeout=10):
         """ Connects to the serial port. """
 
         if not self.serial:
-            connected = False
             try:
-                self.serial = serial.Serial(port=self.port, baudrate=self.baudrate,
-                                            parity=serial.PARITY_NONE, stopbits=serial.STOPBITS_ONE,
-                                            bytesize=serial.EIGHTBITS, timeout=self.timeout)
-                msg = Message()
-                for i in range(timeout+1):
-                    data = self.serial.readline().decode("utf-8")
-
-                    if not data or i == timeout:
-                        raise GatewayError("Gateway not initialized correctly.")
-                    try:
-                        msg.decode(data)
-                    except BadMessageError:
-                        # FIXME This was put here because a bug on pyserial that couldn't flush the buffer
-                        continue
-                    if msg.node_id == 0 and msg.type == 3:
-                        if msg.sub_type == 9:
-                            self.log_queue.put(msg.payload)
-                        elif msg.sub_type == 14:
-                            connected = True
-                            break
-
-                if not connected:
-                    raise GatewayError("Gateway not initialized correctly.")
-
-                if self.protocol_version is None:
-                    msg = Message("0;0;3;0;2;")
-                    self.serial.write(msg.encode().encode("utf-8"))
-                    data = self.serial.readline().decode("utf-8")
-                    while not data.startswith("0;0;3;0;2;"):
-                        self.msg_queue.put(data)
-                        data = self.serial.readline().decode("utf-8")
-                    msg.decode(data)
-
-                    if msg.node_id == 0 and msg.type == 3 and msg.sub_type == 2:
-                        self.protocol_version = msg.payload
-                        self.const = self.protocol_version
-
+                factory = self._serial_factory or serial.Serial
+                self.serial = factory(port=self.port, baudrate=self.baudrate,
+                                      parity=serial.PARITY_NONE, stopbits=serial.STOPBITS_ONE,
+                                      bytesize=serial.EIGHTBITS, timeout=self.timeout)
+                self._buffer.clear()
+                self._handshake(timeout)
             except serial.SerialException as err:
                 raise GatewayError("Gateway not connected or problem in Serial connection.")
+            if self.writer is not None:
+                self.writer.start()
         return True
 
     def disconnect(self):
-        """ Disconnects from the serial port. """
+        """ Disconnects from the serial port, after the messages waiting for the writer are written. """
+        if self.writer is not None:
+            self.writer.stop()
         with self.lock:
             if self.serial is not None:
                 self.serial.close()
                 self.serial = None
+        self._close_stores()
 
     def receive(self):
-        with self.lock:
-            value = self.serial.readline().decode("utf-8")
+        return self._read_line().decode("utf-8")
 
-        return value
+    def send(self, message, ack=False):
+        """ Sends a Message to the gateway. With ack, returns a Future completed by its echo. """
+        future = self.acks.track(message) if ack else None
+        if self.writer is not None and self.writer.running:
+            self.writer.put(message)
+        else:
+            with self.lock:
+                buffer = self._write_buffer
+                del buffer[:]
+                message.encode_into(buffer)
+                self._write(buffer)
+
+        return future
+
+    def send_many(self, msgs):
+        """ Sends several messages in a single write, or queues them for the writer thread. """
+        if self.writer is not None and self.writer.running:
+            for msg in msgs:
+                self.writer.put(msg)
+            return
 
-    def send(self, message):
-        """ Sends a Message to the gateway. """
         with self.lock:
-            self.serial.write(message.encode().encode("utf-8"))
+            buffer = self._write_buffer
+            del buffer[:]
+            for msg in msgs:
+                msg.encode_into(buffer)
+            if buffer:
+                self._write(buffer)
+
+    def _read_line(self):
+        return self.serial.readline()
+
+    def _write(self, data):
+        self.serial.write(data)
+        if self.metrics is not None:
+            self.metrics.written(len(data))
+
+    def _write_locked(self, data):
+        with self.lock:
+            self._write(data)
+
+    def fileno(self):
+        return self.serial.fileno() if self.serial is not None else -1
+
+    def _read_available(self, read=True, reconnect=True):
+        """
+          Reads what is available. The serial port is not reopened here: when it is lost it is closed and
+          GatewayError is raised, so it can be connected again (see manager.GatewayManager).
+        """
+        if read:
+            try:
+                if self.serial is None:
+                    raise GatewayError("Gateway not connected.")
+                try:
+                    self._buffer.feed(self.serial.read(self.serial.in_waiting or 1))
+                except (serial.SerialException, OSError) as err:
+                    raise GatewayError("Serial port of the gateway was lost: {}".format(err))
+            except GatewayError:
+                with self.lock:
+                    if self.serial is not None:
+                        self.serial.close()
+                        self.serial = None
+                raise
+
+        return list(iter(self._buffer.readline, None))
 
     @property
     def baudrate(self):
@@ -283,77 +905,321 @@ class SerialGateway(Gateway):
 
 
 class EthernetGateway(Gateway):
-    """ MySensors Ethernet Gateway (Not impemented yet) """
-    pass
+    """ MySensors Ethernet Gateway. It connects as a TCP client and reconnects with backoff. """
+
+    def __init__(self, host, port=5003, message_callback=None, protocol_version=None, **kwargs):
+        self.socket = None
+        self._host = host
+        self._port = port
+        self._timeout = kwargs.get('timeout', 10.0)
+        self.reconnect_delay = kwargs.get('reconnect_delay', 1.0)
+        self.max_reconnect_delay = kwargs.get('max_reconnect_delay', 60.0)
+        self.max_reconnect_attempts = kwargs.get('max_reconnect_attempts', None)
+        self._buffer = utils.LineBuffer(kwargs.get('buffer_size', 4096))
+        self._write_lock = RLock()
+        # Held while connecting, so the reader and the senders do not reconnect at the same time.
+        self._connect_lock = RLock()
+        self._connecting = False
+        super(EthernetGateway, self).__init__(message_callback, protocol_version, **kwargs)
+
+    def connect(self, timeout=10):
+        """ Connects to the gateway's TCP port. """
+
+        with self._connect_lock:
+            if not self.socket:
+                try:
+                    self.socket = socket.create_connection((self.host, self.port), timeout=self.timeout)
+                    self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                    self._buffer.clear()
+                    self._connecting = True
+                    self._handshake(timeout)
+                except (OSError, GatewayError) as err:
+                    self._close_socket()
+                    raise GatewayError("Gateway not connected or problem in TCP connection: {}".format(err))
+                finally:
+                    self._connecting = False
+        return True
+
+    def disconnect(self):
+        """ Closes the TCP connection. """
+        self._close_socket()
+        self._close_stores()
+
+    def _close_socket(self):
+        with self._write_lock:
+            if self.socket is not None:
+                try:
+                    self.socket.close()
+                finally:
+                    self.socket = None
+
+    def reconnect(self, lost=None):
+        """
+          Reconnects to the gateway, doubling the delay between attempts up to max_reconnect_delay.
+          Raises GatewayError when max_reconnect_attempts is reached.
+          :param lost: Socket found broken. If another thread replaced it in the meantime, nothing is done.
+        """
+        with self._connect_lock:
+            if lost is not None and self.socket is not lost:
+                return True
+            self._close_socket()
+            delay = self.reconnect_delay
+            attempt = 0
+            while True:
+                try:
+                    return self.connect()
+                except GatewayError:
+                    attempt += 1
+                    if self.max_reconnect_attempts is not None and attempt >= self.max_reconnect_attempts:
+                        raise
+                time.sleep(delay)
+                delay = min(delay * 2, self.max_reconnect_delay)
+
+    def receive(self):
+        return self._read_line().decode("utf-8")
+
+    def send(self, message, ack=False):
+        """
+          Sends a Message to the gateway, reconnecting once if the connection was lost.
+          With ack, returns a Future completed by its echo.
+        """
+        future = self.acks.track(message) if ack else None
+        data = message.encode().encode("utf-8")
+        sock = self.socket
+        try:
+            self._write(data)
+        except GatewayError:
+            self.reconnect(sock)
+            self._write(data)
+
+        return future
+
+    def _read_line(self):
+        """ Reads a line, reconnecting if the connection was lost out of the handshake. """
+        sock = self.socket
+        try:
+            return self._recv_line(sock)
+        except GatewayError:
+            if self._connecting:
+                raise
+            self.reconnect(sock)
+
+        return b""
+
+    def fileno(self):
+        return self.socket.fileno() if self.socket is not None else -1
+
+    def _read_available(self, read=True, reconnect=True):
+        """ Reads what is available, reconnecting if the connection was lost. """
+        if read:
+            sock = self.socket
+            try:
+                if sock is None:
+                    raise GatewayError("Gateway not connected.")
+                try:
+                    received = self._buffer.fill(sock.recv_into)
+                except socket.timeout:
+                    received = None
+                except OSError as err:
+                    raise GatewayError("Connection to the gateway was lost: {}".format(err))
+                if received == 0:
+                    raise GatewayError("Connection to the gateway was closed.")
+            except GatewayError:
+                if not reconnect:
+                    self._close_socket()
+                    raise
+                self.reconnect(sock)
+
+        return list(iter(self._buffer.readline, None))
+
+    def _recv_line(self, sock):
+        if sock is None:
+            raise GatewayError("Gateway not connected.")
+
+        line = self._buffer.readline()
+        while line is None:
+            try:
+                received = self._buffer.fill(sock.recv_into)
+            except socket.timeout:
+                return b""
+            except OSError as err:
+                raise GatewayError("Connection to the gateway was lost: {}".format(err))
+            if not received:
+                raise GatewayError("Connection to the gateway was closed.")
+            line = self._buffer.readline()
+
+        return line
+
+    def _write(self, data):
+        with self._write_lock:
+            if self.socket is None:
+                raise GatewayError("Gateway not connected.")
+            try:
+                self.socket.sendall(data)
+            except OSError as err:
+                raise GatewayError("Connection to the gateway was lost: {}".format(err))
+        if self.metrics is not None:
+            self.metrics.written(len(data))
+
+    @property
+    def host(self):
+        return self._host
+
+    @property
+    def port(self):
+        return self._port
+
+    @property
+    def timeout(self):
+        with self.lock:
+            value = self._timeout
+
+        return value
+
+    @timeout.setter
+    def timeout(self, value):
+        with self.lock:
+            self._timeout = value
+            if self.socket is not None:
+                self.socket.settimeout(value)
 
 
 class Node(object):
-    """ Represents a node. """
+    """
+      Represents a node.
+      Reads never lock: the node's fields are kept in a dictionary which writers replace as a whole,
+      so several fields can be updated at once and readers always see a consistent state.
+    """
+
+    _fields = {'sketch_name': str, 'sketch_version': float, 'battery_level': int, 'heartbeat': int,
+               'parent_id': int}
 
     def __init__(self, sensor_id):
         self._id = int(sensor_id)
-        self.sensors = utils.DictThreadSafe()
-        self._sketch_name = ""
-        self._sketch_version = 0.0
-        self._battery_level = 0
+        self.sensors = utils.CopyOnWriteDict()
+        self._info = {'sketch_name': "", 'sketch_version': 0.0, 'battery_level': 0, 'heartbeat': 0, 'parent_id': 0}
+        self.last_seen = None
 
         self.lock = RLock()
 
-    def set_sensor_value(self, id, value_type, value):
-        """ Sets a child sensor's value. """
-        if id in self.sensors:
-            self.sensors[id].values[value_type] = value
+    def set_sensor_value(self, id, value_type, value, raw=None):
+        """
+          Sets a child sensor's value.
+          :param raw: Payload the value was converted from. If None, value is also the raw value.
+        """
+        sensor = self.sensors.get(id)
+        if sensor is not None:
+            sensor.update_value(value_type, value, raw)
         # TODO: Handle error
 
+    def seen(self, sensor_id=None, timestamp=None):
+        """ Records that the node, and one of its sensors if it has sensor_id, sent a message. """
+        if timestamp is None:
+            timestamp = time.time()
+
+        self.last_seen = timestamp
+        sensor = self.sensors.get(sensor_id)
+        if sensor is not None:
+            sensor.last_seen = timestamp
+
+    def update(self, **kwargs):
+        """ Updates several fields (sketch_name, sketch_version, battery_level, heartbeat, parent_id) atomically. """
+        with self.lock:
+            info = self._info.copy()
+            for key, value in kwargs.items():
+                if key not in self._fields:
+                    raise NodeError("Unknown node field: {}".format(key))
+                info[key] = self._fields[key](value)
+            self._info = info
+
+    @classmethod
+    def from_dict(cls, data, const=None, typed=True):
+        """
+          Creates a node from the dictionary returned by snapshot. Values are restored from raw_values.
+          :param const: Protocol module used to turn sensor types and value types into its enums.
+          :param typed: If true (and const is given), raw values are converted to native types.
+        """
+        node = cls(data['id'])
+        node.update(**{key: data[key] for key in cls._fields if key in data})
+        presentation = const.sub_types[const.MessageType.C_PRESENTATION] if const is not None else None
+        set_req = const.sub_types[const.MessageType.C_SET] if const is not None else None
+        sensors = {}
+        for sensor_id, sensor in data['sensors'].items():
+            sensor_type = presentation[sensor['type']] if presentation is not None else sensor['type']
+            sensors[sensor_id] = Sensor(sensor_id, sensor_type)
+            raw_values = sensor['raw_values'] if 'raw_values' in sensor else sensor['values']
+            if set_req is not None:
+                raw_values = {set_req[value_type]: value for value_type, value in raw_values.items()}
+            sensors[sensor_id].raw_values.update(raw_values)
+            if typed and const is not None:
+                sensors[sensor_id].values.update(
+                    (value_type, payload.decode(const, value_type, value)) for value_type, value in raw_values.items())
+            else:
+                sensors[sensor_id].values.update(raw_values)
+        node.sensors.update(sensors)
+
+        return node
+
+    def snapshot(self):
+        """ Returns a consistent copy of the node and its sensors as plain dictionaries. """
+        info = dict(self._info)
+        info['id'] = self._id
+        info['sensors'] = {sensor_id: sensor.snapshot() for sensor_id, sensor in self.sensors.items()}
+
+        return info
+
     @property
     def id(self):
         return self._id
 
     @property
     def sketch_name(self):
-        with self.lock:
-            value = self._sketch_name
-
-        return value
+        return self._info['sketch_name']
 
     @sketch_name.setter
     def sketch_name(self, value):
-        with self.lock:
-            self._sketch_name = str(value)
+        self.update(sketch_name=value)
 
     @property
     def sketch_version(self):
-        with self.lock:
-            value = self._sketch_version
-
-        return value
+        return self._info['sketch_version']
 
     @sketch_version.setter
     def sketch_version(self, value):
-        with self.lock:
-            self._sketch_version = float(value)
+        self.update(sketch_version=value)
 
     @property
     def battery_level(self):
-        with self.lock:
-            value = int(self._battery_level)
-
-        return value
+        return self._info['battery_level']
 
     @battery_level.setter
     def battery_level(self, value):
-        with self.lock:
-            self._battery_level = value
+        self.update(battery_level=value)
+
+    @property
+    def heartbeat(self):
+        return self._info['heartbeat']
+
+    @heartbeat.setter
+    def heartbeat(self, value):
+        self.update(heartbeat=value)
+
+    @property
+    def parent_id(self):
+        return self._info['parent_id']
+
+    @parent_id.setter
+    def parent_id(self, value):
+        self.update(parent_id=value)
 
     def __getitem__(self, item):
         item = int(item)
         return self.sensors[item]
 
     def __setitem__(self, key, value):
-        if key not in self.sensors:
-            key = int(key)
-            self.sensors[key] = Sensor(key, value)
-        else:
+        key = int(key)
+        sensor = Sensor(key, value)
+        if self.sensors.setdefault(key, sensor) is not sensor:
             raise NodeError("There is already a sensor with this ID in this node.")
 
     def __str__(self):
@@ -362,21 +1228,98 @@ class Node(object):
 
 
 class Sensor(object):
-    """ Represents a sensor. """
+    """
+      Represents a sensor.
+      Reads of values, raw_values and last_changed never lock. Updates and snapshot share a lock, so a
+      snapshot never mixes the value of an update with the raw value of another.
+    """
 
     def __init__(self, id, type):
         self.id = int(id)
         self.type = type
-        self.values = utils.DictThreadSafe()
+        self.values = utils.CopyOnWriteDict()
+        self.raw_values = utils.CopyOnWriteDict()
+        self.history = utils.CopyOnWriteDict()
+        self.last_seen = None
+        self.last_changed = utils.CopyOnWriteDict()
+        self._reference = {}
+
+        self.lock = Lock()
+
+    def update_value(self, value_type, value, raw=None, deadband=None, timestamp=None):
+        """
+          Sets a value and tells whether it changed.
+          Numeric values only change when they moved by deadband or more from the value of the last change,
+          so slow drifts are still reported once they add up. Other values change when they are different.
+          :param raw: Payload the value was converted from. If None, value is also the raw value.
+          :return: A tuple (changed, value of the last change or None).
+        """
+        if timestamp is None:
+            timestamp = time.time()
+
+        with self.lock:
+            # Values restored or set directly are the reference until the first change.
+            reference = self._reference if value_type in self._reference else self.values
+            previous = reference.get(value_type)
+            if value_type not in reference:
+                changed = True
+            elif deadband and _is_number(value) and _is_number(previous):
+                changed = abs(value - previous) >= deadband
+            else:
+                changed = value != previous
+
+            self.values[value_type] = value
+            self.raw_values[value_type] = value if raw is None else raw
+            self.last_seen = timestamp
+            if changed:
+                self._reference[value_type] = value
+                self.last_changed[value_type] = timestamp
+
+        return changed, previous
+
+    def add_sample(self, value_type, value, size=1024, max_age=None, timestamp=None):
+        """
+          Adds a numeric value to the history of value_type, creating it with size and max_age if needed.
+          Values that are not numeric are ignored.
+        """
+        try:
+            value = float(value)
+        except (TypeError, ValueError):
+            return
+
+        history = self.history.get(value_type)
+        if history is None:
+            history = self.history.setdefault(value_type, History(size, max_age))
+        history.append(value, timestamp)
+
+    def snapshot(self):
+        """ Returns a consistent copy of the sensor as a plain dictionary. """
+        with self.lock:
+            return {'id': self.id, 'type': self.type, 'values': dict(self.values.snapshot()),
+                    'raw_values': dict(self.raw_values.snapshot())}
 
     def __str__(self):
         return "S_ID: {s.id} | TYPE: {s.type.name} | VALUES: {s.values}".format(s=self)
 
 
+def _is_number(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+def _number(msg, convert):
+    """ Converts the payload of a message, raising BadMessageError if it is not a number. """
+    try:
+        return convert(msg.payload)
+    except ValueError:
+        raise BadMessageError("Invalid payload for {}: {}".format(msg.sub_type.name, msg.payload))
+
+
 class Message(object):
     """ Represents a message from the gateway. """
 
-    def __init__(self, raw=None):
+    __slots__ = ('node_id', 'sensor_id', 'type', 'ack', 'sub_type', 'payload')
+
+    def __init__(self, raw=None, const=None):
         self.node_id = 0
         self.sensor_id = 0
         self.type = ""
@@ -384,31 +1327,68 @@ class Message(object):
         self.sub_type = ""
         self.payload = ""
         if raw is not None:
-            self.decode(raw)
+            self.decode(raw, const)
 
     def copy(self, **kwargs):
         """
         Copies a message, optionally replacing attributes with keyword
         arguments.
         """
-        msg = Message(self.encode())
-        for key, val in kwargs.items():
-            setattr(msg, key, val)
+        msg = Message()
+        for key in self.__slots__:
+            setattr(msg, key, kwargs.get(key, getattr(self, key)))
         return msg
 
-    def decode(self, data):
-        """ Decode a message from command string. """
+    def decode(self, data, const=None):
+        """
+          Decode a message from command string or bytes.
+          Bytes are split directly and only the payload is decoded to str.
+          :param data: Raw message.
+          :param const: Protocol module (mys_15, mys_16, ...) used to resolve type and sub_type to its
+                        enum members. If None, they are kept as int.
+        """
         try:
-            data = data.rstrip().split(';')
-            self.payload = data.pop()
-            (self.node_id,
-             self.sensor_id,
-             self.type,
-             self.ack,
-             self.sub_type) = [int(f) for f in data]
-        except ValueError:
+            if isinstance(data, str):
+                fields = data.rstrip().split(';', 5)
+                self.payload = fields[5]
+            else:
+                fields = data.rstrip().split(b';', 5)
+                self.payload = fields[5].decode("utf-8")
+            self.node_id = int(fields[0])
+            self.sensor_id = int(fields[1])
+            msg_type = int(fields[2])
+            self.ack = int(fields[3])
+            sub_type = int(fields[4])
+        except (ValueError, IndexError):
             raise BadMessageError("Malformed message: {}".format(data))
 
+        if const is not None:
+            try:
+                self.type = const.message_types[msg_type]
+                self.sub_type = const.sub_types[msg_type][sub_type]
+            except IndexError:
+                self.sub_type = None
+            if self.sub_type is None or msg_type < 0 or sub_type < 0:
+                raise BadMessageError("Unknown message type or sub-type: {}".format(data))
+        else:
+            self.type = msg_type
+            self.sub_type = sub_type
+
+    @classmethod
+    def decode_many(cls, data, const=None, errors=None):
+        """
+          Decodes every line of a buffer in one pass. Empty and malformed lines are skipped.
+          :param data: bytes-like buffer of gateway lines.
+          :param const: Protocol module used to resolve type and sub_type (see decode).
+          :param errors: Optional list where malformed lines are appended.
+          :return: Generator of Message.
+        """
+        new = object.__new__
+        for fields in _iter_fields(data, const, errors):
+            msg = new(cls)
+            (msg.node_id, msg.sensor_id, msg.type, msg.ack, msg.sub_type, msg.payload) = fields
+            yield msg
+
     def encode(self):
         """ Encode a command string from message. """
         return ";".join([str(f) for f in [
@@ -420,9 +1400,167 @@ class Message(object):
             self.payload,
         ]]) + "\n"
 
+    def encode_into(self, buffer):
+        """ Appends the encoded message as bytes to a bytearray. """
+        buffer += b"%d;%d;%d;%d;%d;" % (self.node_id, self.sensor_id, self.type, self.ack, self.sub_type)
+        buffer += str(self.payload).encode("utf-8")
+        buffer += b"\n"
+
     def __str__(self):
         return "{};{};{};{};{};{}".format(self.node_id, self.sensor_id, self.type, self.ack, self.sub_type, self.payload)
 
+
+class MessageColumns(object):
+    """
+      Columnar storage of decoded messages. Numeric fields are kept in arrays of
+      unsigned bytes and payloads in a list, all of them indexed by message.
+    """
+
+    def __init__(self):
+        self.node_id = array('B')
+        self.sensor_id = array('B')
+        self.type = array('B')
+        self.ack = array('B')
+        self.sub_type = array('B')
+        self.payload = []
+
+    @classmethod
+    def from_stream(cls, source, const=None, errors=None, chunk_size=1 << 20):
+        """ Builds the columns from a buffer or binary file (see parse_stream). """
+        columns = cls()
+        for chunk in _iter_chunks(source, chunk_size):
+            columns.extend(chunk, const, errors)
+
+        return columns
+
+    def extend(self, data, const=None, errors=None):
+        """
+          Appends every valid line of a buffer.
+          :param data: bytes-like buffer of gateway lines.
+          :param const: Protocol module used to skip unknown types and sub-types.
+          :param errors: Optional list where malformed lines are appended.
+        """
+        for fields in _iter_fields(data, const, errors):
+            numbers = fields[:5]
+            if min(numbers) < 0 or max(numbers) > 255:
+                if errors is not None:
+                    line = ";".join([str(int(f)) for f in numbers] + [fields[5]])
+                    errors.append(line.encode("utf-8"))
+                continue
+            self.node_id.append(fields[0])
+            self.sensor_id.append(fields[1])
+            self.type.append(fields[2])
+            self.ack.append(fields[3])
+            self.sub_type.append(fields[4])
+            self.payload.append(fields[5])
+
+    def message(self, index):
+        """ Returns the message at index as a Message object. """
+        msg = Message()
+        msg.node_id = self.node_id[index]
+        msg.sensor_id = self.sensor_id[index]
+        msg.type = self.type[index]
+        msg.ack = self.ack[index]
+        msg.sub_type = self.sub_type[index]
+        msg.payload = self.payload[index]
+        return msg
+
+    def __len__(self):
+        return len(self.payload)
+
+
+def parse_stream(source, const=None, errors=None, chunk_size=1 << 20):
+    """
+      Decodes gateway lines from a large buffer or binary file, reading files in chunks.
+      Empty and malformed lines are skipped.
+      :param source: bytes-like buffer or a file opened in binary mode.
+      :param const: Protocol module used to resolve type and sub_type (see Message.decode).
+      :param errors: Optional list where malformed lines are appended.
+      :param chunk_size: Bytes read from a file at a time.
+      :return: Generator of Message.
+    """
+    for chunk in _iter_chunks(source, chunk_size):
+        for msg in Message.decode_many(chunk, const, errors):
+            yield msg
+
+
+def _iter_chunks(source, chunk_size):
+    """ Yields chunks of a buffer or binary file which always end on a line boundary. """
+    if not hasattr(source, 'read'):
+        yield source
+        return
+
+    pending = b""
+    while True:
+        chunk = source.read(chunk_size)
+        if not chunk:
+            break
+        end = chunk.rfind(b"\n") + 1
+        if end:
+            yield pending + chunk[:end]
+            pending = chunk[end:]
+        else:
+            pending += chunk
+    if pending:
+        yield pending
+
+
+def _iter_fields(data, const, errors):
+    """ Yields the fields of each valid line of a buffer as a tuple in Message's order. """
+    if const is not None:
+        message_types = const.message_types
+        sub_types = const.sub_types
+    for line in data.splitlines():
+        fields = line.split(b";", 5)
+        if len(fields) != 6:
+            if line.strip() and errors is not None:
+                errors.append(line)
+            continue
+        try:
+            node_id = int(fields[0])
+            sensor_id = int(fields[1])
+            msg_type = int(fields[2])
+            ack = int(fields[3])
+            sub_type = int(fields[4])
+            payload = fields[5].rstrip().decode("utf-8")
+            if const is not None:
+                if msg_type < 0 or sub_type < 0:
+                    raise IndexError
+                sub_type = sub_types[msg_type][sub_type]
+                if sub_type is None:
+                    raise IndexError
+                msg_type = message_types[msg_type]
+        except (ValueError, IndexError):
+            if errors is not None:
+                errors.append(line)
+            continue
+        yield node_id, sensor_id, msg_type, ack, sub_type, payload
+
+
+class PipelineStats(object):
+    """
+      Counters of the reader/dispatcher pipeline.
+      received and dropped are only written by the reader thread, the others by the workers.
+    """
+
+    def __init__(self):
+        self.received = 0
+        self.dropped = 0
+        self.dispatched = 0
+        self.bad_messages = 0
+        self.errors = 0
+        self.last_error = None
+        self.lock = Lock()
+
+    def increment(self, name):
+        with self.lock:
+            setattr(self, name, getattr(self, name) + 1)
+
+    def __str__(self):
+        return "RECEIVED: {s.received} | DROPPED: {s.dropped} | DISPATCHED: {s.dispatched} | "\
+               "BAD MESSAGES: {s.bad_messages} | ERRORS: {s.errors}".format(s=self)
+
+
 # Custom Exceptions
 
 
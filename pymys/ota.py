@@ -0,0 +1,183 @@
+"""
+pymys - Over the air firmware updates using stream messages
+"""
+
+import binascii
+import struct
+from threading import Lock
+
+FIRMWARE_BLOCK_SIZE = 16
+# Images are padded with 0xFF to a multiple of this size, as the bootloader expects.
+FIRMWARE_PAGE_SIZE = 128
+
+
+def _crc16_table():
+    table = []
+    for byte in range(256):
+        crc = byte
+        for _ in range(8):
+            crc = (crc >> 1) ^ 0xA001 if crc & 1 else crc >> 1
+        table.append(crc)
+
+    return tuple(table)
+
+_CRC16_TABLE = _crc16_table()
+
+
+def crc16(data):
+    """ CRC-16 (polynomial 0xA001, initial value 0xFFFF) used by the MySensors bootloader. """
+    crc = 0xFFFF
+    table = _CRC16_TABLE
+    for byte in data:
+        crc = (crc >> 8) ^ table[(crc ^ byte) & 0xFF]
+
+    return crc
+
+
+def parse_hex(lines):
+    """
+      Parses an Intel HEX image.
+      :param lines: Iterable of the file's lines (str).
+      :return: The image as bytes, gaps are filled with 0xFF.
+    """
+    image = bytearray()
+    base = 0
+    for number, line in enumerate(lines, 1):
+        line = line.strip()
+        if not line:
+            continue
+        if not line.startswith(":"):
+            raise FirmwareError("Invalid HEX record at line {}.".format(number))
+        try:
+            record = binascii.unhexlify(line[1:])
+        except (binascii.Error, ValueError):
+            raise FirmwareError("Invalid HEX record at line {}.".format(number))
+        if len(record) < 5 or len(record) != record[0] + 5 or sum(record) & 0xFF:
+            raise FirmwareError("Invalid HEX record or checksum at line {}.".format(number))
+
+        size, address, record_type = record[0], record[1] << 8 | record[2], record[3]
+        data = record[4:4 + size]
+        if record_type == 0:
+            address += base
+            if len(image) < address + size:
+                image.extend(b"\xff" * (address + size - len(image)))
+            image[address:address + size] = data
+        elif record_type == 1:
+            break
+        elif record_type == 2:
+            base = (data[0] << 8 | data[1]) * 16
+        elif record_type == 4:
+            base = (data[0] << 8 | data[1]) << 16
+
+    return bytes(image)
+
+
+class Firmware(object):
+    """
+      Firmware image prepared to be served.
+      The image is padded, its CRC computed and every block response encoded once when it is loaded.
+    """
+
+    def __init__(self, fw_type, fw_version, data):
+        self.type = int(fw_type)
+        self.version = int(fw_version)
+        padding = -len(data) % FIRMWARE_PAGE_SIZE
+        self.data = bytes(data) + b"\xff" * padding
+        self.blocks = len(self.data) // FIRMWARE_BLOCK_SIZE
+        self.crc = crc16(self.data)
+        self.config = _encode(struct.pack("<HHHH", self.type, self.version, self.blocks, self.crc))
+
+        header = struct.Struct("<HHH")
+        self._responses = tuple(
+            _encode(header.pack(self.type, self.version, block) +
+                    self.data[block * FIRMWARE_BLOCK_SIZE:(block + 1) * FIRMWARE_BLOCK_SIZE])
+            for block in range(self.blocks))
+
+    @classmethod
+    def from_hex(cls, fw_type, fw_version, path):
+        """ Loads a firmware from an Intel HEX file. """
+        with open(path) as f:
+            return cls(fw_type, fw_version, parse_hex(f))
+
+    def block(self, block):
+        """ Returns the encoded ST_FIRMWARE_RESPONSE payload of a block. """
+        return self._responses[block]
+
+
+class FirmwareManager(object):
+    """
+      Answers the firmware stream messages of nodes.
+      Loaded firmwares are cached by (type, version), and block requests are answered from the cache
+      by the type and version they carry, so many nodes can be updated at the same time.
+    """
+
+    def __init__(self):
+        self.firmwares = {}
+        self.updates = {}
+        self.progress = {}
+        self.lock = Lock()
+
+    def add(self, firmware):
+        with self.lock:
+            self.firmwares[(firmware.type, firmware.version)] = firmware
+
+        return firmware
+
+    def load(self, fw_type, fw_version, path):
+        """ Loads a firmware from an Intel HEX file, unless it is already cached. """
+        firmware = self.firmwares.get((int(fw_type), int(fw_version)))
+        if firmware is None:
+            firmware = self.add(Firmware.from_hex(fw_type, fw_version, path))
+
+        return firmware
+
+    def schedule(self, node_id, fw_type, fw_version):
+        """ Makes node_id receive a cached firmware on its next ST_FIRMWARE_CONFIG_REQUEST. """
+        key = (int(fw_type), int(fw_version))
+        if key not in self.firmwares:
+            raise FirmwareError("Firmware type {} version {} is not loaded.".format(*key))
+        with self.lock:
+            self.updates[node_id] = key
+
+    def cancel(self, node_id):
+        with self.lock:
+            self.updates.pop(node_id, None)
+            self.progress.pop(node_id, None)
+
+    def handle(self, msg, stream):
+        """
+          Returns the response to a firmware stream message, or None if it must not be answered.
+          :param msg: Stream message from a node.
+          :param stream: Stream enum of the protocol.
+        """
+        if msg.sub_type == stream.ST_FIRMWARE_CONFIG_REQUEST:
+            key = self.updates.get(msg.node_id)
+            if key is None:
+                return None
+            return msg.copy(sub_type=stream.ST_FIRMWARE_CONFIG_RESPONSE, payload=self.firmwares[key].config)
+
+        if msg.sub_type == stream.ST_FIRMWARE_REQUEST:
+            try:
+                fw_type, fw_version, block = struct.unpack("<HHH", binascii.unhexlify(msg.payload))
+            except (binascii.Error, ValueError, struct.error):
+                return None
+            firmware = self.firmwares.get((fw_type, fw_version))
+            if firmware is None or block >= firmware.blocks:
+                return None
+            self.progress[msg.node_id] = block
+            if block == 0 and self.updates.get(msg.node_id) == (fw_type, fw_version):
+                # Blocks are requested from the last to the first one.
+                with self.lock:
+                    self.updates.pop(msg.node_id, None)
+            return msg.copy(sub_type=stream.ST_FIRMWARE_RESPONSE, payload=firmware.block(block))
+
+        return None
+
+
+def _encode(data):
+    return binascii.hexlify(data).decode("ascii").upper()
+
+
+class FirmwareError(Exception):
+    def __init__(self, *args, **kwargs):
+        super(FirmwareError, self).__init__(*args, **kwargs)
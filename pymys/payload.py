@@ -0,0 +1,99 @@
+"""
+pymys - Conversion of set/req payloads to native types
+"""
+
+
+def to_bool(payload):
+    return int(payload) != 0
+
+
+def to_number(payload):
+    """ Returns an int if the payload is an integer, otherwise a float. """
+    try:
+        return int(payload)
+    except ValueError:
+        return float(payload)
+
+
+def to_bytes(payload):
+    """ Converts hex colors such as "ff0000" to bytes. """
+    return bytes.fromhex(payload)
+
+
+def to_position(payload):
+    """ Converts a "latitude;longitude;altitude" position to a tuple of floats. """
+    return tuple(float(f) for f in payload.split(";"))
+
+
+# Converters by SetReq name, every other value type is kept as str.
+CODECS = {
+    'V_TEMP': float,
+    'V_HUM': float,
+    'V_STATUS': to_bool,
+    'V_PERCENTAGE': to_number,
+    'V_PRESSURE': float,
+    'V_RAIN': float,
+    'V_RAINRATE': float,
+    'V_WIND': float,
+    'V_GUST': float,
+    'V_DIRECTION': float,
+    'V_UV': float,
+    'V_WEIGHT': float,
+    'V_DISTANCE': float,
+    'V_IMPEDANCE': float,
+    'V_ARMED': to_bool,
+    'V_TRIPPED': to_bool,
+    'V_WATT': float,
+    'V_KWH': float,
+    'V_SCENE_ON': to_number,
+    'V_SCENE_OFF': to_number,
+    'V_LIGHT_LEVEL': to_number,
+    'V_FLOW': float,
+    'V_VOLUME': float,
+    'V_LOCK_STATUS': to_bool,
+    'V_LEVEL': to_number,
+    'V_VOLTAGE': float,
+    'V_CURRENT': float,
+    'V_RGB': to_bytes,
+    'V_RGBW': to_bytes,
+    'V_HVAC_SETPOINT_COOL': to_number,
+    'V_HVAC_SETPOINT_HEAT': to_number,
+    'V_POSITION': to_position,
+    'V_PH': float,
+    'V_ORP': float,
+    'V_EC': float,
+    'V_VA': float,
+    'V_POWER_FACTOR': float,
+}
+
+_tables = {}
+
+
+def codec_table(const):
+    """
+      Returns a tuple indexed by the SetReq values of a protocol module with the converter of each
+      value type (None for the ones kept as str). Tables are built once per module.
+    """
+    table = _tables.get(const.__name__)
+    if table is None:
+        set_req = const.sub_types[const.MessageType.C_SET]
+        table = tuple(CODECS.get(member.name) if member is not None else None for member in set_req)
+        _tables[const.__name__] = table
+
+    return table
+
+
+def decode(const, value_type, payload):
+    """
+      Converts a payload to the native type of value_type.
+      Payloads that cannot be converted are returned unchanged.
+    """
+    table = codec_table(const)
+    codec = table[value_type] if 0 <= value_type < len(table) else None
+    if codec is None or not payload:
+        return payload
+
+    try:
+        return codec(payload)
+    except ValueError:
+        return payload
@@ -0,0 +1,164 @@
+"""
+pymys - Persistence of nodes and sensors
+"""
+
+import json
+import os
+from threading import Lock, Timer
+
+
+class StateStore(object):
+    """
+      Base implementation for a store of the Gateway's state.
+      The state is a dictionary with 'protocol_version', 'nodes' (as returned by Gateway.snapshot, with
+      enums as ints and only raw_values) and 'id_allocator'. Changes between snapshots are recorded as operations:
+        ('node', node_id, fields)                        Node fields updated
+        ('sensor', node_id, sensor_id, type)             Sensor presented
+        ('value', node_id, sensor_id, value_type, value) Sensor raw value set
+    """
+
+    def load(self):
+        """
+          Loads the last saved state with every recorded operation applied.
+          :return: State dictionary or None if nothing was saved yet.
+        """
+        raise NotImplementedError
+
+    def record(self, *operation):
+        """ Records an operation that changed the state. """
+        raise NotImplementedError
+
+    def compact(self, state):
+        """ Saves a full state, discarding the operations recorded before it. """
+        raise NotImplementedError
+
+    def needs_compaction(self):
+        return False
+
+    def close(self):
+        pass
+
+
+class JsonStore(StateStore):
+    """
+      Keeps the state in a JSON snapshot file and an append-only journal with one JSON operation per line.
+      Operations are flushed to the journal at most flush_interval seconds after they are recorded (0 flushes
+      every operation), and needs_compaction is true after compact_every operations.
+      A journal line torn by a crash is truncated by load, so the operations recorded after it are kept.
+    """
+
+    def __init__(self, path, compact_every=10000, flush_interval=1.0):
+        self.path = path
+        self.journal_path = path + ".journal"
+        self.compact_every = compact_every
+        self.flush_interval = flush_interval
+        self._journal = None
+        self._records = 0
+        self._flush_timer = None
+        self.lock = Lock()
+
+    def load(self):
+        state = None
+        if os.path.exists(self.path):
+            with open(self.path) as f:
+                state = json.load(f)
+            state['nodes'] = {int(k): _load_node(v) for k, v in state['nodes'].items()}
+
+        if os.path.exists(self.journal_path):
+            if state is None:
+                state = {'protocol_version': None, 'nodes': {}, 'id_allocator': None}
+            valid = 0
+            with open(self.journal_path, 'rb') as f:
+                for line in f:
+                    try:
+                        if not line.endswith(b"\n"):
+                            raise ValueError("Incomplete line")
+                        operation = json.loads(line.decode("utf-8"))
+                    except ValueError:
+                        # A partially written line is the last thing written before a crash.
+                        break
+                    apply_operation(state['nodes'], operation)
+                    self._records += 1
+                    valid += len(line)
+            if valid < os.path.getsize(self.journal_path):
+                # Operations appended after the torn line would never be read.
+                with open(self.journal_path, 'r+b') as f:
+                    f.truncate(valid)
+
+        return state
+
+    def record(self, *operation):
+        line = json.dumps(operation, separators=(',', ':')) + "\n"
+        with self.lock:
+            if self._journal is None:
+                self._journal = open(self.journal_path, 'a')
+            self._journal.write(line)
+            self._records += 1
+            if not self.flush_interval:
+                self._journal.flush()
+            elif self._flush_timer is None:
+                self._flush_timer = Timer(self.flush_interval, self.flush)
+                self._flush_timer.daemon = True
+                self._flush_timer.start()
+
+    def compact(self, state):
+        state = dict(state)
+        state['nodes'] = {str(k): v for k, v in state['nodes'].items()}
+        temp_path = self.path + ".tmp"
+        with self.lock:
+            with open(temp_path, 'w') as f:
+                json.dump(state, f, separators=(',', ':'))
+            os.replace(temp_path, self.path)
+            if self._journal is not None:
+                self._journal.close()
+            self._journal = open(self.journal_path, 'w')
+            self._records = 0
+
+    def needs_compaction(self):
+        return self._records >= self.compact_every
+
+    def flush(self):
+        with self.lock:
+            self._flush_timer = None
+            if self._journal is not None:
+                self._journal.flush()
+
+    def close(self):
+        with self.lock:
+            if self._flush_timer is not None:
+                self._flush_timer.cancel()
+                self._flush_timer = None
+            if self._journal is not None:
+                self._journal.close()
+                self._journal = None
+
+
+def apply_operation(nodes, operation):
+    """ Applies a recorded operation to a dictionary of node states. """
+    kind, node_id = operation[0], operation[1]
+    node = nodes.get(node_id)
+    if node is None:
+        node = nodes[node_id] = {'id': node_id, 'sketch_name': "", 'sketch_version': 0.0, 'battery_level': 0,
+                                 'sensors': {}}
+
+    if kind == 'node':
+        node.update(operation[2])
+    elif kind == 'sensor':
+        sensor_id = operation[2]
+        sensor = node['sensors'].setdefault(sensor_id, {'id': sensor_id, 'type': operation[3], 'raw_values': {}})
+        sensor['type'] = operation[3]
+    elif kind == 'value':
+        sensor = node['sensors'].get(operation[2])
+        if sensor is not None:
+            sensor['raw_values'][operation[3]] = operation[4]
+
+
+def _load_node(node):
+    # JSON turns int keys into strings.
+    sensors = {}
+    for sensor_id, sensor in node['sensors'].items():
+        sensor['raw_values'] = {int(k): v for k, v in sensor['raw_values'].items()}
+        sensors[int(sensor_id)] = sensor
+    node['sensors'] = sensors
+
+    return node
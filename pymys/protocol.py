@@ -0,0 +1,109 @@
+"""
+pymys - Protocol modules and their dispatch tables
+"""
+
+import importlib
+from threading import Lock
+
+from pymys import payload
+
+# Registry of the protocol modules by major.minor version. Modules given by name are imported when
+# they are first used. See register.
+MODULES = {
+    1.5: 'pymys.mys_15',
+    1.6: 'pymys.mys_16',
+    2.0: 'pymys.mys_20',
+}
+
+_tables = {}
+_lock = Lock()
+
+
+def parse_version(value):
+    """ Returns the major.minor float of a version, e.g. 2.3 for "2.3.2". """
+    if isinstance(value, (int, float)):
+        return float(value)
+
+    parts = str(value).strip().split(".")
+    try:
+        return float("{}.{}".format(int(parts[0]), int(parts[1]) if len(parts) > 1 else 0))
+    except ValueError:
+        raise UnsupportedProtocolError("Invalid protocol version: {}".format(value))
+
+
+def register(version, module):
+    """
+      Registers the module of a protocol version.
+      :param version: Version the module implements, later minor versions without a module of their own use it.
+      :param module: Protocol module or its import name. It must define MessageType, Presentation, SetReq,
+                     Internal, Stream and the message_types and sub_types lookup tables (see mys_16).
+    """
+    with _lock:
+        MODULES[parse_version(version)] = module
+
+
+def find(version):
+    """
+      Returns the registered version implementing a version: itself, or else the latest lower
+      registered version with the same major version.
+      :return: The version or None if the version is not supported.
+    """
+    version = parse_version(version)
+    if version in MODULES:
+        return version
+
+    candidates = [v for v in MODULES if int(v) == int(version) and v < version]
+
+    return max(candidates) if candidates else None
+
+
+def load(version):
+    """
+      Returns the protocol module of a version, importing it if needed.
+      :raise UnsupportedProtocolError: If no registered module implements the version.
+    """
+    registered = find(version)
+    if registered is None:
+        raise UnsupportedProtocolError("Protocol version {} is not supported.".format(version))
+
+    module = MODULES[registered]
+    if isinstance(module, str):
+        module = importlib.import_module(module)
+
+    return module
+
+
+class DispatchTable(object):
+    """
+      Lookup tables of a protocol module, built once and shared by every gateway using it.
+      They are tuples indexed by the values of the protocol's enums:
+        message_types   MessageType members
+        sub_types       Tuple of sub-type members for each message type
+        handlers        Name of the Gateway method handling each message type
+        codecs          Payload converter of each SetReq value type (see payload.codec_table)
+    """
+
+    def __init__(self, const):
+        self.const = const
+        self.message_types = const.message_types
+        self.sub_types = const.sub_types
+        self.handlers = tuple(member.name.split("_", 1)[1].lower() if member is not None else None
+                              for member in const.message_types)
+        self.codecs = payload.codec_table(const)
+
+
+def dispatch_table(const):
+    """ Returns the DispatchTable of a protocol module, building it on first use. """
+    table = _tables.get(const.__name__)
+    if table is None:
+        with _lock:
+            table = _tables.get(const.__name__)
+            if table is None:
+                table = _tables[const.__name__] = DispatchTable(const)
+
+    return table
+
+
+class UnsupportedProtocolError(Exception):
+    def __init__(self, *args, **kwargs):
+        super(UnsupportedProtocolError, self).__init__(*args, **kwargs)
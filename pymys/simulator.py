@@ -0,0 +1,225 @@
+"""
+pymys - Simulated serial gateway with a network of virtual nodes
+"""
+
+import heapq
+import random
+import time
+from collections import deque
+from threading import Condition
+
+from pymys import mys_16
+from pymys import payload
+
+
+class SimulatedNode(object):
+    """
+      Virtual node which presents itself and its sensors, then reports a value of each sensor every
+      interval seconds. A node without node_id asks the gateway for one (I_ID_REQUEST) first.
+    """
+
+    def __init__(self, node_id=None, sensors=(('S_TEMP', 'V_TEMP'),), interval=60.0, sketch_name="Simulated node",
+                 sketch_version="1.0", battery_level=None):
+        """
+          :param sensors: (Presentation name, SetReq name) of each sensor, their IDs are their indexes.
+          :param interval: Seconds between two reports of a sensor.
+        """
+        self.id = node_id
+        self.sensors = tuple(sensors)
+        self.interval = interval
+        self.sketch_name = sketch_name
+        self.sketch_version = sketch_version
+        self.battery_level = battery_level
+        self.values = {}
+        self.reboots = 0
+        self.generation = 0
+
+
+def simulated_nodes(count, sensors=(('S_TEMP', 'V_TEMP'),), interval=60.0, first_id=1, request_ids=False):
+    """ Returns count nodes with the same sensors, numbered from first_id unless they request their IDs. """
+    return [SimulatedNode(None if request_ids else first_id + i, sensors, interval) for i in range(count)]
+
+
+class SimulatedSerial(object):
+    """
+      Stand-in for serial.Serial which emulates a gateway and its nodes.
+      It answers the version query, hands the IDs sent in I_ID_RESPONSE to the nodes which requested one,
+      echoes messages with the ack flag, applies C_SET and answers C_REQ with the node's values.
+      In realtime mode reports are read when they are due, otherwise time is virtual and reports are
+      read as fast as the gateway can handle them.
+    """
+
+    def __init__(self, nodes=(), const=mys_16, protocol_version="1.6", realtime=True, timeout=1.0, seed=None):
+        self.const = const
+        self.protocol_version = protocol_version
+        self.realtime = realtime
+        self.timeout = timeout
+        self.nodes = {}
+        self.waiting_id = deque()
+        self.lines_read = 0
+        self.lines_written = 0
+        self.dropped = 0
+        self.is_open = True
+        self._output = deque()
+        self._events = []
+        self._sequence = 0
+        self._now = 0.0
+        self._random = random.Random(seed)
+        self._condition = Condition()
+
+        internal = const.Internal
+        self._emit(0, 0, const.MessageType.C_INTERNAL, internal.I_GATEWAY_READY, "Gateway startup complete.")
+        for node in nodes:
+            self.add_node(node)
+
+    def open(self, **kwargs):
+        """ Factory for SerialGateway's serial_factory, the serial parameters are ignored but the timeout. """
+        with self._condition:
+            self.timeout = kwargs.get('timeout', self.timeout)
+            self.is_open = True
+
+        return self
+
+    def add_node(self, node):
+        with self._condition:
+            if node.id is None:
+                self.waiting_id.append(node)
+                internal = self.const.Internal
+                self._emit(255, 255, self.const.MessageType.C_INTERNAL, internal.I_ID_REQUEST, "")
+            else:
+                self._start(node)
+            self._condition.notify()
+
+    def _time(self):
+        return time.monotonic() if self.realtime else self._now
+
+    def _emit(self, node_id, sensor_id, msg_type, sub_type, value, ack=0):
+        line = "{};{};{};{};{};{}\n".format(node_id, sensor_id, int(msg_type), ack, int(sub_type), value)
+        self._output.append(line.encode("utf-8"))
+
+    def _start(self, node):
+        """ Presents a node and schedules its reports. """
+        const = self.const
+        presentation, internal = const.MessageType.C_PRESENTATION, const.MessageType.C_INTERNAL
+        self.nodes[node.id] = node
+        self._emit(node.id, 255, presentation, const.Presentation.S_ARDUINO_NODE, self.protocol_version)
+        self._emit(node.id, 255, internal, const.Internal.I_SKETCH_NAME, node.sketch_name)
+        self._emit(node.id, 255, internal, const.Internal.I_SKETCH_VERSION, node.sketch_version)
+        for sensor_id, (sensor_type, value_type) in enumerate(node.sensors):
+            self._emit(node.id, sensor_id, presentation, const.Presentation[sensor_type], "")
+            node.values[(sensor_id, int(const.SetReq[value_type]))] = self._value(value_type)
+        if node.battery_level is not None:
+            self._emit(node.id, 255, internal, const.Internal.I_BATTERY_LEVEL, node.battery_level)
+
+        # Reports scheduled before a reboot are discarded.
+        node.generation += 1
+        now = self._time()
+        for sensor_id in range(len(node.sensors)):
+            # Spreads the first reports over an interval so nodes do not report in lockstep.
+            self._schedule(now + self._random.random() * node.interval, node, sensor_id)
+
+    def _schedule(self, due, node, sensor_id):
+        self._sequence += 1
+        heapq.heappush(self._events, (due, self._sequence, node, sensor_id, node.generation))
+
+    def _value(self, value_type):
+        codec = payload.CODECS.get(value_type)
+        if codec is float:
+            return "{:.1f}".format(self._random.uniform(0, 100))
+        if codec is payload.to_bool:
+            return str(self._random.randint(0, 1))
+        if codec is payload.to_number:
+            return str(self._random.randint(0, 100))
+        if codec is payload.to_bytes:
+            return "{:06x}".format(self._random.getrandbits(24))
+        if codec is payload.to_position:
+            return "{:.6f};{:.6f};0".format(self._random.uniform(-90, 90), self._random.uniform(-180, 180))
+
+        return str(self._random.randint(0, 100))
+
+    def _report(self, node, sensor_id):
+        value_type = self.const.SetReq[node.sensors[sensor_id][1]]
+        value = node.values[(sensor_id, int(value_type))] = self._value(value_type.name)
+        self._emit(node.id, sensor_id, self.const.MessageType.C_SET, value_type, value)
+
+    def readline(self):
+        """ Returns the next line of the gateway, or b"" if nothing is due before the timeout. """
+        with self._condition:
+            deadline = time.monotonic() + (self.timeout if self.timeout is not None else float('inf'))
+            while True:
+                if self._output:
+                    self.lines_read += 1
+                    return self._output.popleft()
+                if not self.is_open:
+                    return b""
+                now = time.monotonic()
+                if self._events:
+                    due, _, node, sensor_id, generation = self._events[0]
+                    if not self.realtime or due <= now:
+                        heapq.heappop(self._events)
+                        if generation == node.generation and self.nodes.get(node.id) is node:
+                            self._now = max(self._now, due)
+                            self._report(node, sensor_id)
+                            self._schedule(due + node.interval, node, sensor_id)
+                        continue
+                    wait = min(due, deadline) - now
+                else:
+                    wait = deadline - now
+                if now >= deadline:
+                    return b""
+                self._condition.wait(wait if wait != float('inf') else None)
+
+    def write(self, data):
+        """ Handles the messages written by the gateway. """
+        with self._condition:
+            for line in bytes(data).decode("utf-8").splitlines():
+                if line:
+                    self._handle(line)
+            self._condition.notify()
+
+        return len(data)
+
+    def _handle(self, line):
+        self.lines_written += 1
+        try:
+            node_id, sensor_id, msg_type, ack, sub_type, value = line.split(";", 5)
+            node_id, sensor_id, msg_type, ack, sub_type = (int(node_id), int(sensor_id), int(msg_type), int(ack),
+                                                          int(sub_type))
+        except ValueError:
+            self.dropped += 1
+            return
+
+        const = self.const
+        internal = const.Internal
+        if msg_type == const.MessageType.C_INTERNAL:
+            if node_id == 0 and sub_type == internal.I_VERSION:
+                self._emit(0, 0, msg_type, internal.I_VERSION, self.protocol_version)
+                return
+            if node_id == 255 and sub_type == internal.I_ID_RESPONSE:
+                if self.waiting_id:
+                    node = self.waiting_id.popleft()
+                    node.id = int(value)
+                    self._start(node)
+                return
+
+        node = self.nodes.get(node_id)
+        if node is None:
+            self.dropped += 1
+            return
+        if ack:
+            self._emit(node_id, sensor_id, msg_type, sub_type, value, ack)
+
+        if msg_type == const.MessageType.C_SET:
+            node.values[(sensor_id, sub_type)] = value
+            self._emit(node_id, sensor_id, msg_type, sub_type, value)
+        elif msg_type == const.MessageType.C_REQ:
+            if (sensor_id, sub_type) in node.values:
+                self._emit(node_id, sensor_id, const.MessageType.C_SET, sub_type, node.values[(sensor_id, sub_type)])
+        elif msg_type == const.MessageType.C_INTERNAL and sub_type == internal.I_REBOOT:
+            node.reboots += 1
+            self._start(node)
+
+    def close(self):
+        with self._condition:
+            self.is_open = False
+            self._condition.notify_all()
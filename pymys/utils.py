@@ -1,5 +1,8 @@
+import time
+from collections.abc import MutableMapping
 from queue import Queue
-from threading import Lock
+from threading import Event, Lock, Thread
+from types import MappingProxyType
 
 
 class IndexableQueue(Queue):
@@ -7,6 +10,234 @@ class IndexableQueue(Queue):
         with self.mutex:
             return self.queue[index]
 
+    def put_drop_oldest(self, item):
+        """
+          Puts an item without blocking. If the queue is full, the oldest item is discarded.
+          :return: The discarded item or None.
+        """
+        with self.not_full:
+            dropped = None
+            if 0 < self.maxsize <= self._qsize():
+                dropped = self._get()
+                self.unfinished_tasks -= 1
+            self._put(item)
+            self.unfinished_tasks += 1
+            self.not_empty.notify()
+
+        return dropped
+
+
+class LineBuffer(object):
+    """ Reusable receive buffer which frames newline terminated lines from a byte stream. """
+
+    def __init__(self, size=4096):
+        self._chunk = memoryview(bytearray(size))
+        self._data = bytearray()
+
+    def fill(self, recv_into):
+        """
+          Reads once into the internal chunk and appends it to the pending data.
+          :param recv_into: A function like socket.recv_into.
+          :return: Number of bytes read, 0 means end of stream.
+        """
+        size = recv_into(self._chunk)
+        if size:
+            self._data += self._chunk[:size]
+
+        return size
+
+    def feed(self, data):
+        self._data += data
+
+    def readline(self):
+        """ Returns the next complete line (with its newline) or None if there is none yet. """
+        index = self._data.find(b"\n")
+        if index < 0:
+            return None
+
+        line = bytes(self._data[:index + 1])
+        del self._data[:index + 1]
+
+        return line
+
+    def clear(self):
+        del self._data[:]
+
+    def __len__(self):
+        return len(self._data)
+
+
+class CopyOnWriteDict(MutableMapping):
+    """
+      Dictionary for many readers and few writers.
+      Reads never lock: writers copy the data, change the copy and publish it, so the published
+      dictionary is never modified and iterating it is always done over a consistent snapshot.
+    """
+
+    def __init__(self, *args, **kwargs):
+        self.lock = Lock()
+        self._data = dict(*args, **kwargs)
+
+    def __getitem__(self, key):
+        return self._data[key]
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def __iter__(self):
+        return iter(self._data)
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key, default=None):
+        return self._data.get(key, default)
+
+    def keys(self):
+        return self._data.keys()
+
+    def values(self):
+        return self._data.values()
+
+    def items(self):
+        return self._data.items()
+
+    def __setitem__(self, key, value):
+        with self.lock:
+            data = self._data.copy()
+            data[key] = value
+            self._data = data
+
+    def __delitem__(self, key):
+        with self.lock:
+            data = self._data.copy()
+            del data[key]
+            self._data = data
+
+    def update(self, *args, **kwargs):
+        """ Updates several keys at once, readers see either none or all of them. """
+        with self.lock:
+            data = self._data.copy()
+            data.update(*args, **kwargs)
+            self._data = data
+
+    def setdefault(self, key, default=None):
+        """ Atomically returns the value of key, setting it to default if it is not present. """
+        with self.lock:
+            if key in self._data:
+                return self._data[key]
+            data = self._data.copy()
+            data[key] = default
+            self._data = data
+
+        return default
+
+    def snapshot(self):
+        """ Returns a read-only view of the current data, which later writes do not change. """
+        return MappingProxyType(self._data)
+
+    def __repr__(self):
+        return repr(self._data)
+
+
+class Timer(object):
+    """ Timer scheduled on a TimerWheel. """
+
+    __slots__ = ('tick', 'callback', 'args', 'cancelled')
+
+    def __init__(self, tick, callback, args):
+        self.tick = tick
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+
+
+class TimerWheel(object):
+    """
+      Hashed timer wheel.
+      Timers are kept in slots of tick seconds, so scheduling and cancelling are O(1), and a single thread
+      fires every timer instead of one thread or threading.Timer per timer. The thread is started by
+      the first schedule.
+    """
+
+    def __init__(self, tick=0.05, slots=512):
+        self.tick = tick
+        self.slots = slots
+        self._wheel = [{} for _ in range(slots)]
+        self._current = int(time.monotonic() / tick)
+        self._thread = None
+        self._stopping = Event()
+        self.last_error = None
+        self.lock = Lock()
+
+    def schedule(self, delay, callback, *args):
+        """
+          Calls callback(*args) from the wheel's thread after delay seconds (rounded up to a tick).
+          :return: Timer which can be cancelled.
+        """
+        tick = -int(-(time.monotonic() + delay) // self.tick)
+        timer = Timer(tick, callback, args)
+        with self.lock:
+            tick = max(tick, self._current + 1)
+            timer.tick = tick
+            self._wheel[tick % self.slots][id(timer)] = timer
+        if self._thread is None:
+            self.start()
+
+        return timer
+
+    def cancel(self, timer):
+        with self.lock:
+            timer.cancelled = True
+            self._wheel[timer.tick % self.slots].pop(id(timer), None)
+
+    def advance(self, now=None):
+        """ Fires every timer due until now. It is called by the wheel's thread. """
+        if now is None:
+            now = time.monotonic()
+
+        expired = []
+        with self.lock:
+            last = int(now / self.tick)
+            # After a long pause, every slot is visited only once.
+            first = max(self._current + 1, last - self.slots + 1)
+            for tick in range(first, last + 1):
+                slot = self._wheel[tick % self.slots]
+                for key, timer in list(slot.items()):
+                    if timer.tick <= last:
+                        del slot[key]
+                        expired.append(timer)
+            self._current = max(self._current, last)
+
+        for timer in sorted(expired, key=lambda t: t.tick):
+            if not timer.cancelled:
+                try:
+                    timer.callback(*timer.args)
+                except Exception as err:
+                    # The wheel's thread must keep running for the other timers.
+                    self.last_error = err
+
+    def start(self):
+        with self.lock:
+            if self._thread is not None:
+                return
+            self._stopping.clear()
+            self._thread = Thread(target=self._run, name="pymys-timers", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopping.set()
+        thread, self._thread = self._thread, None
+        if thread is not None:
+            thread.join()
+
+    def _run(self):
+        while not self._stopping.wait(self.tick):
+            self.advance()
+
+    def __len__(self):
+        return sum(len(slot) for slot in self._wheel)
+
 
 class DictThreadSafe(dict):
     def __init__(self, *args, **kwargs):
@@ -26,3 +257,15 @@ class DictThreadSafe(dict):
         self.lock.acquire()
         dict.__setitem__(self, key, value)
         self.lock.release()
+
+
+def enum_table(enum_class):
+    """
+      Builds a tuple indexed by value which maps ints to the members of an IntEnum.
+      Aliases resolve to their canonical member and gaps are None.
+    """
+    table = [None] * (max(enum_class) + 1)
+    for member in enum_class:
+        table[member] = member
+
+    return tuple(table)
@@ -0,0 +1,179 @@
+"""
+pymys - Batched writes of outgoing messages
+"""
+
+import queue
+import time
+from threading import Lock, Thread
+
+
+class RateLimiter(object):
+    """
+      Token bucket limiting the number of messages sent per second.
+      Up to burst messages may be sent at once, after which they are let through at rate per second.
+    """
+
+    def __init__(self, rate, burst=None):
+        if rate <= 0:
+            raise ValueError("rate must be positive.")
+        self.rate = float(rate)
+        self.burst = burst if burst is not None else max(1, int(rate))
+        self._tokens = float(self.burst)
+        self._updated = time.monotonic()
+        self.lock = Lock()
+
+    def _refill(self, now):
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def take(self, n, now=None):
+        """
+          Takes up to n tokens.
+          :return: Number of messages which may be sent now.
+        """
+        with self.lock:
+            self._refill(time.monotonic() if now is None else now)
+            granted = min(n, int(self._tokens))
+            self._tokens -= granted
+
+        return granted
+
+    def release(self, n):
+        """ Gives back tokens taken but not used. """
+        with self.lock:
+            self._tokens = min(self.burst, self._tokens + n)
+
+    def delay(self, now=None):
+        """ Returns the seconds to wait before a message may be sent. """
+        with self.lock:
+            self._refill(time.monotonic() if now is None else now)
+            return 0.0 if self._tokens >= 1 else (1 - self._tokens) / self.rate
+
+
+class WriterStats(object):
+    """ Counters of a BatchWriter. Latencies are the seconds messages waited in the queue. """
+
+    def __init__(self):
+        self.batches = 0
+        self.messages = 0
+        self.max_batch_size = 0
+        self.queue_latency = 0.0
+        self.max_queue_latency = 0.0
+        self.errors = 0
+        self.last_error = None
+
+    @property
+    def mean_batch_size(self):
+        return self.messages / self.batches if self.batches else 0.0
+
+    @property
+    def mean_queue_latency(self):
+        return self.queue_latency / self.messages if self.messages else 0.0
+
+    def __str__(self):
+        return "BATCHES: {s.batches} | MESSAGES: {s.messages} | MEAN BATCH SIZE: {s.mean_batch_size:.1f} | "\
+               "MEAN QUEUE LATENCY: {s.mean_queue_latency:.6f}s | ERRORS: {s.errors}".format(s=self)
+
+
+class BatchWriter(object):
+    """
+      Writes outgoing messages from a thread, many of them per write.
+      Queued messages are encoded into a reusable bytearray and written together, up to max_batch
+      messages at once, and optionally no faster than a RateLimiter allows.
+    """
+
+    def __init__(self, write, max_batch=64, rate_limiter=None, queue_size=0):
+        """
+          :param write: Function which writes bytes to the interface.
+          :param max_batch: Maximum number of messages per write.
+          :param rate_limiter: RateLimiter applied to the messages, or None.
+          :param queue_size: Maximum number of queued messages, 0 for no limit.
+        """
+        self.write = write
+        self.max_batch = max_batch
+        self.rate_limiter = rate_limiter
+        self.queue = queue.Queue(queue_size)
+        self.stats = WriterStats()
+        self._buffer = bytearray()
+        self._thread = None
+
+    def put(self, msg):
+        """ Queues a message to be written. """
+        self.queue.put((msg, time.monotonic()))
+
+    def start(self):
+        if self._thread is None:
+            self._thread = Thread(target=self._run, name="pymys-writer", daemon=True)
+            self._thread.start()
+
+    def stop(self, timeout=None):
+        """ Stops the writer thread once every queued message is written. """
+        if self._thread is not None:
+            self.queue.put(None)
+            self._thread.join(timeout)
+            self._thread = None
+
+    @property
+    def running(self):
+        return self._thread is not None
+
+    def _run(self):
+        stopping = False
+        while not stopping:
+            item = self.queue.get()
+            if item is None:
+                break
+            batch = [item]
+            limit = self.max_batch
+            if self.rate_limiter is not None:
+                limit = self.rate_limiter.take(self.max_batch)
+                while not limit:
+                    time.sleep(self.rate_limiter.delay())
+                    limit = self.rate_limiter.take(self.max_batch)
+            while len(batch) < limit:
+                try:
+                    item = self.queue.get(block=False)
+                except queue.Empty:
+                    break
+                if item is None:
+                    stopping = True
+                    break
+                batch.append(item)
+            if self.rate_limiter is not None and len(batch) < limit:
+                self.rate_limiter.release(limit - len(batch))
+            self._flush(batch)
+
+        # Messages queued after stop are written at once.
+        batch = []
+        while True:
+            try:
+                item = self.queue.get(block=False)
+            except queue.Empty:
+                break
+            if item is not None:
+                batch.append(item)
+        if batch:
+            self._flush(batch)
+
+    def _flush(self, batch):
+        now = time.monotonic()
+        buffer = self._buffer
+        del buffer[:]
+        for msg, _ in batch:
+            msg.encode_into(buffer)
+        try:
+            self.write(buffer)
+        except Exception as err:
+            self.stats.errors += 1
+            self.stats.last_error = err
+            return
+
+        stats = self.stats
+        stats.batches += 1
+        stats.messages += len(batch)
+        stats.max_batch_size = max(stats.max_batch_size, len(batch))
+        for _, queued in batch:
+            latency = now - queued
+            stats.queue_latency += latency
+            if latency > stats.max_queue_latency:
+                stats.max_queue_latency = latency
@@ -10,7 +10,12 @@ CLASSIFIERS = [
     "Operating System :: POSIX :: Linux",
     "Programming Language :: Python",
     "Programming Language :: Python :: 3",
-    "Programming Language :: Python :: 3.4",
+    "Programming Language :: Python :: 3 :: Only",
+    "Programming Language :: Python :: 3.7",
+    "Programming Language :: Python :: 3.8",
+    "Programming Language :: Python :: 3.9",
+    "Programming Language :: Python :: 3.10",
+    "Programming Language :: Python :: 3.11",
     "Topic :: Software Development :: Libraries :: Python Modules",
     ]
 
@@ -29,4 +34,6 @@ setup(name='pymys',
       long_description=read('DESCRIPTION.rst'),
       classifiers=CLASSIFIERS,
       packages=['pymys'],
-      install_requires=['pyserial'],)
\ No newline at end of file
+      python_requires='>=3.7',
+      install_requires=['pyserial'],
+      extras_require={'asyncio': ['pyserial-asyncio']},)
\ No newline at end of file
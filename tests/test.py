@@ -1,7 +1,34 @@
+import asyncio
+import io
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
 import unittest
 from unittest import mock
 
+import pymys
+from pymys import aio
+from pymys import payload
+from pymys import protocol
 from pymys import mysensors as mys
+from pymys import utils
+from pymys import writer
+from pymys.ack import AckTimeoutError
+from pymys.capture import INVALID, CaptureError, CaptureWriter, MappedCapture, ReplayGateway, read_capture
+from pymys.allocator import NodeIdAllocator, NoFreeIdError
+from pymys.events import CHANGED, OFFLINE, ONLINE, EventBus
+from pymys.history import History
+from pymys.manager import GatewayManager
+from pymys.metrics import GatewayMetrics
+from pymys.ota import Firmware, FirmwareError, crc16, parse_hex
+from pymys.persistence import JsonStore
+from pymys.protocol import UnsupportedProtocolError
+from pymys.simulator import SimulatedSerial, simulated_nodes
 
 
 class TestGateway(unittest.TestCase):
@@ -9,19 +36,71 @@ class TestGateway(unittest.TestCase):
         self.gw = mys.Gateway()
 
     def testChangeProtocolVersion(self):
-        self.gw.protocol_version = 1.4
-        self.assertEqual(self.gw.protocol_version, 1.4)
-        self.assertIs(self.gw.const, mys.mys_14)
+        self.gw.protocol_version = "1.5"
+        self.assertEqual(self.gw.protocol_version, 1.5)
+        self.assertIs(self.gw.const, mys.mys_15)
 
         self.gw.protocol_version = 1.6
         self.assertEqual(self.gw.protocol_version, 1.6)
         self.assertIs(self.gw.const, mys.mys_16)
 
+        self.gw.protocol_version = "2.3.2"
+        self.assertEqual(self.gw.protocol_version, 2.3)
+        self.assertIs(self.gw.const, mys.mys_20)
+
+    def testDispatchTableShared(self):
+        self.gw = mys.Gateway(protocol_version=1.6)
+        other = mys.Gateway(protocol_version=1.6)
+        self.assertIs(protocol.dispatch_table(self.gw.const), protocol.dispatch_table(other.const))
+        for gw in (self.gw, other):
+            gw._dispatch(b"1;255;0;0;17;1.6\n")
+            gw._dispatch(b"1;0;0;0;6;\n")
+            gw._dispatch(b"1;0;1;0;0;21.5\n")
+            gw._dispatch(b"1;0;1;0;2;x\n")
+        self.assertEqual(self.gw[1][0].values, {mys.mys_16.SetReq.V_TEMP: 21.5, mys.mys_16.SetReq.V_STATUS: "x"})
+        self.assertEqual(self.gw[1][0].values, other[1][0].values)
+        self.assertEqual(self.gw.callbacks[mys.mys_16.MessageType.C_SET], self.gw.set)
+        self.assertEqual(other.callbacks[mys.mys_16.MessageType.C_SET], other.set)
+
+    def testLazyProtocolImport(self):
+        code = "import sys, pymys.mysensors; print('pymys.mys_15' in sys.modules, 'concurrent.futures' in sys.modules)"
+        output = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, check=True).stdout
+        self.assertEqual(output.split(), ["False", "False"])
+
     def testAcessNotPresentNode(self):
         pass
 
     def testNotSupportedProtocol(self):
-        pass
+        self.gw.protocol_version = 1.6
+        with self.assertRaises(UnsupportedProtocolError):
+            self.gw.protocol_version = 1.4
+        self.assertEqual(self.gw.protocol_version, 1.6)
+        self.assertIs(self.gw.const, mys.mys_16)
+        with self.assertRaises(UnsupportedProtocolError):
+            mys.Gateway(protocol_version="3.0")
+
+    def testRegisterProtocol(self):
+        self.addCleanup(protocol.MODULES.pop, 2.9)
+        protocol.register("2.9", mys.mys_16)
+        self.assertIs(protocol.load("2.9.1"), mys.mys_16)
+        self.assertIs(protocol.load("2.8"), mys.mys_20)
+
+    def testInternal2x(self):
+        gw = mys.Gateway(protocol_version="2.3.2")
+        gw.nodes = {1: mys.Node(1)}
+        gw._dispatch(b"1;255;3;0;22;42\n")
+        gw._dispatch(b"1;255;3;0;21;5\n")
+        self.assertEqual(gw[1].heartbeat, 42)
+        self.assertEqual(gw[1].parent_id, 5)
+        for line in (b"1;255;3;0;22;x\n", b"1;255;3;0;21;\n", b"1;255;3;0;0;full\n", b"1;255;3;0;12;v1\n"):
+            with self.assertRaises(mys.BadMessageError):
+                gw._dispatch(line)
+        self.assertEqual(gw[1].heartbeat, 42)
+        self.assertEqual(gw[1].battery_level, 0)
+        gw._dispatch(b"255;255;3;0;22;1\n")
+        self.assertNotIn(255, gw.nodes)
+        gw._dispatch(b"1;255;3;0;28;debug\n")
+        self.assertEqual(gw.log_queue.get_nowait().payload, "debug")
 
     def testNotSupportedMessageType(self):
         pass
@@ -38,6 +117,600 @@ class TestGateway(unittest.TestCase):
         with self.assertRaises(IndexError):
             self.gw.get_free_id()
 
+    def testFreeIdIsReservedUntilPresentation(self):
+        gw = FakeLineGateway([])
+        gw.nodes = {1: mys.Node(1)}
+        gw._dispatch(b"255;255;3;0;3;\n")
+        gw._dispatch(b"255;255;3;0;3;\n")
+        self.assertEqual(gw.sent, ["255;255;3;0;4;2\n", "255;255;3;0;4;3\n"])
+        self.assertTrue(gw.id_allocator.is_reserved(2))
+
+        gw._dispatch(b"2;255;0;0;17;1.6\n")
+        self.assertFalse(gw.id_allocator.is_reserved(2))
+        self.assertFalse(gw.id_allocator.is_free(2))
+
+    def testExpiredReservation(self):
+        allocator = NodeIdAllocator(reservation_timeout=-1)
+        self.assertEqual(allocator.allocate(), 1)
+        self.assertEqual(allocator.allocate(), 1)
+
+        allocator = NodeIdAllocator(first_id=1, last_id=2)
+        allocator.allocate()
+        allocator.allocate()
+        with self.assertRaises(NoFreeIdError):
+            allocator.allocate()
+
+    def testSaveAllocator(self):
+        allocator = NodeIdAllocator()
+        allocator.sync([1, 2, 5])
+        self.assertEqual(allocator.allocate(), 3)
+
+        restored = NodeIdAllocator()
+        restored.from_dict(json.loads(json.dumps(allocator.to_dict())))
+        self.assertEqual(restored.to_dict(), allocator.to_dict())
+        self.assertEqual(restored.allocate(), 4)
+
+
+class FakeLineGateway(mys.Gateway):
+    """ Gateway reading from a list of lines, an empty line is returned when it runs out. """
+
+    def __init__(self, lines, **kwargs):
+        self.lines = list(lines)
+        self.sent = []
+        self.read_all = threading.Event()
+        super(FakeLineGateway, self).__init__(protocol_version=1.6, **kwargs)
+
+    def _read_line(self):
+        if self.lines:
+            return self.lines.pop(0)
+        self.read_all.set()
+        time.sleep(0.001)
+        return b""
+
+    def _read_available(self, read=True, reconnect=True):
+        lines = self.lines if read else []
+        if read:
+            self.lines = []
+        return lines
+
+    def send(self, msg, ack=False):
+        future = self.acks.track(msg) if ack else None
+        self.sent.append(msg.encode())
+        return future
+
+
+class TestPipeline(unittest.TestCase):
+    LINES = [b"1;255;0;0;17;1.6\n", b"1;0;0;0;6;\n"] + [b"1;0;1;0;0;2%d.0\n" % i for i in range(10)]
+
+    def testBlockPolicyDispatchesEverything(self):
+        received = []
+        gw = FakeLineGateway(self.LINES + [b"bad\n"], message_callback=received.append)
+        gw.start(workers=1, queue_size=2)
+        gw.read_all.wait(5)
+        gw.stop(timeout=5)
+
+        self.assertEqual(len(received), 12)
+        self.assertEqual(gw[1][0].values[mys.mys_16.SetReq.V_TEMP], 29.0)
+        self.assertEqual(gw.pipeline_stats.received, 13)
+        self.assertEqual(gw.pipeline_stats.dispatched, 12)
+        self.assertEqual(gw.pipeline_stats.bad_messages, 1)
+        self.assertEqual(gw.pipeline_stats.dropped, 0)
+
+    def testDropPolicies(self):
+        lines = [b"1;255;3;0;0;%d\n" % i for i in range(12)]
+        for policy in (mys.DROP_NEWEST, mys.DROP_OLDEST):
+            release = threading.Event()
+            received = []
+
+            def slow_callback(msg):
+                release.wait(5)
+                received.append(msg.payload)
+
+            gw = FakeLineGateway(lines, message_callback=slow_callback)
+            gw.start(workers=1, queue_size=2, policy=policy)
+            gw.read_all.wait(5)
+            release.set()
+            gw.stop(timeout=5)
+
+            stats = gw.pipeline_stats
+            self.assertEqual(stats.received, 12)
+            self.assertEqual(stats.dispatched, len(received))
+            self.assertEqual(stats.received, stats.dropped + stats.dispatched)
+            self.assertGreater(stats.dropped, 0)
+            if policy == mys.DROP_OLDEST:
+                self.assertEqual(received[-1], "11")
+            else:
+                self.assertEqual(received[0], "0")
+                self.assertNotIn("11", received)
+
+    def testStopWithStuckWorker(self):
+        release = threading.Event()
+        gw = FakeLineGateway(self.LINES, message_callback=lambda msg: release.wait(5))
+        gw.start(workers=1, queue_size=2)
+        gw.read_all.wait(0.5)
+        started = time.monotonic()
+        gw.stop(timeout=0.1)
+        self.assertLess(time.monotonic() - started, 2)
+        release.set()
+        self.assertGreater(gw.pipeline_stats.dropped, 0)
+
+    def testStopWithoutTimeout(self):
+        release = threading.Event()
+        gw = FakeLineGateway(self.LINES, message_callback=lambda msg: release.wait(5))
+        gw.start(workers=1, queue_size=2)
+        reader = gw._threads[0]
+        stopper = threading.Thread(target=gw.stop)
+        stopper.start()
+        # The reader is blocked on the full queue, it must give up its line instead of waiting.
+        reader.join(1)
+        self.assertFalse(reader.is_alive())
+        release.set()
+        stopper.join(5)
+        self.assertFalse(stopper.is_alive())
+        self.assertGreater(gw.pipeline_stats.dropped, 0)
+
+    def testProcessReadyKeepsLinesAfterError(self):
+        gw = FakeLineGateway([b"1;255;0;0;17;1.6\n", b"5;0;1;0;0;20.0\n", b"2;255;0;0;17;1.6\n", b"2;0;0;0;6;\n"])
+        self.assertEqual(gw.process_ready(), 3)
+        self.assertEqual(gw.pipeline_stats.errors, 1)
+        self.assertIsInstance(gw.pipeline_stats.last_error, KeyError)
+        self.assertIn(0, gw[2].sensors)
+
+    def testBadPayloadCountedOnce(self):
+        gw = FakeLineGateway([b"1;255;0;0;17;1.6\n", b"1;255;3;0;0;full\n", b"1;255;3;0;0;87\n"])
+        gw.start(workers=1)
+        gw.read_all.wait(5)
+        gw.stop(timeout=5)
+
+        stats = gw.pipeline_stats
+        self.assertEqual((stats.received, stats.dispatched, stats.bad_messages), (3, 2, 1))
+        self.assertEqual(gw[1].battery_level, 87)
+
+    def testUnknownPolicy(self):
+        with self.assertRaises(ValueError):
+            FakeLineGateway([]).start(policy='wait')
+
+
+class TestPersistence(unittest.TestCase):
+    LINES = [b"1;255;0;0;17;1.6\n", b"1;255;3;0;11;Weather\n", b"1;0;0;0;6;\n", b"1;1;0;0;7;\n",
+             b"1;0;1;0;0;21.5\n", b"1;1;1;0;1;40\n", b"1;255;3;0;0;87\n", b"1;0;0;0;6;\n"]
+
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.dir.name, "state.json")
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def run_gateway(self, lines, **kwargs):
+        gw = FakeLineGateway([], persistence=JsonStore(self.path, **kwargs))
+        for line in lines:
+            gw._dispatch(line)
+        gw.persistence.close()
+        return gw
+
+    def assertRestored(self, gw):
+        restored = FakeLineGateway([], persistence=JsonStore(self.path))
+        self.assertEqual(restored.snapshot(), gw.snapshot())
+        self.assertIs(restored[1][0].type, mys.mys_16.Presentation.S_TEMP)
+        self.assertEqual(restored[1][1].values[mys.mys_16.SetReq.V_HUM], 40.0)
+        self.assertEqual(restored[1][1].raw_values[mys.mys_16.SetReq.V_HUM], "40")
+        self.assertEqual(restored[1].battery_level, 87)
+        self.assertFalse(restored.id_allocator.is_free(1))
+
+    def testJournal(self):
+        gw = self.run_gateway(self.LINES)
+        self.assertFalse(os.path.exists(self.path))
+        self.assertRestored(gw)
+
+    def testCompaction(self):
+        gw = self.run_gateway(self.LINES, compact_every=3)
+        self.assertTrue(os.path.exists(self.path))
+        self.assertRestored(gw)
+
+        gw.persistence = JsonStore(self.path)
+        gw.save_state()
+        self.assertEqual(os.path.getsize(self.path + ".journal"), 0)
+        self.assertRestored(gw)
+
+    def testRestoredVersionNegotiated(self):
+        self.run_gateway(self.LINES, compact_every=3)
+        port = SimulatedSerial(simulated_nodes(1), const=mys.mys_20, protocol_version="2.3.1", realtime=False)
+        gw = mys.SerialGateway("sim", serial_factory=port.open, persistence=JsonStore(self.path))
+        self.assertEqual(gw.protocol_version, 1.6)
+        gw.connect()
+
+        self.assertIs(gw.const, mys.mys_20)
+        self.assertIs(gw[1][0].type, mys.mys_20.Presentation.S_TEMP)
+        self.assertEqual(gw[1][1].values[mys.mys_20.SetReq.V_HUM], 40.0)
+        gw._dispatch(b"1;255;3;0;22;7\n")
+        self.assertEqual(gw[1].heartbeat, 7)
+        gw.disconnect()
+
+    def testTornJournalLine(self):
+        self.run_gateway(self.LINES[:4])
+        with open(self.path + ".journal", 'a') as f:
+            f.write('["value",1,0,0,"2')
+        gw = FakeLineGateway([], persistence=JsonStore(self.path))
+        for line in self.LINES[4:]:
+            gw._dispatch(line)
+        gw.persistence.close()
+        self.assertRestored(gw)
+
+    def testFlushTimer(self):
+        store = JsonStore(self.path, flush_interval=0.01)
+        self.addCleanup(store.close)
+        store.record('node', 1, {'battery_level': 50})
+        time.sleep(0.2)
+        with open(self.path + ".journal") as f:
+            self.assertEqual(f.read(), '["node",1,{"battery_level":50}]\n')
+
+
+class TestMetrics(unittest.TestCase):
+    def testGatewayMetrics(self):
+        metrics = GatewayMetrics()
+        gw = FakeLineGateway([], metrics=metrics)
+        gw._dispatch(b"1;255;0;0;17;1.6\n")
+        gw._dispatch(b"1;0;0;0;6;\n")
+        gw._dispatch(b"1;0;1;0;0;21.5\n")
+        gw._dispatch(b"1;0;1;0;0;22.5\n")
+        with self.assertRaises(mys.BadMessageError):
+            gw._dispatch(b"bad\n")
+
+        self.assertEqual(metrics.count(gw.const.MessageType.C_SET, gw.const.SetReq.V_TEMP), 2)
+        self.assertEqual(metrics.node_messages[1], 4)
+        self.assertEqual(metrics.bad_messages, 1)
+        self.assertEqual(metrics.handler_latency.count, 4)
+        self.assertEqual(metrics.bytes_read, 17 + 11 + 15 + 15 + 4)
+        self.assertGreater(metrics.node_rate(1), 0)
+        self.assertEqual(metrics.top_nodes(1)[0][0], 1)
+
+        text = gw.export_metrics()
+        self.assertIn('pymys_messages_total{type="C_SET",sub_type="V_TEMP"} 2', text)
+        self.assertIn('pymys_node_messages_total{node="1"} 4', text)
+        self.assertIn('pymys_handler_seconds_bucket{le="+Inf"} 4', text)
+        self.assertIn('pymys_queue_depth{queue="msg_queue"} 0', text)
+
+    def testNodeRateDecays(self):
+        metrics = GatewayMetrics(rate_period=10.0)
+        msg = mys.Message("1;0;1;0;0;21.5")
+        for i in range(100):
+            metrics.message(msg, 15, 0.0, now=1000.0 + i * 0.5)
+        self.assertAlmostEqual(metrics.node_rate(1, now=1049.5), 2.0, delta=0.1)
+        self.assertLess(metrics.node_rate(1, now=1100.0), 0.02)
+
+
+class TestEvents(unittest.TestCase):
+    def testFilteredSubscriptions(self):
+        gw = FakeLineGateway([])
+        const = gw.const
+        everything, node_1, temperatures, batteries = [], [], [], []
+        gw.subscribe(everything.append)
+        subscription = gw.subscribe(node_1.append, node_id=1)
+        gw.subscribe(temperatures.append, type=const.MessageType.C_SET, sub_type=const.SetReq.V_TEMP)
+        gw.subscribe(batteries.append, type=const.MessageType.C_INTERNAL, sub_type=const.Internal.I_BATTERY_LEVEL)
+
+        for line in (b"1;255;0;0;17;1.6\n", b"1;0;0;0;6;\n", b"2;255;0;0;17;1.6\n", b"2;0;0;0;6;\n",
+                     b"1;0;1;0;0;21.5\n", b"2;0;1;0;0;19.5\n", b"2;255;3;0;0;80\n"):
+            gw._dispatch(line)
+
+        self.assertEqual(len(everything), 7)
+        self.assertEqual([str(m) for m in node_1], ["1;255;0;0;17;1.6", "1;0;0;0;6;", "1;0;1;0;0;21.5"])
+        self.assertEqual([m.node_id for m in temperatures], [1, 2])
+        self.assertEqual([m.payload for m in batteries], ["80"])
+        # Handlers ran before the subscribers.
+        self.assertEqual(gw[2].battery_level, 80)
+
+        gw.unsubscribe(subscription)
+        gw._dispatch(b"1;0;1;0;0;22.5\n")
+        self.assertEqual(len(node_1), 3)
+        self.assertEqual(len(temperatures), 3)
+
+    def testBackgroundAndErrors(self):
+        bus = EventBus(workers=2)
+        done = threading.Event()
+        received = []
+
+        def failing(value):
+            raise ValueError(value)
+
+        def slow(value):
+            received.append(value)
+            done.set()
+
+        bus.subscribe(failing, 'custom', node_id=1)
+        bus.subscribe(slow, 'custom', node_id=1, background=True)
+        self.assertEqual(bus.publish('custom', node_id=2, args=(0,)), 0)
+        self.assertEqual(bus.publish('custom', node_id=1, args=(1,)), 2)
+        self.assertTrue(done.wait(5))
+        bus.shutdown()
+        self.assertEqual(received, [1])
+        self.assertEqual(bus.errors, 1)
+        self.assertIsInstance(bus.last_error, ValueError)
+        # A field which is not published does not match the subscribers filtering it.
+        self.assertEqual(bus.publish('custom', args=(2,)), 0)
+
+
+class TestChangeDetection(unittest.TestCase):
+    def setUp(self):
+        self.received = []
+        self.gw = FakeLineGateway([], message_callback=self.received.append, changes_only=True,
+                                  deadbands={'V_TEMP': 0.5})
+        self.gw._dispatch(b"1;0;0;0;6;\n")
+        self.gw._dispatch(b"1;1;0;0;3;\n")
+        self.changes = []
+        self.gw.subscribe(lambda msg, previous: self.changes.append((msg.payload, previous)), CHANGED)
+
+    def process(self, lines):
+        self.gw.lines = list(lines)
+        for _ in lines:
+            self.gw.process()
+
+    def testDeadband(self):
+        self.process([b"1;0;1;0;0;21.0\n", b"1;0;1;0;0;21.0\n", b"1;0;1;0;0;21.3\n", b"1;0;1;0;0;21.6\n",
+                      b"1;0;1;0;0;21.2\n"])
+
+        self.assertEqual(self.changes, [("21.0", None), ("21.6", 21.0)])
+        self.assertEqual([msg.payload for msg in self.received], ["21.0", "21.6"])
+        sensor = self.gw[1][0]
+        # The stored value is always the last one received.
+        self.assertEqual(sensor.values[self.gw.const.SetReq.V_TEMP], 21.2)
+        self.assertGreaterEqual(sensor.last_seen, sensor.last_changed[self.gw.const.SetReq.V_TEMP])
+
+    def testExactComparisonWithoutDeadband(self):
+        self.gw.set_deadband('V_TEMP', None)
+        self.process([b"1;1;1;0;2;1\n", b"1;1;1;0;2;1\n", b"1;1;1;0;2;0\n", b"1;0;1;0;0;21.0\n",
+                      b"1;0;1;0;0;21.1\n"])
+
+        self.assertEqual(self.changes, [("1", None), ("0", True), ("21.0", None), ("21.1", 21.0)])
+
+    def testRestoredValuesAreTheReference(self):
+        sensor = self.gw[1][0]
+        sensor.values[self.gw.const.SetReq.V_TEMP] = 21.0
+        self.process([b"1;0;1;0;0;21.2\n"])
+        self.assertEqual(self.changes, [])
+
+
+class TestCapture(unittest.TestCase):
+    LINES = [b"1;255;0;0;17;1.6\n", b"1;0;0;0;6;\n", b"bad\n", b"1;0;1;0;0;21.5\n", b"1;255;3;0;1;\n"]
+
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.dir.name, "capture.bin")
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def capture(self, compress, block_size=65536):
+        capture = CaptureWriter(self.path, compress=compress, block_size=block_size)
+        gw = FakeLineGateway(list(self.LINES), capture=capture)
+        for _ in self.LINES:
+            try:
+                gw.process()
+            except mys.BadMessageError:
+                pass
+        capture.close()
+        return gw
+
+    def testCaptureRoundTrip(self):
+        for compress, block_size in ((False, 65536), (True, 65536), (True, 20)):
+            self.capture(compress, block_size)
+            records = list(read_capture(self.path))
+            self.assertEqual([line for _, line in records], self.LINES)
+            self.assertEqual([t for t, _ in records], sorted(t for t, _ in records))
+
+    def testReplay(self):
+        original = self.capture(True)
+        gw = ReplayGateway(self.path, protocol_version=1.6)
+        self.assertEqual(gw.replay(), 4)
+        self.assertEqual(gw.pipeline_stats.bad_messages, 1)
+        self.assertEqual(gw.snapshot(), original.snapshot())
+        self.assertEqual(len(gw.sent), 1)
+
+    def testReplayMidSession(self):
+        with CaptureWriter(self.path) as capture:
+            capture.write(b"4;0;1;0;0;20.0\n", 100.0)
+            capture.write(b"1;255;0;0;17;1.6\n", 100.1)
+        gw = ReplayGateway(self.path, protocol_version=1.6)
+        self.assertEqual(gw.replay(), 1)
+        self.assertEqual(gw.pipeline_stats.errors, 1)
+        self.assertIn(1, gw.nodes)
+
+    def testRealtimeReplay(self):
+        with CaptureWriter(self.path) as capture:
+            capture.write(b"1;255;0;0;17;1.6\n", 100.0)
+            capture.write(b"1;0;0;0;6;\n", 100.2)
+        gw = ReplayGateway(self.path, speed=2.0, protocol_version=1.6)
+        started = time.monotonic()
+        self.assertEqual(gw.replay(), 2)
+        self.assertGreaterEqual(time.monotonic() - started, 0.09)
+
+    def testFlushTimerAndReopen(self):
+        capture = CaptureWriter(self.path, flush_interval=0.01)
+        capture.write(b"1;255;0;0;17;1.6\n", 100.0)
+        time.sleep(0.2)
+        self.assertEqual(list(read_capture(self.path)), [(100.0, b"1;255;0;0;17;1.6\n")])
+        capture.close()
+        capture.write(b"1;0;0;0;6;\n", 101.0)
+        capture.close()
+        self.assertEqual([line for _, line in read_capture(self.path)], [b"1;255;0;0;17;1.6\n", b"1;0;0;0;6;\n"])
+
+    def testNotACapture(self):
+        with open(self.path, 'wb') as f:
+            f.write(b"1;255;0;0;17;1.6\n")
+        with self.assertRaises(CaptureError):
+            list(read_capture(self.path))
+
+
+class TestMappedCapture(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.dir.name, "capture.bin")
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def write(self, compress):
+        self.lines = []
+        with CaptureWriter(self.path, compress=compress, block_size=256) as capture:
+            for i in range(200):
+                line = b"%d;%d;1;0;0;%d.5\n" % (i % 5 + 1, i % 2, i) if i % 50 else b"garbage\n"
+                capture.write(line, 1000.0 + i)
+                self.lines.append(line)
+
+    def testRandomAccessAndFilters(self):
+        for compress in (False, True):
+            self.write(compress)
+            with MappedCapture(self.path, rebuild=True) as capture:
+                self.assertEqual(len(capture), 200)
+                self.assertEqual(capture[17], (1017.0, self.lines[17]))
+                self.assertEqual(capture[-1], (1199.0, self.lines[-1]))
+                self.assertEqual(capture.seek(1100.5), 101)
+                self.assertEqual(capture.node_id(17), 3)
+                self.assertEqual(capture.type(50), INVALID)
+
+                selected = list(capture.select(node_id=3, sub_type=0, start=1010.0, end=1050.0))
+                self.assertEqual(selected, [12, 17, 22, 27, 32, 37, 42, 47])
+                self.assertEqual(len(list(capture.select(type=1))), 196)
+                self.assertEqual(len(list(capture.select())), 196)
+                msgs = list(capture.messages(node_id=2, start=1190.0, const=mys.mys_16))
+                self.assertEqual([m.payload for m in msgs], ["191.5", "196.5"])
+                self.assertIs(msgs[0].sub_type, mys.mys_16.SetReq.V_TEMP)
+
+    def testIndexIsKeptAndRebuiltWhenStale(self):
+        self.write(False)
+        with MappedCapture(self.path) as capture:
+            self.assertEqual(len(capture), 200)
+        index_mtime = os.stat(self.path + ".idx").st_mtime_ns
+        with MappedCapture(self.path) as capture:
+            self.assertEqual(len(capture), 200)
+        self.assertEqual(os.stat(self.path + ".idx").st_mtime_ns, index_mtime)
+
+        with CaptureWriter(self.path) as writer:
+            writer.write(b"1;0;1;0;0;1.5\n", 1.0)
+        with MappedCapture(self.path) as capture:
+            self.assertEqual(len(capture), 1)
+
+
+class TestLiveness(unittest.TestCase):
+    def testOfflineAndOnline(self):
+        gw = mys.Gateway(protocol_version=1.6, node_timeout=60)
+        self.addCleanup(gw.timers.stop)
+        events = []
+        gw.subscribe(lambda node: events.append(('offline', node.id)), event=OFFLINE)
+        gw.subscribe(lambda node: events.append(('online', node.id)), event=ONLINE)
+        gw.set_node_timeout(2, 300)
+        gw._dispatch(b"1;255;0;0;17;1.6\n")
+        gw._dispatch(b"1;0;0;0;6;\n")
+        gw._dispatch(b"2;255;0;0;17;1.6\n")
+        self.assertIsNotNone(gw[1].last_seen)
+        self.assertEqual(gw[1][0].last_seen, gw[1].last_seen)
+
+        now = time.monotonic()
+        self.assertEqual(gw.liveness.check(now + 30), [])
+        gw.liveness.seen(1, now + 50)
+        self.assertEqual(gw.liveness.check(now + 100), [])
+        self.assertEqual(gw.liveness.check(now + 111), [1])
+        self.assertEqual(gw.liveness.check(now + 301), [2])
+        self.assertFalse(gw.liveness.is_online(1))
+        self.assertEqual(events, [('offline', 1), ('offline', 2)])
+
+        gw._dispatch(b"1;0;1;0;0;20.0\n")
+        self.assertTrue(gw.liveness.is_online(1))
+        self.assertEqual(events, [('offline', 1), ('offline', 2), ('online', 1)])
+
+    def testDisabledByDefault(self):
+        gw = mys.Gateway(protocol_version=1.6)
+        gw._dispatch(b"1;255;0;0;17;1.6\n")
+        self.assertIsNotNone(gw[1].last_seen)
+        self.assertEqual(gw.liveness.check(time.monotonic() + 3600), [])
+        self.assertEqual(len(gw.timers), 0)
+
+
+class TestOutbox(unittest.TestCase):
+    def testSendWhenAwake(self):
+        gw = FakeLineGateway([])
+        gw.send_when_awake(mys.Message("3;1;1;0;2;1"))
+        gw.send_when_awake(mys.Message("3;2;1;0;2;1"))
+        gw.send_when_awake(mys.Message("3;1;1;0;2;0"))
+        gw.send_when_awake(mys.Message("4;1;1;0;2;1"))
+        self.assertEqual(len(gw.pending_messages(3)), 2)
+
+        gw._dispatch(b"3;255;3;0;0;90\n")
+        self.assertEqual(gw.sent, [])
+        gw._dispatch(b"3;255;3;0;18;\n")
+        self.assertEqual(gw.sent, ["3;2;1;0;2;1\n", "3;1;1;0;2;0\n"])
+        self.assertEqual(gw.pending_messages(3), [])
+        self.assertEqual(len(gw.pending_messages(4)), 1)
+
+    def testSendWhenAwakeWithoutWakeUp(self):
+        gw = mys.Gateway(protocol_version=1.5)
+        with self.assertRaises(mys.GatewayError):
+            gw.send_when_awake(mys.Message("3;1;1;0;2;1"))
+        self.assertEqual(gw.pending_messages(3), [])
+
+
+class TestAck(unittest.TestCase):
+    def testTimerWheel(self):
+        fired = []
+        wheel = utils.TimerWheel(tick=0.01, slots=4)
+        wheel.start()
+        wheel.stop()
+        now = time.monotonic()
+        wheel.schedule(0.02, fired.append, "a")
+        late = wheel.schedule(0.2, fired.append, "b")
+        cancelled = wheel.schedule(0.03, fired.append, "c")
+        wheel.cancel(cancelled)
+
+        wheel.advance(now + 0.05)
+        self.assertEqual(fired, ["a"])
+        wheel.advance(now + 0.3)
+        self.assertEqual(fired, ["a", "b"])
+        self.assertEqual(len(wheel), 0)
+        self.assertTrue(late.tick > 0)
+
+    def testAcknowledged(self):
+        gw = FakeLineGateway([], ack_timeout=5.0)
+        gw._dispatch(b"3;1;0;0;3;\n")
+        future = gw.send(mys.Message("3;1;1;0;2;1"), ack=True)
+        self.assertEqual(gw.sent, ["3;1;1;1;2;1\n"])
+        self.assertEqual(len(gw.acks), 1)
+
+        gw._dispatch(b"3;1;1;1;2;1\n")
+        self.assertEqual(str(future.result(1)), "3;1;1;1;2;1")
+        self.assertEqual(len(gw.acks), 0)
+        gw.timers.stop()
+
+    def testCancelledFuture(self):
+        gw = FakeLineGateway([], ack_timeout=5.0)
+        gw._dispatch(b"3;1;0;0;3;\n")
+        future = gw.send(mys.Message("3;1;1;0;2;1"), ack=True)
+        future.cancel()
+        gw._dispatch(b"3;1;1;1;2;1\n")
+        self.assertTrue(future.cancelled())
+        self.assertEqual(len(gw.acks), 0)
+        gw.timers.stop()
+
+    def testRetransmitAndFail(self):
+        gw = FakeLineGateway([], ack_timeout=0.02, ack_retries=2, ack_backoff=1.0)
+        gw.timers.tick = 0.01
+        future = gw.send(mys.Message("3;1;1;0;2;1"), ack=True)
+        with self.assertRaises(AckTimeoutError):
+            future.result(5)
+        self.assertEqual(gw.sent, ["3;1;1;1;2;1\n"] * 3)
+        self.assertEqual(gw.acks.failures, {3: 1})
+        gw.timers.stop()
+
+    def testSuperseded(self):
+        gw = FakeLineGateway([], ack_timeout=5.0)
+        gw._dispatch(b"3;1;0;0;3;\n")
+        first = gw.send(mys.Message("3;1;1;0;2;1"), ack=True)
+        second = gw.send(mys.Message("3;1;1;0;2;0"), ack=True)
+        self.assertTrue(first.cancelled())
+        gw._dispatch(b"3;1;1;1;2;0\n")
+        self.assertEqual(second.result(1).payload, "0")
+        gw.timers.stop()
+
 
 class TestSerialGateway(unittest.TestCase):
     def setUp(self):
@@ -62,13 +735,566 @@ class TestSerialGateway(unittest.TestCase):
         with self.assertRaises(mys.GatewayError):
             self.gw.connect()
 
+    @mock.patch('serial.Serial')
+    def testSendMany(self, mock_serial):
+        mock_serial.return_value.readline.side_effect = [b"0;0;3;0;14;Gateway startup complete.", b"0;0;3;0;2;1.6"]
+        self.gw.connect()
+        self.gw.send_many([mys.Message("3;1;1;0;2;1"), mys.Message("4;1;1;0;2;0")])
+        self.assertEqual(mock_serial.return_value.write.call_args_list[-1][0][0], b"3;1;1;0;2;1\n4;1;1;0;2;0\n")
+
+    @mock.patch('serial.Serial')
+    def testBatchWrites(self, mock_serial):
+        written = []
+        mock_serial.return_value.readline.side_effect = [b"0;0;3;0;14;Gateway startup complete.", b"0;0;3;0;2;1.6"]
+        mock_serial.return_value.write.side_effect = lambda data: written.append(bytes(data))
+        gw = mys.SerialGateway("/dev/ttyUSB0", batch_writes=True, max_batch=8)
+        gw.connect()
+        del written[:]
+        with gw.lock:
+            # The writer waits for the lock, so the messages pile up in its queue.
+            for i in range(10):
+                gw.send(mys.Message("3;{};1;0;2;1".format(i)))
+            time.sleep(0.05)
+        gw.disconnect()
+
+        self.assertEqual(b"".join(written), b"".join("3;{};1;0;2;1\n".format(i).encode() for i in range(10)))
+        self.assertLess(len(written), 10)
+        self.assertEqual(gw.writer.stats.messages, 10)
+        self.assertEqual(gw.writer.stats.max_batch_size, 8)
+
+    def testRateLimiter(self):
+        limiter = writer.RateLimiter(10, burst=5)
+        now = time.monotonic()
+        self.assertEqual(limiter.take(8, now), 5)
+        self.assertEqual(limiter.take(1, now), 0)
+        self.assertAlmostEqual(limiter.delay(now), 0.1)
+        self.assertEqual(limiter.take(8, now + 0.35), 3)
+
+
+class TestSimulator(unittest.TestCase):
+    def testPresentationAndReports(self):
+        port = SimulatedSerial(simulated_nodes(3, [('S_TEMP', 'V_TEMP'), ('S_BINARY', 'V_STATUS')], interval=10),
+                               realtime=False, seed=1)
+        gw = mys.SerialGateway("sim", serial_factory=port.open)
+        gw.connect()
+        self.assertEqual(gw.protocol_version, 1.6)
+        for _ in range(100):
+            gw.process()
+
+        self.assertEqual(sorted(gw.nodes), [1, 2, 3])
+        self.assertEqual(gw[2].sketch_name, "Simulated node")
+        self.assertEqual(gw[2][1].type, gw.const.Presentation.S_BINARY)
+        self.assertIsInstance(gw[3][0].values[gw.const.SetReq.V_TEMP], float)
+
+    def testVersionNegotiation(self):
+        port = SimulatedSerial(simulated_nodes(1), const=mys.mys_20, protocol_version="2.3.2", realtime=False)
+        gw = mys.SerialGateway("sim", serial_factory=port.open)
+        gw.connect()
+        self.assertEqual(gw.protocol_version, 2.3)
+        self.assertIs(gw.const, mys.mys_20)
+
+        port = SimulatedSerial(simulated_nodes(1), protocol_version="3.0.0", realtime=False)
+        gw = mys.SerialGateway("sim", serial_factory=port.open)
+        with self.assertRaises(mys.GatewayError):
+            gw.connect()
+
+    def testIdRequestAndCommands(self):
+        port = SimulatedSerial(simulated_nodes(2, [('S_BINARY', 'V_STATUS')], request_ids=True),
+                               realtime=False, seed=1)
+        gw = mys.SerialGateway("sim", protocol_version=1.6, serial_factory=port.open)
+        gw.connect()
+        for _ in range(10):
+            gw.process()
+        self.assertEqual(sorted(gw.nodes), [1, 2])
+
+        future = gw.send(mys.Message("2;0;1;0;2;1"), ack=True)
+        gw.process()
+        self.assertEqual(future.result(0).payload, "1")
+        gw.process()
+        self.assertIs(gw[2][0].values[gw.const.SetReq.V_STATUS], True)
+
+        gw.send(mys.Message("2;0;2;0;2;"))
+        gw.process()
+        self.assertEqual(port.nodes[2].values[(0, 2)], "1")
+        self.assertIs(gw[2][0].values[gw.const.SetReq.V_STATUS], True)
+
+    def testRealtimeTimeout(self):
+        port = SimulatedSerial(simulated_nodes(1, interval=60), timeout=0.01)
+        for _ in range(5):
+            self.assertTrue(port.readline())
+        self.assertEqual(port.readline(), b"")
+
+
+class FakeEthernetServer(object):
+    """
+      Loopback stand-in for an ethernet gateway. Each connection gets the lines of one session,
+      a None entry waits for data from the client.
+    """
+
+    def __init__(self, sessions):
+        self.sessions = list(sessions)
+        self.received = b""
+        self.connections = 0
+        self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.server.bind(("127.0.0.1", 0))
+        self.server.listen(1)
+        self.port = self.server.getsockname()[1]
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        for lines in self.sessions:
+            conn, _ = self.server.accept()
+            self.connections += 1
+            with conn:
+                for line in lines:
+                    if line is None:
+                        self.received += conn.recv(64)
+                    else:
+                        conn.sendall(line)
+        self.server.close()
+
+
+class TestEthernetGateway(unittest.TestCase):
+    def testConnectAndReconnect(self):
+        ready = b"0;0;3;0;14;Gateway startup complete.\n"
+        server = FakeEthernetServer([
+            [ready, None, b"0;0;3;0;2;1.6\n1;255;0;0;", b"17;1.6\n1;0;0;0;6;\n"],
+            [ready, None, b"0;0;3;0;2;1.6\n1;0;1;0;0;20.5\n"],
+        ])
+        gw = mys.EthernetGateway("127.0.0.1", server.port, timeout=2.0, reconnect_delay=0.01)
+
+        self.assertTrue(gw.connect())
+        self.assertEqual(gw.protocol_version, 1.6)
+        self.assertEqual(server.received, b"0;0;3;0;2;\n")
+        gw.process()
+        gw.process()
+        self.assertIn(0, gw[1].sensors)
+
+        # The first session is closed by the server, so the gateway reconnects.
+        gw.process()
+        gw.process()
+        self.assertEqual(gw[1][0].values[mys.mys_16.SetReq.V_TEMP], 20.5)
+        gw.disconnect()
+
+    def testConcurrentReconnect(self):
+        ready = b"0;0;3;0;14;Gateway startup complete.\n"
+        server = FakeEthernetServer([[ready, None], [ready, None], [ready, None]])
+        gw = mys.EthernetGateway("127.0.0.1", server.port, protocol_version=1.6, timeout=2.0)
+        gw.connect()
+        lost = gw.socket
+
+        # The reader and a sender find the same socket broken, only one of them reconnects.
+        threads = [threading.Thread(target=gw.reconnect, args=(lost,)) for _ in range(2)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(5)
+        self.assertIsNot(gw.socket, lost)
+        self.assertEqual(server.connections, 2)
+        gw.send(mys.Message("1;0;1;0;2;1"))
+        gw.disconnect()
+
+    def testGatewayNotListening(self):
+        gw = mys.EthernetGateway("127.0.0.1", FakeEthernetServer([]).port, timeout=0.5)
+        with self.assertRaises(mys.GatewayError):
+            gw.connect()
+
+
+class TestGatewayManager(unittest.TestCase):
+    def wait_for(self, condition, manager=None):
+        for _ in range(50):
+            if condition():
+                return
+            if manager is not None:
+                manager.poll(0.1)
+            else:
+                time.sleep(0.01)
+        self.fail("Condition not met")
+
+    def testMultiplexAndRoute(self):
+        ready = b"0;0;3;0;14;Gateway startup complete.\n"
+        server_a = FakeEthernetServer([[ready, b"1;255;0;0;17;1.6\n1;0;0;0;6;\n", None]])
+        server_b = FakeEthernetServer([[ready, b"2;255;0;0;17;1.6\n", None, b"255;255;3;0;3;\n", None]])
+        gateways = []
+        for server in (server_a, server_b):
+            gw = mys.EthernetGateway("127.0.0.1", server.port, protocol_version=1.6, timeout=2.0)
+            gw.connect()
+            gateways.append(gw)
+        received = []
+        manager = GatewayManager(gateways, message_callback=received.append)
+
+        self.wait_for(lambda: sorted(manager.nodes) == [1, 2], manager)
+        self.assertIs(manager[1], gateways[0][1])
+        self.assertIs(manager.route(2), gateways[1])
+        self.assertEqual(len(manager.nodes), 2)
+        self.assertEqual(len(received), 3)
+
+        manager.send(mys.Message("2;0;1;0;2;1"))
+        self.wait_for(lambda: b"255;255;3;0;4;" in server_b.received, manager)
+        # Node 1 is on the other network, the shared allocator still hands out a new ID.
+        self.assertEqual(server_b.received, b"2;0;1;0;2;1\n255;255;3;0;4;3\n")
+
+        manager.send(mys.Message("1;0;1;0;2;1"))
+        self.wait_for(lambda: server_a.received)
+        self.assertEqual(server_a.received, b"1;0;1;0;2;1\n")
+
+        with self.assertRaises(KeyError):
+            manager.nodes[5]
+        with self.assertRaises(mys.GatewayError):
+            manager.send(mys.Message("5;0;1;0;2;1"))
+        manager.disconnect()
+        self.assertEqual(manager.gateways, [])
+
+    def testReconnectWithoutBlocking(self):
+        ready = b"0;0;3;0;14;Gateway startup complete.\n"
+        server_a = FakeEthernetServer([[ready, b"1;255;0;0;17;1.6\n"], [ready, b"1;0;0;0;6;\n", None]])
+        server_b = FakeEthernetServer([[ready, None, b"2;255;0;0;17;1.6\n", None]])
+        server_c = FakeEthernetServer([[ready]])
+        gateways = [mys.EthernetGateway("127.0.0.1", server.port, protocol_version=1.6, timeout=2.0,
+                                        reconnect_delay=0.05, max_reconnect_attempts=1)
+                    for server in (server_a, server_b, server_c)]
+        for gw in gateways:
+            gw.connect()
+        manager = GatewayManager(gateways)
+
+        self.wait_for(lambda: gateways[2] not in manager.gateways, manager)
+        self.assertGreaterEqual(manager.errors, 2)
+        gateways[1].send(mys.Message("0;0;3;0;2;"))
+        self.wait_for(lambda: 2 in gateways[1].nodes and 1 in gateways[0].nodes and 0 in gateways[0][1].sensors,
+                      manager)
+        self.assertEqual(manager.gateways, gateways[:2])
+        manager.disconnect()
+
+    def testReconnectInBackground(self):
+        ready = b"0;0;3;0;14;Gateway startup complete.\n"
+        # The second session of server_a never completes the handshake.
+        server_a = FakeEthernetServer([[ready], [None]])
+        server_b = FakeEthernetServer([[ready, None, b"2;255;0;0;17;1.6\n", None]])
+        gateways = [mys.EthernetGateway("127.0.0.1", server.port, protocol_version=1.6, timeout=2.0,
+                                        reconnect_delay=0.05, max_reconnect_attempts=1)
+                    for server in (server_a, server_b)]
+        for gw in gateways:
+            gw.connect()
+        manager = GatewayManager(gateways)
+
+        self.wait_for(lambda: manager._reconnects.get(gateways[0], (0,))[0] is None, manager)
+        start = time.monotonic()
+        gateways[1].send(mys.Message("0;0;3;0;2;"))
+        self.wait_for(lambda: 2 in gateways[1].nodes, manager)
+        self.assertLess(time.monotonic() - start, 1.0)
+        self.assertIn(gateways[0], manager._reconnects)
+        manager.disconnect()
+
+
+class FakeStreamWriter(object):
+    def __init__(self):
+        self.data = b""
+
+    def write(self, data):
+        self.data += data
+
+    async def drain(self):
+        pass
+
+    def close(self):
+        pass
+
+    async def wait_closed(self):
+        pass
+
+
+class FakeAsyncGateway(aio.AsyncGateway):
+    def __init__(self, lines, **kwargs):
+        self.lines = lines
+        super(FakeAsyncGateway, self).__init__(**kwargs)
+
+    async def open_connection(self):
+        reader = asyncio.StreamReader()
+        reader.feed_data(b"".join(self.lines))
+        reader.feed_eof()
+        return reader, FakeStreamWriter()
+
+
+class TestAsyncGateway(unittest.IsolatedAsyncioTestCase):
+    async def testConnectionSucess(self):
+        gw = FakeAsyncGateway([b"0;0;3;0;9;gateway started, id=0, parent=0, distance=0\n",
+                               b"0;0;3;0;14;Gateway startup complete.\n",
+                               b"0;0;3;0;2;1.6\n"])
+
+        self.assertTrue(await gw.connect())
+        self.assertEqual(gw.protocol_version, 1.6)
+        self.assertEqual(gw.writer.data, b"0;0;3;0;2;\n")
+
+    async def testGatewayFailure(self):
+        gw = FakeAsyncGateway([b""])
+        with self.assertRaises(mys.GatewayError):
+            await gw.connect()
+
+    async def testProcessAsyncCallback(self):
+        received = []
+
+        async def show_msg(msg):
+            received.append(str(msg))
+
+        gw = FakeAsyncGateway([b"0;0;3;0;14;Gateway startup complete.\n",
+                               b"1;255;0;0;17;1.6\n",
+                               b"1;0;0;0;6;\n",
+                               b"1;0;1;0;0;21.5\n"],
+                              message_callback=show_msg, protocol_version=1.6)
+        await gw.connect()
+        for _ in range(3):
+            await gw.process()
+
+        self.assertEqual(received, ["1;255;0;0;17;1.6", "1;0;0;0;6;", "1;0;1;0;0;21.5"])
+        self.assertEqual(gw[1][0].values[mys.mys_16.SetReq.V_TEMP], 21.5)
+        with self.assertRaises(mys.GatewayError):
+            await gw.process()
+
+    async def testRunSkipsBadMessages(self):
+        gw = FakeAsyncGateway([b"0;0;3;0;14;Gateway startup complete.\n",
+                               b"1;255;0;0;17;1.6\n",
+                               b"garbage\n",
+                               b"1;0;0;0;6;\n"],
+                              protocol_version=1.6)
+        await gw.connect()
+        with self.assertRaises(mys.GatewayError):
+            await gw.run()
+
+        self.assertEqual(gw.pipeline_stats.bad_messages, 1)
+        self.assertIn(0, gw[1].sensors)
+
+
+class TestParseStream(unittest.TestCase):
+    CAPTURE = (b"1;255;0;0;17;1.6\n"
+               b"garbage\n"
+               b"\n"
+               b"1;0;0;0;6;\r\n"
+               b"1;0;1;0;0;21.5\n"
+               b"1;0;1;0;99;1\n"
+               b"300;0;1;0;1;40")
+
+    def testDecodeMany(self):
+        errors = []
+        msgs = list(mys.Message.decode_many(self.CAPTURE, mys.mys_16, errors))
+        self.assertEqual([str(m) for m in msgs], ["1;255;0;0;17;1.6", "1;0;0;0;6;", "1;0;1;0;0;21.5", "300;0;1;0;1;40"])
+        self.assertIs(msgs[2].sub_type, mys.mys_16.SetReq.V_TEMP)
+        self.assertEqual(errors, [b"garbage", b"1;0;1;0;99;1"])
+
+    def testParseFileInChunks(self):
+        source = io.BytesIO(self.CAPTURE)
+        msgs = list(pymys.parse_stream(source, chunk_size=7))
+        self.assertEqual(len(msgs), 5)
+        self.assertEqual(msgs[-1].payload, "40")
+
+    def testColumns(self):
+        errors = []
+        columns = pymys.MessageColumns.from_stream(io.BytesIO(self.CAPTURE), mys.mys_16, errors)
+        self.assertEqual(len(columns), 3)
+        self.assertEqual(list(columns.node_id), [1, 1, 1])
+        self.assertEqual(list(columns.type), [0, 0, 1])
+        self.assertEqual(columns.payload, ["1.6", "", "21.5"])
+        self.assertEqual(str(columns.message(2)), "1;0;1;0;0;21.5")
+        self.assertEqual(len(errors), 3)
+
 
 class TestNode(unittest.TestCase):
-    pass
+    def setUp(self):
+        self.node = mys.Node(1)
+
+    def testUpdate(self):
+        self.node.update(sketch_name="Temp", sketch_version="1.2", battery_level="87")
+        self.assertEqual((self.node.sketch_name, self.node.sketch_version, self.node.battery_level),
+                         ("Temp", 1.2, 87))
+        with self.assertRaises(mys.NodeError):
+            self.node.update(parent=0)
+
+    def testRepeatedSensor(self):
+        self.node[0] = mys.mys_16.Presentation.S_TEMP
+        with self.assertRaises(mys.NodeError):
+            self.node[0] = mys.mys_16.Presentation.S_HUM
+        self.assertIs(self.node[0].type, mys.mys_16.Presentation.S_TEMP)
+
+    def testSnapshot(self):
+        self.node[0] = mys.mys_16.Presentation.S_TEMP
+        self.node.set_sensor_value(0, mys.mys_16.SetReq.V_TEMP, "21.5")
+        snapshot = self.node.snapshot()
+        self.node.set_sensor_value(0, mys.mys_16.SetReq.V_TEMP, "22.0")
+
+        self.assertEqual(snapshot['sensors'][0]['values'], {mys.mys_16.SetReq.V_TEMP: "21.5"})
+        self.assertEqual(self.node[0].values[mys.mys_16.SetReq.V_TEMP], "22.0")
+
+    def testSnapshotWhileUpdating(self):
+        self.node[0] = mys.mys_16.Presentation.S_TEMP
+        sensor = self.node[0]
+        v_temp = mys.mys_16.SetReq.V_TEMP
+        done = threading.Event()
+
+        def update():
+            for i in range(5000):
+                sensor.update_value(v_temp, float(i), str(i))
+            done.set()
+
+        thread = threading.Thread(target=update)
+        thread.start()
+        while not done.is_set():
+            snapshot = sensor.snapshot()
+            if snapshot['values']:
+                self.assertEqual(snapshot['values'][v_temp], float(snapshot['raw_values'][v_temp]))
+        thread.join()
+
+    def testIterateWhileWriting(self):
+        gw = mys.Gateway(protocol_version=1.6)
+        for node_id in range(1, 50):
+            gw._get_node(node_id)
+        for node_id in gw.nodes:
+            gw._get_node(node_id + 100)
+        self.assertEqual(len(gw.nodes), 98)
+        self.assertEqual(len(gw.snapshot()), 98)
+
+        gw.nodes = {}
+        gw._get_node(1)
+        self.assertIsInstance(gw.nodes, utils.CopyOnWriteDict)
+
+
+class TestHistory(unittest.TestCase):
+    def setUp(self):
+        self.history = History(size=4)
+        for i, value in enumerate([10.0, 11.0, 13.0, 12.0, 14.0, 9.0]):
+            self.history.append(value, timestamp=100.0 + i)
+
+    def testRingBuffer(self):
+        self.assertEqual(len(self.history), 4)
+        self.assertEqual(self.history.last(2), [(104.0, 14.0), (105.0, 9.0)])
+        self.assertEqual(list(self.history)[0], (102.0, 13.0))
+
+    def testQueries(self):
+        self.assertEqual(self.history.range(103.0, 104.0), [(103.0, 12.0), (104.0, 14.0)])
+        self.assertEqual(self.history.range(start=104.5), [(105.0, 9.0)])
+        self.assertEqual(self.history.window(2.0, now=105.0), [12.0, 14.0, 9.0])
+        self.assertEqual(self.history.min(), 9.0)
+        self.assertEqual(self.history.max(3.0, now=105.0), 14.0)
+        self.assertEqual(self.history.mean(), 12.0)
+        self.assertIsNone(History().mean())
+
+    def testMaxAge(self):
+        history = History(size=10, max_age=2.0)
+        for i in range(5):
+            history.append(float(i), timestamp=float(i))
+        self.assertEqual([value for _, value in history], [2.0, 3.0, 4.0])
+
+    def testGatewayHistory(self):
+        gw = FakeLineGateway([], history_size=8)
+        for line in [b"1;255;0;0;17;1.6\n", b"1;0;0;0;6;\n", b"1;0;1;0;0;21.5\n", b"1;0;1;0;0;22.5\n",
+                     b"1;0;1;0;47;text\n"]:
+            gw._dispatch(line)
+        history = gw[1][0].history[mys.mys_16.SetReq.V_TEMP]
+        self.assertEqual([value for _, value in history], [21.5, 22.5])
+        self.assertNotIn(mys.mys_16.SetReq.V_TEXT, gw[1][0].history)
+
+
+class TestPayload(unittest.TestCase):
+    def testCodecs(self):
+        set_req = mys.mys_16.SetReq
+        self.assertEqual(payload.decode(mys.mys_16, set_req.V_TEMP, "21.5"), 21.5)
+        self.assertIs(payload.decode(mys.mys_16, set_req.V_LIGHT, "1"), True)
+        self.assertEqual(payload.decode(mys.mys_16, set_req.V_DIMMER, "40"), 40)
+        self.assertEqual(payload.decode(mys.mys_16, set_req.V_RGB, "ff0080"), b"\xff\x00\x80")
+        self.assertEqual(payload.decode(mys.mys_16, set_req.V_POSITION, "55.72;13.19;41"), (55.72, 13.19, 41.0))
+        self.assertEqual(payload.decode(mys.mys_16, set_req.V_TEXT, "hello"), "hello")
+        self.assertEqual(payload.decode(mys.mys_16, set_req.V_TEMP, "nan?"), "nan?")
+        self.assertEqual(payload.decode(mys.mys_15, 100, "1"), "1")
+
+    def testGatewayKeepsRawValues(self):
+        gw = FakeLineGateway([])
+        for line in [b"1;255;0;0;17;1.6\n", b"1;0;0;0;26;\n", b"1;0;1;0;2;1\n", b"1;0;1;0;40;00ff00\n"]:
+            gw._dispatch(line)
+        sensor = gw[1][0]
+        self.assertIs(sensor.values[mys.mys_16.SetReq.V_STATUS], True)
+        self.assertEqual(sensor.values[mys.mys_16.SetReq.V_RGB], b"\x00\xff\x00")
+        self.assertEqual(sensor.raw_values[mys.mys_16.SetReq.V_RGB], "00ff00")
+
+        gw = FakeLineGateway([], typed_values=False)
+        for line in [b"1;255;0;0;17;1.6\n", b"1;0;0;0;26;\n", b"1;0;1;0;2;1\n"]:
+            gw._dispatch(line)
+        self.assertEqual(gw[1][0].values[mys.mys_16.SetReq.V_STATUS], "1")
+
+
+class TestFirmware(unittest.TestCase):
+    HEX = [":10000000000102030405060708090A0B0C0D0E0F78\n",
+           ":020010001011CD\n",
+           ":00000001FF\n"]
+
+    def testParseHex(self):
+        self.assertEqual(parse_hex(self.HEX), bytes(range(16)) + b"\x10\x11")
+        with self.assertRaises(FirmwareError):
+            parse_hex([":020010001011CE\n"])
+
+    def testCrc(self):
+        self.assertEqual(crc16(b"123456789"), 0x4B37)
+
+    def testFirmware(self):
+        firmware = Firmware(1, 2, parse_hex(self.HEX))
+        self.assertEqual(len(firmware.data), 128)
+        self.assertEqual(firmware.blocks, 8)
+        self.assertEqual(firmware.config, "010002000800" + "{:02X}{:02X}".format(firmware.crc & 0xFF, firmware.crc >> 8))
+        self.assertEqual(firmware.block(0), "010002000000000102030405060708090A0B0C0D0E0F")
+
+    def testUpdateNodes(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "fw.hex")
+            with open(path, "w") as f:
+                f.writelines(self.HEX)
+            gw = FakeLineGateway([])
+            gw.update_firmware([3, 4], 1, 2, path)
+
+        self.assertEqual(gw.sent, ["3;255;3;0;13;\n", "4;255;3;0;13;\n"])
+        firmware = gw.ota.firmwares[(1, 2)]
+        gw._dispatch(b"3;255;4;0;0;010001000A00FFFF0200\n")
+        gw._dispatch(b"5;255;4;0;0;010001000A00FFFF0200\n")
+        gw._dispatch(b"4;255;4;0;2;010002000100\n")
+        gw._dispatch(b"3;255;4;0;2;010002000000\n")
+        self.assertEqual(gw.sent[2:], ["3;255;4;0;1;" + firmware.config + "\n",
+                                       "4;255;4;0;3;" + firmware.block(1) + "\n",
+                                       "3;255;4;0;3;" + firmware.block(0) + "\n"])
+        self.assertNotIn(3, gw.ota.updates)
+        self.assertIn(4, gw.ota.updates)
 
 
 class TestMessage(unittest.TestCase):
-    pass
+    def testDecodeBytes(self):
+        msg = mys.Message(b"12;3;1;0;0;21.5\n")
+        self.assertEqual((msg.node_id, msg.sensor_id, msg.type, msg.ack, msg.sub_type), (12, 3, 1, 0, 0))
+        self.assertEqual(msg.payload, "21.5")
+        self.assertEqual(msg.encode(), "12;3;1;0;0;21.5\n")
+
+    def testDecodeResolvesEnums(self):
+        msg = mys.Message(b"12;3;1;0;2;1\n", mys.mys_16)
+        self.assertIs(msg.type, mys.mys_16.MessageType.C_SET)
+        self.assertIs(msg.sub_type, mys.mys_16.SetReq.V_STATUS)
+
+        msg = mys.Message("0;255;3;0;18;", mys.mys_16)
+        self.assertIs(msg.sub_type, mys.mys_16.Internal.I_HEARTBEAT)
+
+    def testUnknownSubtype(self):
+        with self.assertRaises(mys.BadMessageError):
+            mys.Message(b"1;0;3;0;18;\n", mys.mys_15)
+        with self.assertRaises(mys.BadMessageError):
+            mys.Message(b"1;0;7;0;0;\n", mys.mys_16)
+        with self.assertRaises(mys.BadMessageError):
+            mys.Message(b"1;0;1;0;-1;\n", mys.mys_16)
+
+    def testMalformed(self):
+        with self.assertRaises(mys.BadMessageError):
+            mys.Message(b"1;0;1;0\n")
+        with self.assertRaises(mys.BadMessageError):
+            mys.Message("a;0;1;0;0;1")
+
+    def testCopy(self):
+        msg = mys.Message(b"255;255;3;0;3;\n", mys.mys_16)
+        response = msg.copy(sub_type=mys.mys_16.Internal.I_ID_RESPONSE, payload=1)
+        self.assertEqual(response.encode(), "255;255;3;0;4;1\n")
+        self.assertEqual(msg.payload, "")
 
 
 if __name__ == '__main__':